@@ -2,36 +2,52 @@ from django.shortcuts import render, redirect
 from django.http import HttpResponse, JsonResponse
 
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import logging
 import json
 
 from workstation_coordinator.models import Reservation
-from workstation_coordinator.coordinator import WorkstationCoordinator
+from .models import User
+from workstation_coordinator.client import CoordinatorClient
 
 logger = logging.getLogger('django.server')
 
-@login_required(login_url='login')
-def get_tags_compatible_with_tags(request):
-    if request.method != 'POST':
-        return JsonResponse({'received': False})
-    
-    coordinator = WorkstationCoordinator()
+# Tag catalogue only changes when templates or tags are edited, responses are revalidated with the catalogue version
+def _get_tag_catalogue_etag(request, *args, **kwargs) -> str:
+    client = CoordinatorClient()
+    return client.template_handler.get_tag_catalogue_version()
 
-    raw_tags = json.loads(request.body)['tags'] 
+def _get_compatible_tags_response(raw_tags: list) -> JsonResponse:
+    client = CoordinatorClient()
     logger.info(f'Received compatible tags query for tags: {raw_tags}')
-    tags = coordinator.template_handler.get_tags_by_string(raw_tags)
-    logger.info(f'Parsed tags: {tags}')
-    compatible_tags = coordinator.template_handler.get_tags_compatible_with_tags(tags)
-    logger.info(f'Compatible tags: {compatible_tags}')
-    compatible_tags_names = coordinator.template_handler.get_tag_names(compatible_tags)
+    compatible_tags_names = client.template_handler.get_tag_names_compatible_with_tag_names(raw_tags)
     logger.info(f'Compatible tags names: {compatible_tags_names}')
     return JsonResponse({'compatible_tags': compatible_tags_names})
 
+# Tags of a GET request are part of the URL, so only its responses are cached and revalidated with the catalogue version
+@cache_control(private=True, max_age=settings.TAG_CATALOGUE_MAX_AGE)
+@condition(etag_func=_get_tag_catalogue_etag)
+def _get_tags_compatible_with_tags_cached(request):
+    return _get_compatible_tags_response(request.GET.getlist('tags'))
+
 @login_required(login_url='login')
+def get_tags_compatible_with_tags(request):
+    if request.method == 'GET':
+        return _get_tags_compatible_with_tags_cached(request)
+    if request.method == 'POST':
+        return _get_compatible_tags_response(json.loads(request.body)['tags'])
+    return JsonResponse({'received': False})
+
+@login_required(login_url='login')
+@cache_control(private=True, max_age=settings.TAG_CATALOGUE_MAX_AGE)
+@condition(etag_func=_get_tag_catalogue_etag)
 def get_all_tags(request):
-    coordinator = WorkstationCoordinator()
-    tags = coordinator.template_handler.get_all_tags()
-    tag_names = coordinator.template_handler.get_tag_names(tags)
+    client = CoordinatorClient()
+    tag_names = client.template_handler.get_all_tag_names()
     response = {'data': [{'text': tag_name, 'value': tag_name} for tag_name in tag_names]}
     return JsonResponse(response)
 
@@ -41,7 +57,7 @@ def get_mapping_target_for_reservation_by_token(request, token: str):
     if request.method != 'GET':
         return HttpResponse('Invalid request method') 
     
-    coordinator = WorkstationCoordinator()
+    client = CoordinatorClient()
     try:
         #mapping_id = base64.b64decode(token).decode('utf-8')
         mapping_id = token
@@ -49,18 +65,125 @@ def get_mapping_target_for_reservation_by_token(request, token: str):
         logger.error(f'Error while decoding token: {e}')
         return HttpResponse('Error while decoding token') 
     logger.info(f'Received token: {mapping_id}')
-    result = coordinator.reservation_handler.get_mapping_target_by_id(mapping_id)
+    result = client.mapping_handler.get_mapping_target_by_id(mapping_id)
     logger.info(f'mapping target result: {result}')
     return HttpResponse(result)
 
+def _get_autocomplete_response(input_text: str, limit: int) -> JsonResponse:
+    client = CoordinatorClient()
+    limit = max(1, min(limit, settings.TAG_AUTOCOMPLETE_MAX_LIMIT))
+    tag_names = client.template_handler.get_tag_names_matching_text(input_text, limit)
+    response = {'data': [{'text': tag_name, 'value': tag_name} for tag_name in tag_names]}
+    return JsonResponse(response)
+
 @login_required(login_url='login')
 def get_all_tags_containing_text(request):
     if request.method != 'POST':
         return JsonResponse({'received': False})
     
-    coordinator = WorkstationCoordinator()
     input_text = json.loads(request.body)['text'] 
-    tags = coordinator.template_handler.get_tags_containing_string_anycase(input_text)
-    tag_names = coordinator.template_handler.get_tag_names(tags)
-    response = {'data': [{'text': tag_name, 'value': tag_name} for tag_name in tag_names]}
-    return JsonResponse(response)
\ No newline at end of file
+    return _get_autocomplete_response(input_text, settings.TAG_AUTOCOMPLETE_LIMIT)
+
+# Used on every keystroke in the reservation form, answered from the in-memory tag index
+@login_required(login_url='login')
+def autocomplete_tags(request):
+    if request.method != 'GET':
+        return JsonResponse({'received': False})
+
+    input_text = request.GET.get('text', '')
+    try:
+        limit = int(request.GET.get('limit', settings.TAG_AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = settings.TAG_AUTOCOMPLETE_LIMIT
+    return _get_autocomplete_response(input_text, limit)
+
+# Requested on every change of the selected tags, answered from the in-memory capacity timeline
+@login_required(login_url='login')
+def get_availability(request):
+    if request.method != 'GET':
+        return JsonResponse({'received': False})
+
+    tags = request.GET.getlist('tags')
+    try:
+        days = int(request.GET.get('days', settings.AVAILABILITY_MAX_DAYS))
+    except ValueError:
+        days = settings.AVAILABILITY_MAX_DAYS
+    client = CoordinatorClient()
+    availability = client.get_availability_for_tags(tags, days)
+    if availability is None:
+        return JsonResponse({'template': None, 'free': []})
+    return JsonResponse(availability)
+
+def _is_string_list(value) -> bool:
+    return isinstance(value, list) and all([isinstance(item, str) for item in value])
+
+# Books reservations for a class or lab in one admission. Either seats reservations owned by the requesting user
+# or one reservation per user in usernames are created, booking for other users requires a staff account.
+# Same validation as the reservation form, dates are ISO 8601
+@login_required(login_url='login')
+def create_reservations(request):
+    if request.method != 'POST':
+        return JsonResponse({'received': False})
+
+    try:
+        data = json.loads(request.body)
+        tags = data['tags']
+        start_date = parse_datetime(data['start_date'])
+        end_date = parse_datetime(data['end_date'])
+        user_label = data.get('user_label', '')
+        usernames = data.get('usernames')
+        seats = int(data.get('seats', 0))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.info(f'Invalid bulk reservation request: {e}')
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+
+    # A string would otherwise be taken as a list of its characters
+    if not _is_string_list(tags) or (usernames is not None and not _is_string_list(usernames)):
+        return JsonResponse({'error': 'Invalid request', 'errors': ['Tags and usernames must be lists of strings.']}, status=400)
+    user_label_max_length = Reservation._meta.get_field('user_label').max_length
+    if user_label is not None and (not isinstance(user_label, str) or len(user_label) > user_label_max_length):
+        return JsonResponse({'error': 'Invalid request', 'errors': [f'Label must be a string of at most {user_label_max_length} characters.']}, status=400)
+
+    errors = []
+    if start_date is None or end_date is None:
+        return JsonResponse({'error': 'Invalid request', 'errors': ['Dates must be in ISO 8601 format.']}, status=400)
+    if timezone.is_naive(start_date):
+        start_date = timezone.make_aware(start_date)
+    if timezone.is_naive(end_date):
+        end_date = timezone.make_aware(end_date)
+    if end_date <= start_date:
+        errors.append('End date must be after start date.')
+    if end_date < timezone.now():
+        errors.append('End date must be in the future.')
+    if (end_date - start_date) < timezone.timedelta(minutes=15):
+        errors.append('Reservation must be at least 15 minutes long.')
+    if len(tags) == 0:
+        errors.append('You must select at least one tag.')
+
+    if usernames is not None:
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Only staff can book reservations for other users'}, status=403)
+        users_by_username = {user.username: user for user in User.objects.filter(username__in=usernames)}
+        unknown_usernames = [username for username in usernames if username not in users_by_username]
+        if len(unknown_usernames) > 0:
+            errors.append(f'Unknown users: {", ".join(unknown_usernames)}')
+        users = [users_by_username[username] for username in usernames if username in users_by_username]
+    else:
+        users = [request.user] * seats
+    if len(users) == 0 or len(users) > settings.BULK_RESERVATION_MAX_SEATS:
+        errors.append(f'Between 1 and {settings.BULK_RESERVATION_MAX_SEATS} reservations can be booked at once.')
+
+    if len(errors) > 0:
+        return JsonResponse({'error': 'Invalid request', 'errors': errors}, status=400)
+
+    client = CoordinatorClient()
+    result = client.create_reservations(users, tags, start_date, end_date, user_label)
+    if result is None:
+        return JsonResponse({'error': 'No template matches the tags'}, status=400)
+    if len(result['reservations']) == 0:
+        return JsonResponse({'error': f'Not enough capacity for {len(users)} reservations'}, status=409)
+    return JsonResponse({
+        'template': result['template'].name,
+        'reservations': [{'id': reservation.id, 'user': reservation.user.username, 'status': reservation.status}
+                         for reservation in result['reservations']],
+    })
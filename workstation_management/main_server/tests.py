@@ -1,3 +1,411 @@
-from django.test import TestCase
+import asyncio
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+
+from main_server.models import User
+from main_server.vnc_proxy import VncProxy
+from workstation_coordinator.mapping_handler import MappingHandler
+from workstation_coordinator.models import Engine, Reservation, Tag, Workstation
+from workstation_coordinator.status_events import StatusEventListener
+from workstation_coordinator.testing import QueryPlanAssertionsMixin, create_reservation_dataset
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are checked on PostgreSQL only')
+class ViewQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = create_reservation_dataset(20000)
+        cls.reservation = Reservation.objects.filter(status=Reservation.Status.Active).first()
+        cls.user = cls.reservation.user
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _get(self, url: str) -> CaptureQueriesContext:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+    def test_dashboard(self):
+        self.assertNoSequentialScans(self._get(reverse('dashboard')))
+
+    def test_reservations_table(self):
+        response = self.client.get(reverse('reservations_table', args=[1]))
+        url = reverse('reservations_table', args=[2]) + '?' + urlencode({'after': response.context['next_cursor']})
+        self.assertNoSequentialScans(self._get(url))
+        url = reverse('reservations_table', args=[1]) + '?' + urlencode({'before': response.context['previous_cursor']})
+        self.assertNoSequentialScans(self._get(url))
+
+    def test_view_reservation(self):
+        for name in ['view_reservation', 'view_reservation_fragments', 'view_reservation_table', 'view_reservation_buttons',
+                     'view_reservation_status', 'view_reservation_progress']:
+            with self.subTest(view=name):
+                self.assertNoSequentialScans(self._get(reverse(name, args=[self.reservation.id])))
+
+    def test_mapping_target_by_token(self):
+        self._get(reverse('access_reservation', args=[self.reservation.id]))
+        self.reservation.refresh_from_db()
+        self.assertNoSequentialScans(self._get(reverse('get_mapping_target_for_reservation_by_token',
+                                                       args=[self.reservation.proxy_mapping_id])))
+
+
+# Sizes of history the query budgets are checked against, budgets must not depend on it
+BUDGET_DATASET_SIZES = [100, 1000, 5000]
+# Including two queries loading session and user of every request. The tag index is rebuilt by the first
+# tag view after the dataset is created, with three queries loading templates, their tags and tags.
+# Later tag views are answered from the index. Availability loads the matched template, the capacity timeline
+# is rebuilt by the first availability request, with one query loading engines and one loading reservations holding capacity
+QUERY_BUDGETS = {
+    'reservations_table': 4,
+    'view_reservation': 3,
+    'view_reservation_fragments': 3,
+    'view_reservation_table': 3,
+    'view_reservation_buttons': 3,
+    'view_reservation_status': 3,
+    'view_reservation_progress': 3,
+    'dashboard': 3,
+    'get_all_tags': 5,
+    'get_tags_compatible_with_tags': 2,
+    'get_all_tags_containing_text': 2,
+    'get_availability': 5,
+}
+
+
+class ViewQueryBudgetTests(TestCase):
+    def _assert_budget(self, name: str, method, url: str, data: dict = None):
+        with self.assertNumQueries(QUERY_BUDGETS[name]):
+            if method == 'post':
+                response = self.client.post(url, data, content_type='application/json')
+            else:
+                response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_views(self):
+        for size in BUDGET_DATASET_SIZES:
+            with self.subTest(size=size), transaction.atomic():
+                dataset = create_reservation_dataset(size, template_count=max(size // 20, 5))
+                reservation = Reservation.objects.filter(status=Reservation.Status.Active).first()
+                self.client.force_login(reservation.user)
+
+                self._assert_budget('dashboard', 'get', reverse('dashboard'))
+                self._assert_budget('reservations_table', 'get', reverse('reservations_table', args=[1]))
+                for name in ['view_reservation', 'view_reservation_fragments', 'view_reservation_table', 'view_reservation_buttons',
+                             'view_reservation_status', 'view_reservation_progress']:
+                    self._assert_budget(name, 'get', reverse(name, args=[reservation.id]))
+
+                tag_names = [tag.name for tag in dataset['tags'][:2]]
+                self._assert_budget('get_all_tags', 'get', reverse('get_all_tags'))
+                self._assert_budget('get_tags_compatible_with_tags', 'post', reverse('get_tags_compatible_with_tags'), {'tags': tag_names})
+                self._assert_budget('get_all_tags_containing_text', 'post', reverse('get_all_tags_containing_text'), {'text': 'tag-1'})
+                self._assert_budget('get_availability', 'get', f"{reverse('get_availability')}?tags={tag_names[0]}")
+                transaction.set_rollback(True)
+
+
+class ReservationsTablePaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        dataset = create_reservation_dataset(200, user_count=2)
+        cls.user = dataset['users'][0]
+        # Request dates are shared by several rows, ids order them within a page and across pages
+        reservations = list(Reservation.objects.filter(user=cls.user))
+        for i, reservation in enumerate(reservations):
+            reservation.request_date = reservations[i // 3 * 3].request_date
+        Reservation.objects.bulk_update(reservations, ['request_date'])
+        cls.expected_ids = list(Reservation.objects.filter(user=cls.user).order_by('-request_date', '-id').values_list('id', flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _get_page(self, page: int, **cursor):
+        response = self.client.get(reverse('reservations_table', args=[page]) + '?' + urlencode(cursor))
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_pages_forward_and_back(self):
+        pages = [self._get_page(1)]
+        while pages[-1]['has_next']:
+            pages.append(self._get_page(len(pages) + 1, after=pages[-1]['next_cursor']))
+        self.assertEqual([reservation.id for page in pages for reservation in page['reservations']], self.expected_ids)
+        self.assertEqual(len(pages), pages[0]['max_pages'])
+        self.assertFalse(pages[0]['has_previous'])
+
+        for number in range(len(pages) - 1, 0, -1):
+            previous_page = self._get_page(number, before=pages[number]['previous_cursor'])
+            self.assertEqual([reservation.id for reservation in previous_page['reservations']],
+                             [reservation.id for reservation in pages[number - 1]['reservations']])
+            self.assertEqual(previous_page['has_previous'], number > 1)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('reservations_table', args=[2]), {'after': 'invalid'})
+        self.assertContains(response, 'Invalid page cursor')
+
+
+class ReservationFragmentsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=1)
+        cls.reservation = Reservation.objects.filter(status=Reservation.Status.Active).first()
+
+    def setUp(self):
+        self.client.force_login(self.reservation.user)
+        self.url = reverse('view_reservation_fragments', args=[self.reservation.id])
+
+    def test_fragments_swapped_out_of_band(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        for element_id in ['reservation-poller', 'reservation-table', 'reservation-progress',
+                           'reservation-status', 'reservation-buttons']:
+            self.assertContains(response, f'id="{element_id}" hx-swap-oob="true"')
+
+    def test_unchanged_version(self):
+        version = self.client.get(self.url).context['version']
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'version': version})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{version}"')
+        self.assertEqual(response.status_code, 304)
+
+        self.reservation.workstation.set_workstation_status(Workstation.Status.Restart)
+        response = self.client.get(self.url, {'version': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.context['version'], version)
+
+    def test_other_user(self):
+        self.client.force_login(User.objects.exclude(id=self.reservation.user_id).first())
+        response = self.client.get(self.url)
+        self.assertContains(response, 'You are not authorized to view this reservation.')
+
+    def test_fragments_cached_until_status_update(self):
+        workstation = self.reservation.workstation
+        response = self.client.get(self.url)
+        vary_on = [self.reservation.id, self.reservation.last_status_update, workstation.last_status_update]
+        self.assertIsNotNone(cache.get(make_template_fragment_key('reservation_status', vary_on)))
+        self.assertContains(response, 'Workstation is active and ready to be accessed')
+
+        self.reservation.set_reservation_status(Reservation.Status.Cancelled)
+        response = self.client.get(self.url)
+        self.assertContains(response, 'Reservation has been cancelled by the user')
+
+    def test_events_disabled(self):
+        response = self.client.get(reverse('view_reservation_events', args=[self.reservation.id]))
+        self.assertEqual(response.status_code, 204)
+
+
+# Notifications are only delivered once the status change commits, so the change is not made in a test transaction
+@skipUnless(connection.vendor == 'postgresql', 'Status events use PostgreSQL notifications')
+@override_settings(STATUS_EVENTS_ENABLED=True, STATUS_EVENTS_HEARTBEAT=0.1)
+class ReservationEventsTests(TransactionTestCase):
+    def setUp(self):
+        create_reservation_dataset(10, live_reservation_count=1)
+        self.reservation = Reservation.objects.select_related('workstation', 'user').filter(status=Reservation.Status.Active).first()
+
+    async def _read_event(self, stream) -> str:
+        async with asyncio.timeout(10):
+            async for chunk in stream:
+                chunk = chunk.decode()
+                if chunk.startswith('event: status'):
+                    return chunk
+
+    async def test_status_change_pushed(self):
+        await self.async_client.aforce_login(self.reservation.user)
+        response = await self.async_client.get(reverse('view_reservation_events', args=[self.reservation.id]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        try:
+            # Streams refresh once the listener is connected
+            await self._read_event(stream)
+
+            workstation = self.reservation.workstation
+            await sync_to_async(workstation.set_workstation_status)(Workstation.Status.Restart)
+            self.assertEqual(await self._read_event(stream), f'event: status\ndata: workstation:{workstation.id}\n\n')
+        finally:
+            await stream.aclose()
+            StatusEventListener().task.cancel()
+
+
+class TagCatalogueCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = create_reservation_dataset(10)
+
+    def setUp(self):
+        self.client.force_login(self.dataset['users'][0])
+
+    def test_not_modified_until_catalogue_changes(self):
+        tag_names = [tag.name for tag in self.dataset['tags'][:2]]
+        for url in [reverse('get_all_tags'), reverse('get_tags_compatible_with_tags') + f'?tags={tag_names[0]}&tags={tag_names[1]}']:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('private', response['Cache-Control'])
+                etag = response['ETag']
+
+                with self.assertNumQueries(2):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+
+                tag = Tag.objects.create(name='new-tag')
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+                tag.delete()
+
+    def test_compatible_tags_match_post(self):
+        tag_names = [self.dataset['tags'][0].name]
+        response = self.client.post(reverse('get_tags_compatible_with_tags'), {'tags': tag_names}, content_type='application/json')
+        self.assertEqual(response.json(), {'compatible_tags': [self.dataset['tags'][1].name]})
+        response = self.client.get(reverse('get_tags_compatible_with_tags'), {'tags': tag_names})
+        self.assertEqual(response.json(), {'compatible_tags': [self.dataset['tags'][1].name]})
+        response = self.client.get(reverse('get_tags_compatible_with_tags'), {'tags': tag_names + ['unknown']})
+        self.assertEqual(response.json(), {'compatible_tags': []})
+
+    # Tags of a POST are in the body, a matching catalogue version must not turn it into a failed precondition
+    def test_post_not_conditional(self):
+        tag_names = [self.dataset['tags'][0].name]
+        etag = self.client.get(reverse('get_tags_compatible_with_tags'), {'tags': tag_names})['ETag']
+        response = self.client.post(reverse('get_tags_compatible_with_tags'), {'tags': tag_names},
+                                    content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'compatible_tags': [self.dataset['tags'][1].name]})
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Cache-Control'))
+
+
+# Each of the two engines has room for 30 reservations of a template
+class BulkReservationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = create_reservation_dataset(0, engine_count=2, template_count=1)
+        Engine.objects.update(max_resources={'cpu': 2 * 30, 'memory': 4096 * 30})
+        cls.user = cls.dataset['users'][0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def _post(self, **data):
+        start_date = timezone.now() + timezone.timedelta(days=1)
+        request = {
+            'tags': [self.dataset['tags'][0].name],
+            'start_date': start_date.isoformat(),
+            'end_date': (start_date + timezone.timedelta(hours=2)).isoformat(),
+            'user_label': 'Lab',
+        }
+        request.update(data)
+        return self.client.post(reverse('create_reservations'), request, content_type='application/json')
+
+    def test_seats(self):
+        with CaptureQueriesContext(connection) as few_seats:
+            response = self._post(seats=5)
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as many_seats:
+            response = self._post(seats=55)
+        self.assertEqual(response.status_code, 200)
+        # Queries do not depend on the number of seats
+        self.assertEqual(len(many_seats), len(few_seats))
+
+        reservations = Reservation.objects.filter(user=self.user)
+        self.assertEqual(reservations.filter(status=Reservation.Status.Approved, workstation__status=Workstation.Status.Scheduled).count(), 60)
+        self.assertEqual(Workstation.objects.filter(engine=self.dataset['engines'][1]).count(), 30)
+        self.assertEqual(len(response.json()['reservations']), 55)
+        self.assertTrue(reservations.filter(user_label='Lab #55').exists())
+
+    def test_longest_label(self):
+        response = self._post(seats=1, user_label='L' * 50)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Reservation.objects.filter(user_label='L' * 50).exists())
+
+    def test_not_enough_capacity(self):
+        response = self._post(seats=61)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Reservation.objects.count(), 0)
+        self.assertEqual(Workstation.objects.count(), 0)
+
+    def test_usernames(self):
+        usernames = [user.username for user in self.dataset['users'][:3]]
+        self.assertEqual(self._post(usernames=usernames).status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save(update_fields=['is_staff'])
+        response = self._post(usernames=usernames)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([reservation['user'] for reservation in response.json()['reservations']], usernames)
+        self.assertEqual(self._post(usernames=['not-a-user']).status_code, 400)
+
+    def test_invalid_request(self):
+        self.assertEqual(self._post(seats=0).status_code, 400)
+        self.assertEqual(self._post(seats=5, end_date='not-a-date').status_code, 400)
+        self.assertEqual(self._post(seats=5, tags=['not-a-tag']).status_code, 400)
+        self.assertEqual(self._post(seats=5, tags=self.dataset['tags'][0].name).status_code, 400)
+        self.assertEqual(self._post(seats=5, tags=[1]).status_code, 400)
+
+        self.user.is_staff = True
+        self.user.save(update_fields=['is_staff'])
+        self.assertEqual(self._post(usernames=self.dataset['users'][0].username).status_code, 400)
+        self.assertEqual(self._post(usernames=[None]).status_code, 400)
+        self.assertEqual(self._post(seats=5, user_label=5).status_code, 400)
+        self.assertEqual(self._post(seats=5, user_label=['Lab']).status_code, 400)
+        self.assertEqual(self._post(usernames=[self.user.username], user_label='L' * 51).status_code, 400)
+        self.assertEqual(Reservation.objects.count(), 0)
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+# Drives the proxy as an ASGI server would, with the workstation VNC port served by an echo server
+class VncProxyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=1)
+        cls.reservation = Reservation.objects.select_related('workstation').filter(status=Reservation.Status.Active).first()
+
+    async def _connect(self, token: str) -> tuple:
+        client_messages = asyncio.Queue()
+        server_messages = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/websockify', 'query_string': f'token={token}'.encode(), 'subprotocols': ['binary']}
+        await client_messages.put({'type': 'websocket.connect'})
+        task = asyncio.create_task(VncProxy()(scope, client_messages.get, server_messages.put))
+        return client_messages, server_messages, task
+
+    async def test_relay(self):
+        server = await asyncio.start_server(echo, '127.0.0.1', 0)
+        workstation = self.reservation.workstation
+        workstation.ip_address, workstation.port = server.sockets[0].getsockname()
+        await workstation.asave(update_fields=['ip_address', 'port'])
+        await sync_to_async(MappingHandler().create_mapping_for_reservation)(self.reservation)
+        token = str(self.reservation.proxy_mapping.id)
+
+        async with server, asyncio.timeout(10):
+            client_messages, server_messages, task = await self._connect(token)
+            self.assertEqual(await server_messages.get(), {'type': 'websocket.accept', 'subprotocol': 'binary'})
+            for data in [b'RFB 003.008\n', b'x' * 200000]:
+                await client_messages.put({'type': 'websocket.receive', 'bytes': data})
+                received = b''
+                while len(received) < len(data):
+                    received += (await server_messages.get())['bytes']
+                self.assertEqual(received, data)
+            await client_messages.put({'type': 'websocket.disconnect', 'code': 1000})
+            await task
+
+            # Tokens give a target once, reconnecting needs a new mapping
+            client_messages, server_messages, task = await self._connect(token)
+            self.assertEqual(await server_messages.get(), {'type': 'websocket.close', 'code': 1008})
+            await task
+
+    async def test_unknown_token(self):
+        client_messages, server_messages, task = await self._connect('unknown')
+        self.assertEqual(await server_messages.get(), {'type': 'websocket.close', 'code': 1008})
+        await task
@@ -11,6 +11,9 @@ api_patterns = [
     path('get_all_tags/', api_views.get_all_tags, name='get_all_tags'),
     path('get_mapping_target_for_reservation_by_token/<str:token>', api_views.get_mapping_target_for_reservation_by_token, name='get_mapping_target_for_reservation_by_token'),
     path('get_all_tags_containing_text/', api_views.get_all_tags_containing_text, name='get_all_tags_containing_text'),
+    path('autocomplete_tags/', api_views.autocomplete_tags, name='autocomplete_tags'),
+    path('availability/', api_views.get_availability, name='get_availability'),
+    path('create_reservations/', api_views.create_reservations, name='create_reservations'),
 ]
 
 
@@ -30,6 +33,8 @@ urlpatterns = [
     path('create_reservation/', views.create_reservation, name='create_reservation'),
     path('cancel_reservation/<uuid:reservation_id>/', views.cancel_reservation, name='cancel_reservation'),
     path('view_reservation_status/<uuid:reservation_id>/', views.view_reservation_status, name='view_reservation_status'),
+    path('view_reservation_fragments/<uuid:reservation_id>/', views.view_reservation_fragments, name='view_reservation_fragments'),
+    path('view_reservation_events/<uuid:reservation_id>/', views.view_reservation_events, name='view_reservation_events'),
     path('view_reservation_progress/<uuid:reservation_id>/', views.view_reservation_progress, name='view_reservation_progress'),
     path('restart_workstation/<uuid:reservation_id>/', views.restart_workstation, name='restart_workstation'),
     path('api/', include(api_patterns)), 
@@ -1,14 +1,18 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.conf import settings
+from django.utils.cache import get_conditional_response
 from django.db.models import Q
 
 from django.contrib.auth.decorators import login_required
 from .forms import UserCreationFormWithEmail, CreateReservation
 from django.utils import timezone
+import asyncio
 import logging
 
 from workstation_coordinator.models import Reservation
-from workstation_coordinator.coordinator import WorkstationCoordinator
+from workstation_coordinator.client import CoordinatorClient, RESERVATION_TABLE_FIELDS
+from workstation_coordinator.status_events import StatusEventListener, get_status_event_keys_for_reservation
 
 logger = logging.getLogger('django.server')
 
@@ -55,6 +59,7 @@ def dashboard(request):
     latest_reservations = Reservation.objects\
         .filter(user=request.user)\
         .filter(Q(status=Reservation.Status.Approved) | Q(status=Reservation.Status.Active))\
+        .only(*RESERVATION_TABLE_FIELDS)\
         .order_by('-start_date')[:2]
     template_arguments['latest_reservations'] = latest_reservations
     return render(request, 'frontend/dashboard.html', template_arguments)
@@ -65,41 +70,127 @@ def reservations(request):
     template_arguments['username'] = request.user.username
     return render(request, 'frontend/reservations.html', template_arguments)
 
+RESERVATIONS_PAGE_SIZE = 10
+
+# Everything the reservation views render in one query, ownership is checked with user_id without loading the user
+def _get_reservation(reservation_id) -> Reservation:
+    return Reservation.objects.select_related('template', 'workstation', 'proxy_mapping').get(id=reservation_id)
+
+# Pages link to each other with cursors of their first and last row, page numbers are only displayed
 @login_required(login_url='login')
 def reservations_table(request, page: int):
+    client = CoordinatorClient()
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    page = page - 1
-    start_index = page * 10
-    end_index = start_index + 10
-    user_reservations = Reservation.objects.filter(user=request.user)
-    truncated_reservations = user_reservations[start_index:end_index]
-    template_arguments['reservations'] = truncated_reservations
-    template_arguments['current_page'] = page + 1
-    template_arguments['max_pages'] = len(user_reservations) // 10 + 1
+    try:
+        reservations_page = client.get_reservations_page_for_user(request.user, RESERVATIONS_PAGE_SIZE,
+                                                                  after=request.GET.get('after'),
+                                                                  before=request.GET.get('before'))
+    except ValueError:
+        return HttpResponse('Invalid page cursor')
+    reservations = reservations_page['reservations']
+    template_arguments['reservations'] = reservations
+    template_arguments['has_previous'] = reservations_page['has_previous'] and page > 1
+    template_arguments['has_next'] = reservations_page['has_next']
+    if len(reservations) > 0:
+        template_arguments['previous_cursor'] = client.get_reservation_cursor(reservations[0])
+        template_arguments['next_cursor'] = client.get_reservation_cursor(reservations[-1])
+    template_arguments['current_page'] = page
+    reservation_count = client.get_reservation_count_for_user(request.user)
+    template_arguments['max_pages'] = max((reservation_count - 1) // RESERVATIONS_PAGE_SIZE + 1, 1)
 
     return render(request, 'frontend/reservations_table.html', template_arguments)
 
-@login_required(login_url='login')
-def view_reservation(request, reservation_id):
+def _get_reservation_page_arguments(request, reservation: Reservation) -> dict:
+    client = CoordinatorClient()
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    reservation = Reservation.objects.get(id=reservation_id)
     template_arguments['reservation'] = reservation
+    template_arguments['progress'] = client.get_progress_for_reservation(reservation)
+    template_arguments['version'] = client.get_state_version_for_reservation(reservation, template_arguments['progress'])
+    template_arguments['fragment_cache_ttl'] = settings.RESERVATION_FRAGMENT_CACHE_TTL
+    template_arguments['status_events_enabled'] = settings.STATUS_EVENTS_ENABLED
+    if settings.STATUS_EVENTS_ENABLED:
+        template_arguments['poll_interval'] = settings.STATUS_EVENTS_POLL_INTERVAL
+    else:
+        template_arguments['poll_interval'] = settings.RESERVATION_POLL_INTERVAL
+    return template_arguments
+
+@login_required(login_url='login')
+def view_reservation(request, reservation_id):
+    reservation = _get_reservation(reservation_id)
+
+    if reservation.user_id != request.user.id:
+        return HttpResponse('You are not authorized to view this reservation.')
+
+    return render(request, 'frontend/view_reservation.html', _get_reservation_page_arguments(request, reservation))
 
-    if reservation.user != request.user:
+# Polled by the reservation page, returns all of its fragments as htmx out of band swaps. Pages send the version
+# they show and get an empty 204 response while it is current, which htmx does not swap
+@login_required(login_url='login')
+def view_reservation_fragments(request, reservation_id):
+    reservation = _get_reservation(reservation_id)
+
+    if reservation.user_id != request.user.id:
+        return HttpResponse('You are not authorized to view this reservation.')
+
+    template_arguments = _get_reservation_page_arguments(request, reservation)
+    version = template_arguments['version']
+    if request.GET.get('version') == version:
+        return HttpResponse(status=204)
+    response = get_conditional_response(request, etag=f'"{version}"')
+    if response is not None:
+        return response
+
+    response = render(request, 'frontend/view_reservation_fragments.html', template_arguments)
+    response['ETag'] = f'"{version}"'
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+async def _stream_reservation_events(reservation: Reservation):
+    listener = StatusEventListener()
+    queue = listener.subscribe(get_status_event_keys_for_reservation(reservation))
+    try:
+        while True:
+            try:
+                key = await asyncio.wait_for(queue.get(), timeout=settings.STATUS_EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ': heartbeat\n\n'
+                continue
+            # Workstation is assigned together with a reservation status change
+            if key.startswith('reservation:'):
+                reservation = await Reservation.objects.aget(id=reservation.id)
+                listener.update_subscription(queue, get_status_event_keys_for_reservation(reservation))
+            yield f'event: status\ndata: {key}\n\n'
+    finally:
+        listener.unsubscribe(queue)
+
+# Server sent events telling the reservation page its reservation or workstation changed status, the page then
+# fetches view_reservation_fragments once. Answered with 204 when disabled, which stops EventSource reconnecting
+@login_required(login_url='login')
+async def view_reservation_events(request, reservation_id):
+    if not settings.STATUS_EVENTS_ENABLED:
+        return HttpResponse(status=204)
+    reservation = await Reservation.objects.aget(id=reservation_id)
+    user = await request.auser()
+
+    if reservation.user_id != user.id:
         return HttpResponse('You are not authorized to view this reservation.')
 
-    return render(request, 'frontend/view_reservation.html', template_arguments)
+    response = StreamingHttpResponse(_stream_reservation_events(reservation), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 @login_required(login_url='login')
 def view_reservation_table(request, reservation_id):
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    reservation = Reservation.objects.get(id=reservation_id)
+    template_arguments['fragment_cache_ttl'] = settings.RESERVATION_FRAGMENT_CACHE_TTL
+    reservation = _get_reservation(reservation_id)
     template_arguments['reservation'] = reservation
 
-    if reservation.user != request.user:
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to view this reservation.')
 
     return render(request, 'frontend/view_reservation_table.html', template_arguments)
@@ -108,10 +199,10 @@ def view_reservation_table(request, reservation_id):
 def view_reservation_buttons(request, reservation_id):
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    reservation = Reservation.objects.get(id=reservation_id)
+    reservation = _get_reservation(reservation_id)
     template_arguments['reservation'] = reservation
 
-    if reservation.user != request.user:
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to view this reservation.')
 
     return render(request, 'frontend/view_reservation_buttons.html', template_arguments)
@@ -120,42 +211,47 @@ def view_reservation_buttons(request, reservation_id):
 def view_reservation_status(request, reservation_id):
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    reservation = Reservation.objects.get(id=reservation_id)
+    template_arguments['fragment_cache_ttl'] = settings.RESERVATION_FRAGMENT_CACHE_TTL
+    reservation = _get_reservation(reservation_id)
     template_arguments['reservation'] = reservation
 
-    if reservation.user != request.user:
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to view this reservation.')
 
     return render(request, 'frontend/view_reservation_status.html', template_arguments)
 
 @login_required(login_url='login')
 def view_reservation_progress(request, reservation_id):
-    coordinator = WorkstationCoordinator()
+    client = CoordinatorClient()
     template_arguments = {}
     template_arguments['username'] = request.user.username
-    reservation = Reservation.objects.get(id=reservation_id)
+    template_arguments['fragment_cache_ttl'] = settings.RESERVATION_FRAGMENT_CACHE_TTL
+    reservation = _get_reservation(reservation_id)
     template_arguments['reservation'] = reservation
-    template_arguments['progress'] =  coordinator.reservation_handler.get_progress_for_reservation(reservation)
+    template_arguments['progress'] =  client.get_progress_for_reservation(reservation)
 
-    if reservation.user != request.user:
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to view this reservation.')
 
     return render(request, 'frontend/view_reservation_progress.html', template_arguments)
 
 @login_required(login_url='login')
 def access_reservation(request, reservation_id):
-    reservation = Reservation.objects.get(id=reservation_id)
-    coordinator = WorkstationCoordinator()
-    coordinator.reservation_handler.archive_mapping_for_reservation_if_exists(reservation)
-    coordinator.reservation_handler.get_mapping_for_reservation(reservation) 
+    reservation = _get_reservation(reservation_id)
+
+    if reservation.user_id != request.user.id:
+        return HttpResponse('You are not authorized to access this reservation.')
+
+    client = CoordinatorClient()
+    client.mapping_handler.archive_mapping_for_reservation_if_exists(reservation)
+    client.mapping_handler.get_mapping_for_reservation(reservation) 
     template_arguments = {}
     template_arguments['username'] = request.user.username
     
     template_arguments['reservation'] = reservation
     template_arguments['mapping_target'] = reservation.proxy_mapping.id
-
-    if reservation.user != request.user:
-        return HttpResponse('You are not authorized to access this reservation.')
+    # noVNC connects to the path relative to its own address, websockify is served at the root
+    template_arguments['vnc_path'] = settings.VNC_PROXY_PATH.lstrip('/') if settings.VNC_PROXY_ENABLED else ''
 
     return render(request, 'frontend/access_reservation.html', template_arguments)
 
@@ -175,8 +271,8 @@ def create_reservation(request):
             start_date = form.cleaned_data['start_date']
             end_date = form.cleaned_data['end_date']
 
-            coordinator = WorkstationCoordinator()
-            reservation = coordinator.reservation_handler.create_reservation(request.user, tags, start_date, end_date)
+            client = CoordinatorClient()
+            reservation = client.create_reservation(request.user, tags, start_date, end_date)
             if reservation is None:
                 logger.info("Reservation not created")
                 return HttpResponse('Reservation not created.') 
@@ -225,8 +321,8 @@ def create_reservation(request):
             if len(form.errors) > 0:
                 return render(request, 'frontend/create_reservation.html', {'form': form})
 
-            coordinator = WorkstationCoordinator()
-            reservation = coordinator.reservation_handler.create_reservation(request.user, tags, start_date, end_date, user_label)
+            client = CoordinatorClient()
+            reservation = client.create_reservation(request.user, tags, start_date, end_date, user_label)
             if reservation is None:
                 logger.info("Reservation not created")
                 return HttpResponse('Reservation not created.') 
@@ -243,12 +339,12 @@ def create_reservation(request):
 
 @login_required(login_url='login')
 def cancel_reservation(request, reservation_id):
-    reservation = Reservation.objects.get(id=reservation_id)
-    if reservation.user != request.user:
+    reservation = _get_reservation(reservation_id)
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to cancel this reservation.')
 
-    coordinator = WorkstationCoordinator()
-    result = coordinator.reservation_handler.cancel_reservation(reservation)
+    client = CoordinatorClient()
+    result = client.cancel_reservation(reservation)
     template_arguments = {}
     template_arguments['result'] = result
     
@@ -263,12 +359,12 @@ def cancel_reservation(request, reservation_id):
 @login_required(login_url='login')
 def restart_workstation(request, reservation_id):
 
-    reservation = Reservation.objects.get(id=reservation_id)
-    if reservation.user != request.user:
+    reservation = _get_reservation(reservation_id)
+    if reservation.user_id != request.user.id:
         return HttpResponse('You are not authorized to cancel this reservation.')
 
-    coordinator = WorkstationCoordinator()
-    result = coordinator.reservation_handler.restart_workstation_for_reservation(reservation)
+    client = CoordinatorClient()
+    result = client.restart_workstation_for_reservation(reservation)
     if result:
         logger.info('Workstation restarted')
     else:
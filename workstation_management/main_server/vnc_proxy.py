@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import socket
+import time
+from typing import Callable
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from workstation_coordinator.client import CoordinatorClient
+
+logger = logging.getLogger('django.server')
+
+# Subprotocol requested by noVNC, frames carry raw RFB bytes
+VNC_PROXY_SUBPROTOCOL = 'binary'
+SERVER_READ_SIZE = 65536
+
+
+class VncProxyConnectionStats:
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self.target = None
+        self.started_at = time.perf_counter()
+        self.connected_at = None
+        self.first_server_byte_at = None
+        self.closed_at = None
+        self.client_bytes = 0
+        self.client_messages = 0
+        self.server_bytes = 0
+        self.server_messages = 0
+
+    def as_dict(self) -> dict:
+        closed_at = self.closed_at if self.closed_at is not None else time.perf_counter()
+        duration = closed_at - self.started_at
+        stats = {
+            'target': self.target,
+            'duration_s': round(duration, 3),
+            'client_bytes': self.client_bytes,
+            'client_messages': self.client_messages,
+            'server_bytes': self.server_bytes,
+            'server_messages': self.server_messages,
+            'client_throughput_mbps': round(self.client_bytes * 8 / duration / 1e6, 3) if duration > 0 else 0,
+            'server_throughput_mbps': round(self.server_bytes * 8 / duration / 1e6, 3) if duration > 0 else 0,
+        }
+        if self.connected_at is not None:
+            stats['connect_ms'] = round((self.connected_at - self.started_at) * 1000, 3)
+        if self.first_server_byte_at is not None:
+            stats['first_server_byte_ms'] = round((self.first_server_byte_at - self.started_at) * 1000, 3)
+        return stats
+
+
+def get_token(scope) -> str:
+    tokens = parse_qs(scope.get('query_string', b'').decode()).get('token', [])
+    return tokens[0] if len(tokens) > 0 else None
+
+
+# Mappings give host:port to their first lookup only, later lookups and archived mappings give no target
+def parse_target(target: str) -> tuple:
+    host, separator, port = target.rpartition(':')
+    if separator == '' or host == '' or not port.isdigit():
+        return None
+    return host, int(port)
+
+
+async def resolve_target_by_token(token: str) -> tuple:
+    client = CoordinatorClient()
+    target = await sync_to_async(client.mapping_handler.get_mapping_target_by_id)(token)
+    return parse_target(target)
+
+
+# ASGI application relaying noVNC WebSocket connections to the VNC port of the workstation of a proxy mapping,
+# in place of an external websockify process calling back into the token API. Tokens are resolved in process
+# through the mapping cache, data is passed on as received in both directions without reassembling it.
+class VncProxy:
+    def __init__(self, resolve_target: Callable = resolve_target_by_token, on_close: Callable = None) -> None:
+        self.resolve_target = resolve_target
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+
+        stats = VncProxyConnectionStats(get_token(scope))
+        target = None
+        if stats.token is not None:
+            target = await self.resolve_target(stats.token)
+        if target is None:
+            logger.info(f'VNC proxy rejected token {stats.token}')
+            await send({'type': 'websocket.close', 'code': 1008})
+            return
+        stats.target = f'{target[0]}:{target[1]}'
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*target), timeout=settings.VNC_PROXY_CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.error(f'VNC proxy could not connect to {stats.target}: {e}')
+            await send({'type': 'websocket.close', 'code': 1011})
+            return
+        server_socket = writer.get_extra_info('socket')
+        if server_socket is not None:
+            server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stats.connected_at = time.perf_counter()
+
+        subprotocol = VNC_PROXY_SUBPROTOCOL if VNC_PROXY_SUBPROTOCOL in scope.get('subprotocols', []) else None
+        await send({'type': 'websocket.accept', 'subprotocol': subprotocol})
+        try:
+            await self._relay(receive, send, reader, writer, stats)
+        finally:
+            writer.close()
+            stats.closed_at = time.perf_counter()
+            logger.info(f'VNC proxy connection closed: {stats.as_dict()}')
+            if self.on_close is not None:
+                self.on_close(stats)
+
+    async def _relay(self, receive, send, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, stats: VncProxyConnectionStats):
+        tasks = [
+            asyncio.create_task(self._relay_client_to_server(receive, writer, stats)),
+            asyncio.create_task(self._relay_server_to_client(send, reader, stats)),
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                logger.error(f'VNC proxy connection to {stats.target} failed: {task.exception()}')
+
+    async def _relay_client_to_server(self, receive, writer: asyncio.StreamWriter, stats: VncProxyConnectionStats):
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                return
+            data = message.get('bytes')
+            if data is None:
+                continue
+            writer.write(data)
+            stats.client_bytes += len(data)
+            stats.client_messages += 1
+            # Waits only while the workstation does not keep up, so the client is slowed down instead of buffered
+            await writer.drain()
+
+    async def _relay_server_to_client(self, send, reader: asyncio.StreamReader, stats: VncProxyConnectionStats):
+        while True:
+            data = await reader.read(SERVER_READ_SIZE)
+            if len(data) == 0:
+                await send({'type': 'websocket.close', 'code': 1000})
+                return
+            if stats.first_server_byte_at is None:
+                stats.first_server_byte_at = time.perf_counter()
+            stats.server_bytes += len(data)
+            stats.server_messages += 1
+            await send({'type': 'websocket.send', 'bytes': data})
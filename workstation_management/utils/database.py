@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db import connection, connections
+
+# Returns connections of the calling thread. With the pool enabled they go back to the pool, otherwise
+# they are closed, so that threads which are done with the database do not keep idle sessions open.
+def release_connections():
+    connections.close_all()
+
+# Pooled connections are shared between threads, session level state such as advisory locks
+# taken by the coordinator must not be handed over to the next user of the connection
+def reset_pooled_connection(pooled_connection):
+    pooled_connection.execute('SELECT pg_advisory_unlock_all()')
+    if not pooled_connection.autocommit:
+        pooled_connection.rollback()
+
+# Has to be called before the first connection is made, the pool is created with the options it has then
+def use_pooled_connection_reset(alias: str = 'default'):
+    pool_options = settings.DATABASES[alias].get('OPTIONS', {}).get('pool')
+    if isinstance(pool_options, dict):
+        pool_options['reset'] = reset_pooled_connection
+
+def get_pool_stats() -> dict:
+    pool = getattr(connection, 'pool', None)
+    if pool is None:
+        return {}
+    return pool.get_stats()
@@ -1,4 +1,5 @@
 import threading
+from .database import release_connections
 
 class ThreadWithCallback(threading.Thread):
     def __init__(self, callback=None, callback_args=(), *args, **kwargs):
@@ -9,6 +10,9 @@ class ThreadWithCallback(threading.Thread):
         self.callback_args = callback_args
 
     def target_with_callback(self, *args, **kwargs):
-        self.method(*args, **kwargs)
-        if self.callback is not None:
-            self.callback(*self.callback_args)
\ No newline at end of file
+        try:
+            self.method(*args, **kwargs)
+            if self.callback is not None:
+                self.callback(*self.callback_args)
+        finally:
+            release_connections()
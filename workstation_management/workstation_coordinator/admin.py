@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Workstation, Engine, Host, ProxyMapping, Reservation, Tag, Template, EngineType
+from .models import Workstation, Engine, Host, ProxyMapping, Reservation, Tag, Template, EngineType, CoordinatorCommand
 
 
 class EngineAdmin(admin.ModelAdmin):
@@ -13,3 +13,4 @@ admin.site.register(Reservation)
 admin.site.register(Tag)
 admin.site.register(Template)
 admin.site.register(EngineType)
+admin.site.register(CoordinatorCommand)
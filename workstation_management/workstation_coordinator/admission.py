@@ -0,0 +1,115 @@
+import logging
+from django.db.models import QuerySet
+from .models import Template, Reservation, Host, Workstation, Engine
+from .reservation_policies import ReservationPolicy, EngineCandidate, get_policy
+from .engine_handler import EngineHandler
+
+logger = logging.getLogger('workstation_coordinator')
+
+
+# Capacity check and engine placement of pending reservations, used by the coordinator tick and by web workers
+# admitting reservations while the request is handled. Callers lock engine rows with EngineHandler._get_all_for_update
+# until the admission is committed, so that two admissions cannot book the same capacity.
+class ReservationAdmission:
+    def __init__(self) -> None:
+        self.policies = {}
+
+    def _get_policy_for_template(self, template: Template) -> ReservationPolicy:
+        name = template.placement_policy
+        if name not in self.policies:
+            self.policies[name] = get_policy(name)
+        return self.policies[name]
+
+    def _get_without_workstation(self, reservations: QuerySet) -> QuerySet:
+        return reservations.filter(workstation__isnull=True)
+
+    def _get_overlapping(self, reservation: Reservation) -> QuerySet:
+
+        start_overlap = Reservation.objects.filter(start_date__lte=reservation.start_date, end_date__lte=reservation.end_date, end_date__gte=reservation.start_date)
+        end_overlap = Reservation.objects.filter(start_date__gte=reservation.start_date, end_date__gte=reservation.end_date, start_date__lte=reservation.end_date)
+        outer_overlap = Reservation.objects.filter(start_date__lte=reservation.start_date, end_date__gte=reservation.end_date)
+        inner_overlap = Reservation.objects.filter(start_date__gte=reservation.start_date, end_date__lte=reservation.end_date)
+
+        return (start_overlap | end_overlap | outer_overlap | inner_overlap)\
+            .exclude(id=reservation.id)\
+            .select_related('template', 'user')
+
+    def _get_candidates(self, reservation: Reservation, engines: list, engine_handler: EngineHandler) -> list[EngineCandidate]:
+        logger.info(f'Checking for overlapping reservations')
+
+        reservations_in_same_timeframe = self._get_overlapping(reservation)
+        logger.info(f'Reservations in same timeframe: {list(reservations_in_same_timeframe)}')
+
+        logger.info(f'Filtering out reservetions with already assigned workstation') 
+        reservations_without_workstation = list(self._get_without_workstation(reservations_in_same_timeframe))
+        filtered_reservations = reservations_in_same_timeframe.exclude(id__in=[r.id for r in reservations_without_workstation])
+        logger.info(f'Reservations without workstation: {reservations_without_workstation}')
+        logger.info(f'Searching for suitable engine')
+
+        load_by_engine = engine_handler._get_load_by_engine(filtered_reservations)
+
+        candidates = []
+        for engine in engines:
+            logger.info(f'Checking engine: {engine}')
+
+            # Does engine have available resources at the time of reservation
+            max_vm_load_at_time = load_by_engine.get(engine.id, {})
+            max_possible_load = engine_handler._get_max_possible_load(engine)
+            template_load = reservation.template.resource_requirements
+            candidate = EngineCandidate(engine, max_vm_load_at_time, max_possible_load, template_load, engine.average_setup_time)
+
+            logger.info(f'Max VM load at time: {max_vm_load_at_time}')
+            logger.info(f'Max possible load: {max_possible_load}')
+            logger.info(f'Template load: {template_load}')
+            logger.info(f'Cumulative load: {candidate.get_load_after_placement()}')
+            if candidate.fits():
+                logger.info(f'Engine {engine} has enough resources for reservation {reservation}')
+            else:
+                logger.info(f'Engine {engine} does not have enough resources for reservation {reservation}')
+            candidates.append(candidate)
+        return candidates
+
+    # Returns engine selected by the placement policy of the template, None if no engine has enough resources
+    def select_engine(self, reservation: Reservation, engines: list, engine_handler: EngineHandler) -> Engine:
+        candidates = self._get_candidates(reservation, engines, engine_handler)
+        policy = self._get_policy_for_template(reservation.template)
+        logger.info(f'Using placement policy: {policy.name}')
+        selected = policy.select_engine(candidates)
+        if selected is None:
+            logger.info(f'No suitable engine found for reservation {reservation}')
+            return None
+
+        logger.info(f'Policy {policy.name} selected engine {selected.engine} for reservation {reservation}')
+        return selected.engine
+
+    # Returns False if the reservation changed status since it was read, its workstation is then discarded
+    def approve(self, reservation: Reservation, engine: Engine) -> bool:
+        host = Host.objects.filter(engines__in=[engine]).first()
+        workstation = Workstation.objects.create(
+            template=reservation.template,
+            host=host,
+            engine=engine,
+            status=Workstation.Status.Scheduled
+        )
+        if not reservation.set_reservation_status(Reservation.Status.Approved, workstation=workstation):
+            logger.info(f'Reservation {reservation} changed status during admission, discarding workstation')
+            workstation.delete()
+            return False
+        logger.info(f'Reservation {reservation} approved')
+        return True
+
+    # Places count reservations with the template and time of reservation one after another, each seeing the load
+    # of the ones placed before it. Returns selected engines, None if not all of them fit
+    def select_engines(self, reservation: Reservation, count: int, engines: list, engine_handler: EngineHandler) -> list[Engine]:
+        candidates = self._get_candidates(reservation, engines, engine_handler)
+        policy = self._get_policy_for_template(reservation.template)
+        logger.info(f'Using placement policy: {policy.name} for {count} reservations')
+        selected_engines = []
+        for _ in range(count):
+            selected = policy.select_engine(candidates)
+            if selected is None:
+                logger.info(f'Only {len(selected_engines)} of {count} reservations fit')
+                return None
+            selected.current_load = {**selected.current_load, **selected.get_load_after_placement()}
+            selected_engines.append(selected.engine)
+        return selected_engines
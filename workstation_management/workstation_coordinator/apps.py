@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class WorkstationCoordinatorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'workstation_coordinator'
\ No newline at end of file
+    name = 'workstation_coordinator'
+
+    def ready(self):
+        from . import signals
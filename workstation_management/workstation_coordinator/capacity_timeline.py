@@ -0,0 +1,176 @@
+import logging
+import math
+import operator
+import threading
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.utils import timezone
+from utils.singleton import Singleton
+from .models import Engine, Reservation
+from .scheduler import SYNC_OVERLAP
+
+logger = logging.getLogger('workstation_coordinator')
+
+# Reservations in these statuses do not hold capacity of their engine, same as in EngineHandler._get_reservations_with_engine
+NOT_HOLDING_CAPACITY_STATUSES = [
+    Reservation.Status.Pending,
+    Reservation.Status.Rejected,
+    Reservation.Status.Completed,
+    Reservation.Status.Cancelled,
+]
+
+TIMELINE_FIELDS = ['id', 'status', 'start_date', 'end_date', 'last_status_update',
+                   'workstation__engine_id', 'template__resource_requirements']
+
+
+class CapacityTimelineSnapshot:
+    def __init__(self, origin: datetime, bucket_size: timedelta, bucket_count: int, engines: list[Engine]) -> None:
+        self.origin = origin
+        self.bucket_size = bucket_size
+        self.bucket_count = bucket_count
+        self.horizon = origin + bucket_size * bucket_count
+        self.max_resources_by_engine = {engine.id: engine.max_resources for engine in engines}
+        # Load per engine, resource and bucket
+        self.load_by_engine = {engine.id: {} for engine in engines}
+        # Buckets and load each reservation was added with, so that changed reservations can be taken out again
+        self.placements = {}
+        # Last seen status update per reservation, so that rows inside the sync overlap are applied only once
+        self.versions = {}
+        self.watermark = timezone.now()
+
+    def _get_bucket_range(self, start_date: datetime, end_date: datetime) -> range:
+        first = max(math.floor((start_date - self.origin) / self.bucket_size), 0)
+        last = min(math.ceil((end_date - self.origin) / self.bucket_size), self.bucket_count)
+        return range(first, last)
+
+    def _add_load(self, engine_id, buckets: range, resources: dict, sign: int):
+        load = self.load_by_engine.get(engine_id)
+        # Engines created after the snapshot are picked up once it is rebuilt
+        if load is None:
+            return
+        for name, amount in resources.items():
+            row = load.setdefault(name, [0] * self.bucket_count)
+            change = sign * int(amount)
+            for bucket in buckets:
+                row[bucket] += change
+
+    def apply(self, row: dict):
+        if self.versions.get(row['id']) == row['last_status_update']:
+            return
+        self.versions[row['id']] = row['last_status_update']
+        if row['last_status_update'] > self.watermark:
+            self.watermark = row['last_status_update']
+
+        placement = self.placements.pop(row['id'], None)
+        if placement is not None:
+            self._add_load(*placement, -1)
+
+        if row['status'] in NOT_HOLDING_CAPACITY_STATUSES or row['workstation__engine_id'] is None:
+            return
+        buckets = self._get_bucket_range(row['start_date'], row['end_date'])
+        if len(buckets) == 0:
+            return
+        placement = (row['workstation__engine_id'], buckets, row['template__resource_requirements'] or {})
+        self.placements[row['id']] = placement
+        self._add_load(*placement, 1)
+
+    # Number of reservations needing required_resources which still fit in each bucket, summed over engines.
+    # Whole rows of buckets are combined at once instead of checking buckets one by one
+    def get_free_slots(self, required_resources: dict, bucket_count: int) -> list[int]:
+        free_slots = [0] * bucket_count
+        for engine_id, max_resources in self.max_resources_by_engine.items():
+            load = self.load_by_engine[engine_id]
+            engine_slots = None
+            for name, amount in required_resources.items():
+                amount = int(amount)
+                if amount <= 0:
+                    continue
+                max_load = int(max_resources.get(name, 0))
+                row = load.get(name)
+                if row is None:
+                    slots = [max(max_load, 0) // amount] * bucket_count
+                else:
+                    slots = [max(max_load - used, 0) // amount for used in row[:bucket_count]]
+                engine_slots = slots if engine_slots is None else list(map(min, engine_slots, slots))
+            if engine_slots is not None:
+                free_slots = list(map(operator.add, free_slots, engine_slots))
+        return free_slots
+
+
+# Per engine load over the next AVAILABILITY_MAX_DAYS in buckets of AVAILABILITY_BUCKET_MINUTES. It is built once
+# and then kept up to date by applying reservations with a newer status update, like DueActionScheduler.sync does.
+# The snapshot is rebuilt when its first bucket ends, when engines change and after AVAILABILITY_TIMELINE_TTL.
+class CapacityTimeline(metaclass=Singleton):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.version = 0
+        self.snapshot = None
+        self.snapshot_version = None
+        self.snapshot_time = None
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    def _get_origin(self, current_time: datetime) -> datetime:
+        bucket_size = timedelta(minutes=settings.AVAILABILITY_BUCKET_MINUTES)
+        epoch = datetime(2000, 1, 1, tzinfo=current_time.tzinfo)
+        return epoch + (current_time - epoch) // bucket_size * bucket_size
+
+    def _is_current(self, origin: datetime) -> bool:
+        return self.snapshot is not None \
+            and self.snapshot_version == self.version \
+            and self.snapshot.origin == origin \
+            and time.monotonic() - self.snapshot_time < settings.AVAILABILITY_TIMELINE_TTL
+
+    def _build(self, origin: datetime) -> CapacityTimelineSnapshot:
+        bucket_size = timedelta(minutes=settings.AVAILABILITY_BUCKET_MINUTES)
+        bucket_count = settings.AVAILABILITY_MAX_DAYS * 24 * 60 // settings.AVAILABILITY_BUCKET_MINUTES
+        snapshot = CapacityTimelineSnapshot(origin, bucket_size, bucket_count, list(Engine.objects.all()))
+        rows = Reservation.objects\
+            .filter(workstation__engine__isnull=False, end_date__gt=origin, start_date__lt=snapshot.horizon)\
+            .exclude(status__in=NOT_HOLDING_CAPACITY_STATUSES)\
+            .order_by()\
+            .values(*TIMELINE_FIELDS)
+        for row in rows:
+            snapshot.apply(row)
+        return snapshot
+
+    def _sync(self, snapshot: CapacityTimelineSnapshot):
+        since = snapshot.watermark - SYNC_OVERLAP
+        snapshot.versions = {key: value for key, value in snapshot.versions.items() if value >= since}
+        rows = Reservation.objects\
+            .filter(last_status_update__gte=since)\
+            .order_by()\
+            .values(*TIMELINE_FIELDS)
+        for row in rows:
+            snapshot.apply(row)
+
+    def get_snapshot(self) -> CapacityTimelineSnapshot:
+        origin = self._get_origin(timezone.now())
+        with self.lock:
+            if self._is_current(origin):
+                self._sync(self.snapshot)
+                return self.snapshot
+            version = self.version
+            start = time.perf_counter()
+            self.snapshot = self._build(origin)
+            self.snapshot_version = version
+            self.snapshot_time = time.monotonic()
+            logger.info(f'Built capacity timeline with {len(self.snapshot.placements)} reservations in {(time.perf_counter() - start) * 1000:.1f}ms')
+            return self.snapshot
+
+    # Admission sums all reservations overlapping the requested time, so a time in which every bucket has
+    # a free slot can still be rejected if the reservations in it do not all overlap each other
+    def get_free_slots(self, required_resources: dict, days: int) -> dict:
+        days = max(1, min(days, settings.AVAILABILITY_MAX_DAYS))
+        snapshot = self.get_snapshot()
+        bucket_count = days * 24 * 60 // settings.AVAILABILITY_BUCKET_MINUTES
+        with self.lock:
+            free_slots = snapshot.get_free_slots(required_resources, bucket_count)
+        return {
+            'start': snapshot.origin.isoformat(),
+            'bucket_minutes': settings.AVAILABILITY_BUCKET_MINUTES,
+            'free': free_slots,
+        }
@@ -0,0 +1,210 @@
+import hashlib
+import logging
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import Reservation, CoordinatorCommand, Host, Workstation
+from .template_handler import TemplateHandler
+from .mapping_handler import MappingHandler
+from .engine_handler import EngineHandler
+from .admission import ReservationAdmission
+from .capacity_timeline import CapacityTimeline
+
+logger = logging.getLogger('workstation_coordinator')
+
+# Columns rendered by the reservations table
+RESERVATION_TABLE_FIELDS = ['id', 'user_label', 'status', 'request_date', 'start_date', 'end_date']
+
+# Used by web workers instead of WorkstationCoordinator. It only reads and writes the database, operations
+# which change a reservation's lifecycle are sent to the coordinator process as CoordinatorCommand rows.
+class CoordinatorClient:
+    def __init__(self) -> None:
+        self.template_handler = TemplateHandler()
+        self.mapping_handler = MappingHandler()
+        self.engine_handler = EngineHandler()
+        self.admission = ReservationAdmission()
+
+    def _send_command(self, reservation: Reservation, command_type: CoordinatorCommand.Type) -> CoordinatorCommand:
+        command = CoordinatorCommand.objects.create(type=command_type, reservation=reservation)
+        logger.info(f'Sent command {command}')
+        return command
+
+    def create_reservation(self, user, tags, start_date, end_date, user_label) -> Reservation:
+        logger.info(f'Creating reservation for user {user} with tags {tags} from {start_date} to {end_date}')
+        logger.info(f'Finding template with tags: {tags}')
+        template = self.template_handler.find_template_with_tags(tags)
+        if template is None:
+            logger.info(f'No template found for tags {tags}')
+            return None
+        logger.info(f'Found template: {template} for reservation')
+        logger.info(f'User label: {user_label}')
+        if user_label == "" or user_label is None or len(user_label) == 0:
+            logger.info(f'No user label provided, using default')
+            user_label = f'{template.name}'
+        else:
+            logger.info(f'Using user label: {user_label}')
+        # Pending reservations are picked up by the coordinator on its next tick
+        with transaction.atomic():
+            reservation = Reservation.objects.create(
+                status=Reservation.Status.Pending,
+                request_date=timezone.now(),
+                start_date=start_date,
+                end_date=end_date,
+                user=user,
+                template=template,
+                user_label=user_label
+            )
+            logger.info(f'Reservation created: {reservation}')
+            if settings.SYNCHRONOUS_ADMISSION:
+                self._admit_reservation(reservation)
+        cache.delete(self._get_reservation_count_key(user))
+        return reservation
+
+    def _get_seat_label(self, user_label: str, seat: int) -> str:
+        suffix = f' #{seat + 1}'
+        return user_label[:Reservation._meta.get_field('user_label').max_length - len(suffix)] + suffix
+
+    # Books one reservation per user in a single admission, either all of them are approved or none is created.
+    # Users may repeat, for example one user booking seats of a lab. Approved reservations come due together
+    # and are set up by coordinators in parallel. Returns None if no template matches the tags
+    def create_reservations(self, users: list, tags, start_date, end_date, user_label) -> dict:
+        logger.info(f'Creating {len(users)} reservations with tags {tags} from {start_date} to {end_date}')
+        template = self.template_handler.find_template_with_tags(tags)
+        if template is None:
+            logger.info(f'No template found for tags {tags}')
+            return None
+        if user_label == "" or user_label is None:
+            user_label = template.name[:Reservation._meta.get_field('user_label').max_length]
+        request_date = timezone.now()
+        # Not saved, it only describes the template and time all reservations share for the admission
+        prototype = Reservation(start_date=start_date, end_date=end_date, template=template)
+
+        with transaction.atomic():
+            engines = self.engine_handler._get_all_for_update()
+            selected_engines = self.admission.select_engines(prototype, len(users), engines, self.engine_handler)
+            if selected_engines is None:
+                return {'template': template, 'reservations': []}
+
+            hosts_by_engine_id = {}
+            for host in Host.objects.filter(engines__in={engine.id for engine in selected_engines}).prefetch_related('engines'):
+                for engine in host.engines.all():
+                    hosts_by_engine_id.setdefault(engine.id, host)
+            workstations = Workstation.objects.bulk_create([
+                Workstation(template=template, host=hosts_by_engine_id.get(engine.id), engine=engine,
+                            status=Workstation.Status.Scheduled)
+                for engine in selected_engines
+            ])
+            reservations = Reservation.objects.bulk_create([
+                Reservation(
+                    status=Reservation.Status.Approved,
+                    request_date=request_date,
+                    start_date=start_date,
+                    end_date=end_date,
+                    user=user,
+                    template=template,
+                    workstation=workstation,
+                    user_label=user_label if len(users) == 1 else self._get_seat_label(user_label, seat)
+                )
+                for seat, (user, workstation) in enumerate(zip(users, workstations))
+            ])
+        logger.info(f'Created {len(reservations)} approved reservations')
+        cache.delete_many([self._get_reservation_count_key(user) for user in set(users)])
+        return {'template': template, 'reservations': reservations}
+
+    # Same admission as the coordinator tick, with the same engine row locks. The reservation is inserted in the same
+    # transaction, so coordinators only see it once it is already approved or rejected. Approved reservations are
+    # scheduled by coordinators on their next schedule sync
+    def _admit_reservation(self, reservation: Reservation):
+        engines = self.engine_handler._get_all_for_update()
+        engine = self.admission.select_engine(reservation, engines, self.engine_handler)
+        if engine is None:
+            reservation.set_reservation_status(Reservation.Status.Rejected)
+            logger.info(f'Reservation {reservation} rejected')
+            return
+        self.admission.approve(reservation, engine)
+
+    def cancel_reservation(self, reservation: Reservation) -> bool:
+        if reservation.status in [Reservation.Status.Completed, Reservation.Status.Cancelled, Reservation.Status.Rejected]:
+            return False
+        self._send_command(reservation, CoordinatorCommand.Type.Cancel)
+        return True
+
+    def restart_workstation_for_reservation(self, reservation: Reservation) -> bool:
+        if reservation.workstation is None:
+            return False
+        self._send_command(reservation, CoordinatorCommand.Type.Restart)
+        return True
+
+    def get_progress_for_reservation(self, reservation: Reservation) -> int:
+        if reservation.status in [Reservation.Status.Completed, Reservation.Status.Cancelled, Reservation.Status.Rejected]:
+            return 100
+
+        time_between = reservation.end_date - reservation.start_date
+        time_left = reservation.end_date - timezone.now()
+        progress = int((time_between - time_left) / time_between * 100)
+
+        return progress
+
+    # Changes whenever anything shown on the reservation page changes, pages polling with it skip unchanged states
+    def get_state_version_for_reservation(self, reservation: Reservation, progress: int) -> str:
+        state = [reservation.status, reservation.last_status_update.isoformat(), progress]
+        if reservation.workstation is not None:
+            state += [reservation.workstation.status, reservation.workstation.last_status_update.isoformat()]
+        return hashlib.sha1(repr(state).encode()).hexdigest()[:16]
+
+    # Free capacity for reservations of the template matching the tags, None if no template matches them
+    def get_availability_for_tags(self, tags: list, days: int) -> dict:
+        template = self.template_handler.find_template_with_tags(tags)
+        if template is None:
+            return None
+        availability = CapacityTimeline().get_free_slots(template.resource_requirements, days)
+        availability['template'] = template.name
+        return availability
+
+    def _get_reservation_count_key(self, user) -> str:
+        return f'reservation_count:{user.id}'
+
+    # Reservations are only added by create_reservation, which drops the cached count. Processes which did not
+    # create the reservation see the new count after RESERVATION_COUNT_CACHE_TTL
+    def get_reservation_count_for_user(self, user) -> int:
+        return cache.get_or_set(self._get_reservation_count_key(user),
+                                lambda: Reservation.objects.filter(user=user).count(),
+                                settings.RESERVATION_COUNT_CACHE_TTL)
+
+    def get_reservation_cursor(self, reservation: Reservation) -> str:
+        return f'{reservation.request_date.isoformat()}|{reservation.id}'
+
+    def _parse_reservation_cursor(self, cursor: str) -> tuple:
+        request_date, reservation_id = cursor.split('|')
+        return datetime.fromisoformat(request_date), uuid.UUID(reservation_id)
+
+    # Keyset pagination in Reservation.Meta.ordering with id breaking ties, pages after or before the row of a cursor
+    # are read from the user and request date index without skipping over earlier rows like OFFSET does
+    def get_reservations_page_for_user(self, user, page_size: int, after: str = None, before: str = None) -> dict:
+        reservations = Reservation.objects.filter(user=user).only(*RESERVATION_TABLE_FIELDS)
+        if before is not None:
+            request_date, reservation_id = self._parse_reservation_cursor(before)
+            rows = list(reservations
+                        .filter(request_date__gte=request_date)
+                        .exclude(request_date=request_date, id__lte=reservation_id)
+                        .order_by('request_date', 'id')[:page_size + 1])
+            return {
+                'reservations': rows[:page_size][::-1],
+                'has_previous': len(rows) > page_size,
+                'has_next': True,
+            }
+
+        if after is not None:
+            request_date, reservation_id = self._parse_reservation_cursor(after)
+            reservations = reservations\
+                .filter(request_date__lte=request_date)\
+                .exclude(request_date=request_date, id__gte=reservation_id)
+        rows = list(reservations.order_by('-request_date', '-id')[:page_size + 1])
+        return {
+            'reservations': rows[:page_size],
+            'has_previous': after is not None,
+            'has_next': len(rows) > page_size,
+        }
@@ -1,6 +1,7 @@
 import logging
-from threading import Thread
+from django.conf import settings
 from utils.singleton import Singleton
+from utils.database import get_pool_stats
 import time
 
 from .reservation_handler import RevervationHandler
@@ -9,23 +10,15 @@ from .engine_handler import EngineHandler
 
 logger = logging.getLogger('workstation_coordinator')
 
+# Runs only in the run_coordinator management command, web workers talk to it through CoordinatorClient
 class WorkstationCoordinator(metaclass=Singleton):
     def __init__(self):
-        self.thread = None 
+        self.last_orphan_sweep = None
 
         self.reservation_handler = RevervationHandler()
         self.template_handler = TemplateHandler()
         self.engine_handler = EngineHandler()
 
-    def is_active(self) -> bool:
-        if self.thread is None:
-            return False
-        
-        if not self.thread.is_alive():
-            return False
-        
-        return True
-    
     def _list_info(self):
         engines = self.engine_handler.get_all_types()
         logger.info(f'Listing all engine types')
@@ -43,20 +36,42 @@ class WorkstationCoordinator(metaclass=Singleton):
     def _main_loop(self):
         self.engine_handler._initialize_clients()
         self._list_info()
+        self.reservation_handler.rebalance_shards(self.engine_handler)
+        self.reservation_handler.rebuild_schedule()
         time.sleep(5)
         while True:
+            self.reservation_handler.rebalance_shards(self.engine_handler)
             self.reservation_handler.handle(self.engine_handler)
             self.engine_handler._gc_setup_threads()
             self.engine_handler._list_setup_threads()
             self.engine_handler._gc_cleanup_threads()
             self.engine_handler._list_cleanup_threads()
-            self.engine_handler._clean_orphaned_workstations()
-            time.sleep(5)
+            self._list_connection_pool_stats()
+            self._sweep_orphaned_workstations_if_due()
+            self._wait_for_next_tick()
 
-    def start(self):
-        if self.is_active():
-            logger.info('Coordinator is already active, skipping startup')
+    def _list_connection_pool_stats(self):
+        stats = get_pool_stats()
+        if len(stats) == 0:
             return
-        t = Thread(target=self._main_loop, args=(), daemon=True)
-        self.thread = t
-        self.thread.start() 
+        logger.info(f'Connection pool: {stats.get("pool_size", 0)}/{stats.get("pool_max", 0)} connections, '
+                    f'{stats.get("pool_available", 0)} available, {stats.get("requests_waiting", 0)} waiting, '
+                    f'{stats.get("requests_num", 0)} requests, {stats.get("requests_wait_ms", 0)}ms total wait, '
+                    f'{stats.get("requests_errors", 0)} timed out')
+
+    def _sweep_orphaned_workstations_if_due(self):
+        # With multiple coordinators only the leader sweeps
+        if not self.reservation_handler.shard_manager.is_leader:
+            return
+        current_time = time.monotonic()
+        if self.last_orphan_sweep is not None and current_time - self.last_orphan_sweep < settings.ORPHAN_SWEEP_INTERVAL:
+            return
+        self.last_orphan_sweep = current_time
+        self.engine_handler.start_orphan_sweep()
+
+    # Sleeps until the next scheduled start or end date, but no longer than the tick interval
+    def _wait_for_next_tick(self):
+        scheduler = self.reservation_handler.scheduler
+        timeout = scheduler.get_seconds_until_next_due(settings.COORDINATOR_TICK_INTERVAL)
+        logger.info(f'Next tick in {timeout:.2f}s')
+        scheduler.wait(timeout)
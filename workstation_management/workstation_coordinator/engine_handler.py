@@ -1,19 +1,57 @@
 import logging
-from threading import Thread
-from django.db.models import QuerySet, Q
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, BoundedSemaphore
+from django.conf import settings
+from django.db.models import QuerySet, Q, Sum
 from .models import EngineType, Engine, Template, Reservation, Host, Workstation
 from engines.generic_client import GenericClient
 import time
 from typing import Callable
 from utils.threading import ThreadWithCallback
+from utils.database import release_connections
 
 logger = logging.getLogger('workstation_coordinator')
 
+# Weight of the newest measurement in engine average setup time
+SETUP_TIME_SMOOTHING = 0.3
+
+# Polling of VM state during teardown starts fast and backs off exponentially
+POLL_INITIAL_INTERVAL = 0.25
+POLL_BACKOFF_FACTOR = 1.5
+POLL_MAX_INTERVAL = 5
+
+class TeardownProgress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.stopped = 0
+        self.deleted = 0
+        self.failed = 0
+        self.start_time = time.monotonic()
+        self.lock = Lock()
+
+    def mark_stopped(self):
+        with self.lock:
+            self.stopped += 1
+
+    def mark_deleted(self):
+        with self.lock:
+            self.deleted += 1
+
+    def mark_failed(self):
+        with self.lock:
+            self.failed += 1
+
+    def __str__(self) -> str:
+        return f'({self.deleted}/{self.total} deleted, {self.stopped} stopped, {self.failed} failed, {time.monotonic() - self.start_time:.1f}s elapsed)'
+
 class EngineHandler:
     def __init__(self) -> None:
         self.clients = {}
         self.setup_threads = {}
         self.cleanup_threads = {}
+        self.orphan_sweep_thread = None
+        self.teardown_semaphores = {}
+        self.teardown_semaphores_lock = Lock()
 
     def _initialize_clients(self):
         for host in Host.objects.all():
@@ -36,31 +74,50 @@ class EngineHandler:
     
     def _get_all(self) -> list:
         return list(Engine.objects.all())
+
+    # Has to be called inside a transaction, rows stay locked until it is committed
+    def _get_all_for_update(self) -> list:
+        return list(Engine.objects.select_for_update().order_by('id'))
     
-    def _get_max_load_at_time(self, engine: Engine, reservations: QuerySet) -> dict:
+    def _get_reservations_with_engine(self, reservations: QuerySet) -> QuerySet:
         # If reservations has an engine assigned it is already approved or active
-        reservations_with_engine = reservations\
-            .filter(workstation__engine=engine)\
+        return reservations\
+            .filter(workstation__engine__isnull=False)\
             .exclude(Q(status=Reservation.Status.Pending) | 
                      Q(status=Reservation.Status.Rejected) | 
                      Q(status=Reservation.Status.Completed) | 
                      Q(status=Reservation.Status.Cancelled))
-        
-        logger.info(f'Reservations with engine {engine}: {list(reservations_with_engine)}')
-        sum_vm_load = {}
-        logger.info(f'Reservations with engine {engine}: {list(reservations_with_engine)}')
-        for reservation in reservations_with_engine:
-            reservation: Reservation
-            template: Template = reservation.template
-            for key, value in template.resource_requirements.items():
-                if key not in sum_vm_load:
-                    sum_vm_load[key] = 0
-                sum_vm_load[key] += int(value)
+
+    # Sums resource requirements of reservations per engine with a single aggregate query
+    def _get_load_by_engine(self, reservations: QuerySet) -> dict:
+        rows = self._get_reservations_with_engine(reservations)\
+            .filter(template__resources__isnull=False)\
+            .order_by()\
+            .values('workstation__engine_id', 'template__resources__name')\
+            .annotate(amount=Sum('template__resources__amount'))
+        load_by_engine = {}
+        for row in rows:
+            load = load_by_engine.setdefault(row['workstation__engine_id'], {})
+            load[row['template__resources__name']] = row['amount']
+        logger.info(f'VM load by engine: {load_by_engine}')
+        return load_by_engine
+
+    def _get_max_load_at_time(self, engine: Engine, reservations: QuerySet) -> dict:
+        sum_vm_load = self._get_load_by_engine(reservations.filter(workstation__engine=engine)).get(engine.id, {})
         logger.info(f'Sum of VM load for engine {engine}: {sum_vm_load}')
         return sum_vm_load
     
     def _get_max_possible_load(self, engine: Engine) -> dict:
         return engine.max_resources
+
+    def _record_setup_time(self, engine_id, setup_time: float):
+        engine = Engine.objects.get(id=engine_id)
+        if engine.average_setup_time is None:
+            average_setup_time = setup_time
+        else:
+            average_setup_time = SETUP_TIME_SMOOTHING * setup_time + (1 - SETUP_TIME_SMOOTHING) * engine.average_setup_time
+        Engine.objects.filter(id=engine_id).update(average_setup_time=average_setup_time)
+        logger.info(f'Setup took {setup_time:.1f}s on engine {engine}, average setup time is now {average_setup_time:.1f}s')
             
     def _get_supported_engine_types(self, template: Template) -> list:
         engs = Engine.objects.filter(type__in=template.allowed_engine_types.all())
@@ -84,6 +141,10 @@ class EngineHandler:
             self.cleanup_threads.pop(key)
             logger.info(f'Removed cleanup thread for reservation {key}')
     
+    def _is_cleanup_thread_running(self, reservation: Reservation) -> bool:
+        t = self.cleanup_threads.get(reservation.id)
+        return t is not None and t.is_alive()
+    
     def start_workstation_cleanup_for_reservation(self, reservation: Reservation, callback: Callable = None):
         t = ThreadWithCallback(target=self._cleanup_workstation, args=(reservation,), daemon=True, callback=callback)
         self.cleanup_threads[reservation.id] = t
@@ -120,36 +181,83 @@ class EngineHandler:
         vm_name = f'{username}{internal_name}{date_as_numbers}'
         return vm_name
     
-    def _delete_vm(self, vm_name: str, client: GenericClient):
+    def _wait_until(self, predicate: Callable, description: str):
+        interval = POLL_INITIAL_INTERVAL
+        while not predicate():
+            logger.info(f'Waiting for {description}')
+            time.sleep(interval)
+            interval = min(interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+
+    def _get_teardown_semaphore(self, engine_id) -> BoundedSemaphore:
+        with self.teardown_semaphores_lock:
+            if engine_id not in self.teardown_semaphores:
+                self.teardown_semaphores[engine_id] = BoundedSemaphore(settings.VM_TEARDOWN_CONCURRENCY)
+            return self.teardown_semaphores[engine_id]
+    
+    def _delete_vm(self, vm_name: str, client: GenericClient, progress: TeardownProgress = None):
         if vm_name is None or vm_name == '' or not client.vm_exists(vm_name):
             logger.info(f'VM {vm_name} does not exist, skipping deletion')
+            if progress is not None:
+                progress.mark_deleted()
             return
 
         client.stop_vm(vm_name)
-        while client.is_vm_running(vm_name):
-            logger.info(f'Waiting for VM {vm_name} to stop')
-            time.sleep(5)
-        try:
-            client.delete_vm(vm_name)
-        except Exception as e:
-            logger.error(f'Error while deleting VM {vm_name}: {e}')
-            return
-        while client.vm_exists(vm_name):
-            logger.info(f'Waiting for VM {vm_name} to be deleted')
-            time.sleep(5) 
+        self._wait_until(lambda: not client.is_vm_running(vm_name), f'VM {vm_name} to stop')
+        if progress is not None:
+            progress.mark_stopped()
+        client.delete_vm(vm_name)
+        self._wait_until(lambda: not client.vm_exists(vm_name), f'VM {vm_name} to be deleted')
+        if progress is not None:
+            progress.mark_deleted()
         logger.info(f'VM {vm_name} deleted successfully')
+
+    # Errors are raised after they are counted, so that cleanup callbacks do not archive workstations whose VM may still exist
+    def _delete_vm_on_engine(self, engine_id, vm_name: str, progress: TeardownProgress = None):
+        client: GenericClient = self.clients.get(engine_id) or self._spawn_client_for_engine_id(engine_id)
+        # Teardown only talks to the engine from here on, connection is not held while waiting for VMs
+        release_connections()
+        with self._get_teardown_semaphore(engine_id):
+            try:
+                self._delete_vm(vm_name, client, progress)
+            except Exception as e:
+                logger.error(f'Error while tearing down VM {vm_name}: {e}')
+                if progress is not None:
+                    progress.mark_failed()
+                raise
+        if progress is not None:
+            logger.info(f'Teardown progress: {progress}')
+
+    # Deletes many VMs at once, at most VM_TEARDOWN_CONCURRENCY at a time on each engine
+    def teardown_vms(self, vm_names_by_engine: dict) -> TeardownProgress:
+        total = sum([len(vm_names) for vm_names in vm_names_by_engine.values()])
+        progress = TeardownProgress(total)
+        if total == 0:
+            return progress
+
+        max_workers = sum([min(len(vm_names), settings.VM_TEARDOWN_CONCURRENCY) for vm_names in vm_names_by_engine.values()])
+        logger.info(f'Tearing down {total} VMs on {len(vm_names_by_engine)} engines')
+        # Failed deletions are counted in progress, errors raised by the workers are not needed here
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='teardown') as executor:
+            for engine_id, vm_names in vm_names_by_engine.items():
+                for vm_name in vm_names:
+                    executor.submit(self._delete_vm_on_engine, engine_id, vm_name, progress)
+        logger.info(f'Finished teardown: {progress}')
+        return progress
     
     def setup_workstation_for_reservation(self, reservation: Reservation, callback: Callable = None):
         vm_name = self._generate_name_for_vm(reservation)
         reservation.workstation.engine_internal_name = vm_name
-        reservation.workstation.save()
+        reservation.workstation.save(update_fields=['engine_internal_name'])
         t = ThreadWithCallback(target=self._setup_workstation, args=(reservation, vm_name), daemon=True, callback=callback)
         self.setup_threads[reservation.id] = (t, vm_name)
         t.start()
         logger.info(f'Started setup thread for reservation {reservation}')
     
     def _setup_workstation(self, reservation: Reservation, vm_name: str): 
+        setup_start = time.monotonic()
         client: GenericClient = self._spawn_client_for_engine_id(reservation.workstation.engine.id) 
+        # Setup takes minutes, connection is taken from the pool again when the result is saved
+        release_connections()
 
         # Check if VM with same name exists, and delete it if so
         if client.vm_exists(vm_name):
@@ -183,60 +291,86 @@ class EngineHandler:
         reservation.workstation.ip_address = ip_address
         logger.info(f'Workstation ip address: {reservation.workstation.ip_address}')
         reservation.workstation.engine_internal_name = vm_name
-        reservation.workstation.save()
+        # Only network fields are written, status may have been changed by the coordinator in the meantime
+        reservation.workstation.save(update_fields=['ip_address', 'engine_internal_name'])
+        self._record_setup_time(reservation.workstation.engine.id, time.monotonic() - setup_start)
         logger.info(f'Finished workstation setup for reservation {reservation}, set status to Active') 
 
     def _cleanup_workstation(self, reservation: Reservation):
-        self._delete_vm(reservation.workstation.engine_internal_name, 
-                        self.clients[reservation.workstation.engine.id]) 
+        # Wait for setup or restart to finish first, otherwise it could keep working on the deleted VM
+        setup = self.setup_threads.get(reservation.id)
+        if setup is not None:
+            t, _ = setup
+            logger.info(f'Waiting for setup thread of reservation {reservation} to finish before cleanup')
+            t.join()
+        self._delete_vm_on_engine(reservation.workstation.engine.id, reservation.workstation.engine_internal_name)
+
+    def _get_orphaned_vm_names(self, vm_names: list[str], setup_vm_names: set) -> list[str]:
+        # VM is expected to exist only if its workstation and reservation are both in a live status
+        expected_vm_names = set(Reservation.objects
+            .filter(workstation__engine_internal_name__in=vm_names,
+                    status__in=[Reservation.Status.Approved, 
+                                Reservation.Status.Active],
+                    workstation__status__in=[Workstation.Status.Active, 
+                                             Workstation.Status.Setup, 
+                                             Workstation.Status.Cleanup,
+                                             Workstation.Status.Restart])
+            .values_list('workstation__engine_internal_name', flat=True))
+
+        return [name for name in vm_names if name not in expected_vm_names and name not in setup_vm_names]
+
+    def _find_orphaned_workstations_on_engine(self, engine: Engine, setup_vm_names: set) -> list[str]:
+        client: GenericClient = self._spawn_client_for_engine_id(engine.id)
+        release_connections()
+        try:
+            all_vm_names = client.get_all_vm_names()
+        except Exception as e:
+            logger.error(f'Error while getting VM names from engine {engine}: {e}') 
+            return []
+
+        try:
+            orphaned_vm_names = self._get_orphaned_vm_names(all_vm_names, setup_vm_names)
+        finally:
+            release_connections()
+        logger.info(f'Engine {engine} has {len(all_vm_names)} VMs, {len(orphaned_vm_names)} of them orphaned: {orphaned_vm_names}')
+        return orphaned_vm_names
 
-    def _clean_orphaned_workstations(self):
+    def _clean_orphaned_workstations(self, setup_vm_names: set):
         logger.info('Cleaning orphaned workstations')
+        engines = list(Engine.objects.all())
+        release_connections()
+        if len(engines) == 0:
+            return
+        orphaned_vm_names_by_engine = {}
+        with ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix='orphan_sweep') as executor:
+            futures = {engine.id: executor.submit(self._find_orphaned_workstations_on_engine, engine, setup_vm_names) for engine in engines}
+            for engine_id, future in futures.items():
+                try:
+                    orphaned_vm_names_by_engine[engine_id] = future.result()
+                except Exception as e:
+                    logger.error(f'Error while searching for orphaned workstations: {e}')
+        self.teardown_vms(orphaned_vm_names_by_engine)
+        logger.info('Finished cleaning orphaned workstations')
+
+    def _is_orphan_sweep_running(self) -> bool:
+        return self.orphan_sweep_thread is not None and self.orphan_sweep_thread.is_alive()
+
+    def start_orphan_sweep(self):
+        if self._is_orphan_sweep_running():
+            logger.info('Orphan sweep is still running, skipping')
+            return
+        # Names are collected here, setup_threads is only modified by the main loop
+        setup_vm_names = {name for _, name in self.setup_threads.values()}
+        t = Thread(target=self._clean_orphaned_workstations, args=(setup_vm_names,), daemon=True)
+        self.orphan_sweep_thread = t
+        t.start()
+        logger.info('Started orphan sweep thread')
 
-        for engine in Engine.objects.all():
-            client: GenericClient = self._spawn_client_for_engine_id(engine.id)
-            try:
-                all_vm_names = client.get_all_vm_names()
-            except Exception as e:
-                logger.error(f'Error while getting VM names from engine {engine}: {e}') 
-                continue
-            for name in all_vm_names:
-                logger.info(f'Checking VM {name} for orphaned status')
-                if name in [name for _, name in self.setup_threads.values()]:
-                    logger.info(f'Found VM {name} in setup threads, skipping')
-                    continue
-                
-                workstation_query = Workstation.objects.filter(engine_internal_name=name)
-                reservation_query = Reservation.objects.filter(workstation__engine_internal_name=name)
-
-                if not reservation_query.exists() or not workstation_query.exists():
-                    logger.info(f'Found orphaned VM {name}, deleting it')
-                    self._delete_vm(name, client)
-                    continue
-
-                reservation_handle = reservation_query.first()
-                workstation_handle = workstation_query.first()
-
-
-                reservation_status_as_expected = reservation_handle.status in [Reservation.Status.Approved, 
-                                                                               Reservation.Status.Active]
-
-                workstation_status_as_expected = workstation_handle.status in [Workstation.Status.Active, 
-                                                                               Workstation.Status.Setup, 
-                                                                               Workstation.Status.Cleanup,
-                                                                               Workstation.Status.Restart]
-                
-
-                if not workstation_status_as_expected or not reservation_status_as_expected:
-                    logger.info(f'Found orphaned VM {name}, deleting it')
-                    self._delete_vm(name, client)    
-                    continue
-
-                logger.info(f'Workstation has DB record and approved status, skipping')
     def _restart_workstation(self, reservation: Reservation):
         logger.info("Restart thread running")
         client: GenericClient = self.clients[reservation.workstation.engine.id]
         vm_name = reservation.workstation.engine_internal_name
+        release_connections()
         client.reboot_vm(vm_name)
         while not client.is_agent_running(vm_name):
             logger.info(f'Waiting for VM {vm_name} to start')
@@ -0,0 +1,119 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from main_server.models import User
+from workstation_coordinator.engine_handler import EngineHandler
+from workstation_coordinator.models import EngineType, Engine, Host, Template, Workstation, Reservation
+
+
+class Command(BaseCommand):
+    help = 'Compare summing engine load in Python with the SQL aggregate on a synthetic reservation set, all rows are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engines', type=int, default=10)
+        parser.add_argument('--templates', type=int, default=5)
+        parser.add_argument('--reservations', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _create_dataset(self, rng: random.Random, options: dict):
+        user = User.objects.create(username='benchmark_load_aggregation', email='benchmark@localhost')
+        engine_type = EngineType.objects.create(name='benchmark_load_aggregation')
+        engines = []
+        for i in range(options['engines']):
+            engine = Engine.objects.create(name=f'benchmark-engine-{i}', port=8000 + i, type=engine_type,
+                                           available_resources={}, max_resources={'cpu': 1024, 'memory': 2097152})
+            engines.append(engine)
+        host = Host.objects.create(name='benchmark-host', ip_address='127.0.0.1')
+        host.engines.set(engines)
+
+        templates = []
+        for i in range(options['templates']):
+            templates.append(Template.objects.create(
+                name=f'benchmark-template-{i}',
+                internal_name=f'benchmark-template-{i}',
+                description='',
+                resource_requirements={'cpu': rng.choice([1, 2, 4, 8]), 'memory': rng.choice([2048, 4096, 8192]), 'disk': 32},
+            ))
+
+        now = timezone.now()
+        statuses = [Reservation.Status.Approved, Reservation.Status.Active, Reservation.Status.Completed, Reservation.Status.Cancelled]
+        workstations = Workstation.objects.bulk_create([
+            Workstation(template=rng.choice(templates), host=host, engine=rng.choice(engines), status=Workstation.Status.Scheduled)
+            for _ in range(options['reservations'])
+        ])
+        reservations = []
+        for workstation in workstations:
+            start_date = now + timedelta(minutes=rng.randrange(0, 7 * 24 * 60))
+            reservations.append(Reservation(
+                status=rng.choice(statuses),
+                request_date=now,
+                start_date=start_date,
+                end_date=start_date + timedelta(minutes=rng.choice([60, 120, 240])),
+                user=user,
+                template=workstation.template,
+                workstation=workstation,
+            ))
+        Reservation.objects.bulk_create(reservations)
+        return engines
+
+    # Implementation used before resource requirements were normalized, kept here as the baseline
+    def _get_load_in_python(self, engines: list, reservations) -> dict:
+        load_by_engine = {}
+        for engine in engines:
+            reservations_with_engine = reservations\
+                .filter(workstation__engine=engine)\
+                .exclude(Q(status=Reservation.Status.Pending) |
+                         Q(status=Reservation.Status.Rejected) |
+                         Q(status=Reservation.Status.Completed) |
+                         Q(status=Reservation.Status.Cancelled))
+            sum_vm_load = {}
+            for reservation in reservations_with_engine:
+                for key, value in reservation.template.resource_requirements.items():
+                    if key not in sum_vm_load:
+                        sum_vm_load[key] = 0
+                    sum_vm_load[key] += int(value)
+            if len(sum_vm_load) > 0:
+                load_by_engine[engine.id] = sum_vm_load
+        return load_by_engine
+
+    def _measure(self, method, repeat: int) -> tuple:
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                result = method()
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best, len(queries)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        engine_handler = EngineHandler()
+
+        with transaction.atomic():
+            engines = self._create_dataset(rng, options)
+            reservations = Reservation.objects.filter(workstation__engine__in=engines)
+
+            python_load, python_time, python_queries = self._measure(
+                lambda: self._get_load_in_python(engines, reservations), options['repeat'])
+            sql_load, sql_time, sql_queries = self._measure(
+                lambda: engine_handler._get_load_by_engine(reservations), options['repeat'])
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{len(engines)} engines, {options["templates"]} templates, {options["reservations"]} reservations')
+        self.stdout.write(f'{"Method":<16}{"Best time s":>14}{"Queries":>10}')
+        self.stdout.write(f'{"Python loop":<16}{python_time:>14.4f}{python_queries:>10}')
+        self.stdout.write(f'{"SQL aggregate":<16}{sql_time:>14.4f}{sql_queries:>10}')
+        if python_load != sql_load:
+            self.stderr.write('Results differ between Python loop and SQL aggregate')
+        else:
+            self.stdout.write(f'Results match, SQL aggregate is {python_time / sql_time:.1f}x faster')
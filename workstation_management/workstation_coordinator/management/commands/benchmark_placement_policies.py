@@ -0,0 +1,112 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from workstation_coordinator.engine_handler import SETUP_TIME_SMOOTHING
+from workstation_coordinator.reservation_policies import EngineCandidate, POLICIES
+
+
+class SyntheticEngine:
+    def __init__(self, name: str, max_resources: dict, setup_time: float) -> None:
+        self.name = name
+        self.max_resources = max_resources
+        self.setup_time = setup_time
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class Command(BaseCommand):
+    help = 'Compare placement policies on a synthetic reservation workload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--engines', type=int, default=20)
+        parser.add_argument('--reservations', type=int, default=5000)
+        parser.add_argument('--days', type=int, default=14)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _generate_engines(self, rng: random.Random, count: int) -> list[SyntheticEngine]:
+        engines = []
+        for i in range(count):
+            size = rng.choice([1, 2, 4])
+            max_resources = {'cpu': 16 * size, 'memory': 32768 * size}
+            setup_time = rng.uniform(60, 300)
+            engines.append(SyntheticEngine(f'engine-{i}', max_resources, setup_time))
+        return engines
+
+    def _generate_reservations(self, rng: random.Random, count: int, days: int) -> list[tuple]:
+        template_loads = [
+            {'cpu': 2, 'memory': 4096},
+            {'cpu': 4, 'memory': 8192},
+            {'cpu': 8, 'memory': 16384},
+        ]
+        horizon = days * 24 * 60
+        reservations = []
+        for _ in range(count):
+            start = rng.randrange(0, horizon)
+            end = start + rng.choice([60, 90, 120, 180, 240, 480])
+            reservations.append((start, end, rng.choice(template_loads)))
+        return reservations
+
+    def _simulate(self, policy_name: str, engines: list[SyntheticEngine], reservations: list[tuple]) -> dict:
+        policy = POLICIES[policy_name]()
+        placed = {engine.name: [] for engine in engines}
+        measured_setup_time = {}
+        rejected = 0
+        setup_times = []
+        idle_engine_samples = []
+        decision_time = 0.0
+
+        for start, end, template_load in reservations:
+            decision_start = time.perf_counter()
+            candidates = []
+            for engine in engines:
+                # Same semantics as EngineHandler._get_max_load_at_time, overlapping reservations are summed
+                load = {}
+                for other_start, other_end, other_load in placed[engine.name]:
+                    if other_start <= end and other_end >= start:
+                        for key, value in other_load.items():
+                            load[key] = load.get(key, 0) + value
+                candidates.append(EngineCandidate(engine, load, engine.max_resources, template_load, measured_setup_time.get(engine.name)))
+            selected = policy.select_engine(candidates)
+            decision_time += time.perf_counter() - decision_start
+
+            idle_engine_samples.append(sum([1 for candidate in candidates if len(candidate.current_load) == 0]))
+            if selected is None:
+                rejected += 1
+                continue
+
+            engine = selected.engine
+            placed[engine.name].append((start, end, template_load))
+            setup_times.append(engine.setup_time)
+            previous = measured_setup_time.get(engine.name)
+            if previous is None:
+                measured_setup_time[engine.name] = engine.setup_time
+            else:
+                measured_setup_time[engine.name] = SETUP_TIME_SMOOTHING * engine.setup_time + (1 - SETUP_TIME_SMOOTHING) * previous
+
+        return {
+            'throughput': len(reservations) / decision_time if decision_time > 0 else 0.0,
+            'rejection_rate': rejected / len(reservations) * 100,
+            'average_setup_time': sum(setup_times) / len(setup_times) if len(setup_times) > 0 else 0.0,
+            'average_idle_engines': sum(idle_engine_samples) / len(idle_engine_samples),
+        }
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        engines = self._generate_engines(rng, options['engines'])
+        reservations = self._generate_reservations(rng, options['reservations'], options['days'])
+        reservations.sort(key=lambda reservation: reservation[0])
+
+        self.stdout.write(f'{len(engines)} engines, {len(reservations)} reservations over {options["days"]} days')
+        self.stdout.write(f'{"Policy":<14}{"Decisions/s":>14}{"Rejected %":>12}{"Avg setup s":>13}{"Idle engines":>14}')
+        for policy_name in POLICIES.keys():
+            result = self._simulate(policy_name, engines, reservations)
+            self.stdout.write(
+                f'{policy_name:<14}'
+                f'{result["throughput"]:>14.0f}'
+                f'{result["rejection_rate"]:>12.2f}'
+                f'{result["average_setup_time"]:>13.1f}'
+                f'{result["average_idle_engines"]:>14.2f}'
+            )
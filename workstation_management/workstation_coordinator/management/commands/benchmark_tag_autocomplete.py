@@ -0,0 +1,75 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from workstation_coordinator.models import Tag
+from workstation_coordinator.tag_index import TagNameAutocomplete
+
+WORDS = ['python', 'java', 'gpu', 'cuda', 'linux', 'windows', 'ubuntu', 'debian', 'matlab', 'office', 'docker',
+         'rust', 'latex', 'blender', 'unity', 'oracle', 'postgres', 'spark', 'hadoop', 'android', 'network', 'lab']
+
+
+class Command(BaseCommand):
+    help = 'Compare tag autocomplete from the in-memory index with icontains queries, database rows are rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tags', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=2000)
+        parser.add_argument('--database-queries', type=int, default=100)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def _generate_tag_names(self, rng: random.Random, count: int) -> list[str]:
+        names = set()
+        while len(names) < count:
+            words = rng.sample(WORDS, rng.choice([1, 2, 3]))
+            names.add(f'{"-".join(words)}-{rng.randrange(0, 10000)}')
+        return list(names)
+
+    def _generate_queries(self, rng: random.Random, names: list[str], count: int) -> list[str]:
+        queries = []
+        for _ in range(count):
+            name = rng.choice(names)
+            length = rng.randint(1, min(8, len(name)))
+            start = rng.randrange(0, len(name) - length + 1)
+            queries.append(name[start:start + length])
+        return queries
+
+    def _get_percentile(self, timings: list[float], percentile: float) -> float:
+        timings = sorted(timings)
+        return timings[min(len(timings) - 1, int(len(timings) * percentile))] * 1000
+
+    def _write_row(self, method: str, timings: list[float]):
+        self.stdout.write(f'{method:<26}{len(timings):>10}{self._get_percentile(timings, 0.5):>12.3f}{self._get_percentile(timings, 0.99):>12.3f}')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        names = self._generate_tag_names(rng, options['tags'])
+        queries = self._generate_queries(rng, names, options['queries'])
+        limit = options['limit']
+
+        start = time.perf_counter()
+        autocomplete = TagNameAutocomplete(names)
+        build_time = time.perf_counter() - start
+
+        index_timings = []
+        for query in queries:
+            start = time.perf_counter()
+            autocomplete.search(query, limit)
+            index_timings.append(time.perf_counter() - start)
+
+        database_timings = []
+        with transaction.atomic():
+            Tag.objects.bulk_create([Tag(name=name) for name in names], batch_size=5000)
+            for query in queries[:options['database_queries']]:
+                start = time.perf_counter()
+                list(Tag.objects.filter(name__icontains=query))
+                database_timings.append(time.perf_counter() - start)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'{len(names)} tags, index built in {build_time:.2f}s, results limited to {limit}')
+        self.stdout.write(f'{"Method":<26}{"Queries":>10}{"p50 ms":>12}{"p99 ms":>12}')
+        self._write_row('In-memory index', index_timings)
+        self._write_row('icontains, unlimited', database_timings)
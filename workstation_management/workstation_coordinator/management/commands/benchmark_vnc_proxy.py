@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from main_server.vnc_proxy import VncProxy
+
+CHUNK_SIZE = 65536
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while data := await reader.read(CHUNK_SIZE):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+# Stands in for a workstation sending framebuffer updates, streams a fixed amount of data and closes
+def get_streamer(total_bytes: int):
+    async def stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        chunk = b'\0' * CHUNK_SIZE
+        sent = 0
+        while sent < total_bytes:
+            writer.write(chunk)
+            await writer.drain()
+            sent += len(chunk)
+        writer.close()
+    return stream
+
+
+# Proxied connection driven the way an ASGI server drives the proxy, without a network hop for the WebSocket side
+class ProxyClient:
+    def __init__(self, address: tuple, on_close) -> None:
+        self.address = address
+        self.on_close = on_close
+
+    async def _resolve(self, token: str) -> tuple:
+        return self.address
+
+    async def connect(self):
+        self.client_messages = asyncio.Queue()
+        self.server_messages = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': '/websockify', 'query_string': b'token=benchmark', 'subprotocols': ['binary']}
+        await self.client_messages.put({'type': 'websocket.connect'})
+        self.task = asyncio.create_task(VncProxy(self._resolve, self.on_close)(scope, self.client_messages.get, self.server_messages.put))
+        await self.server_messages.get()
+
+    async def send(self, data: bytes):
+        await self.client_messages.put({'type': 'websocket.receive', 'bytes': data})
+
+    async def read(self) -> bytes:
+        message = await self.server_messages.get()
+        return message.get('bytes', b'')
+
+    async def close(self):
+        await self.client_messages.put({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+
+class DirectClient:
+    def __init__(self, address: tuple) -> None:
+        self.address = address
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(*self.address)
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read(self) -> bytes:
+        return await self.reader.read(CHUNK_SIZE)
+
+    async def close(self):
+        self.writer.close()
+
+
+class Command(BaseCommand):
+    help = 'Compare round trip latency and throughput to a dummy VNC server through the ASGI VNC proxy and directly'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--message-size', type=int, default=64)
+        parser.add_argument('--stream-mb', type=int, default=256)
+
+    def _get_percentile(self, timings: list[float], percentile: float) -> float:
+        timings = sorted(timings)
+        return timings[min(len(timings) - 1, int(len(timings) * percentile))] * 1000
+
+    async def _measure_latency(self, client, messages: int, message_size: int) -> list[float]:
+        await client.connect()
+        data = b'x' * message_size
+        timings = []
+        for _ in range(messages):
+            start = time.perf_counter()
+            await client.send(data)
+            received = 0
+            while received < message_size:
+                received += len(await client.read())
+            timings.append(time.perf_counter() - start)
+        await client.close()
+        return timings
+
+    async def _measure_throughput(self, client) -> tuple:
+        start = time.perf_counter()
+        await client.connect()
+        received = 0
+        while data := await client.read():
+            received += len(data)
+        duration = time.perf_counter() - start
+        if isinstance(client, ProxyClient):
+            await client.task
+        else:
+            await client.close()
+        return received, duration
+
+    async def _run(self, options: dict):
+        connection_stats = []
+        echo_server = await asyncio.start_server(echo, '127.0.0.1', 0)
+        stream_server = await asyncio.start_server(get_streamer(options['stream_mb'] * 1024 * 1024), '127.0.0.1', 0)
+        echo_address = echo_server.sockets[0].getsockname()
+        stream_address = stream_server.sockets[0].getsockname()
+
+        async with echo_server, stream_server:
+            self.stdout.write(f'Round trips of {options["message_size"]} byte messages')
+            self.stdout.write(f'{"Path":<12}{"Messages":>10}{"p50 ms":>12}{"p99 ms":>12}')
+            for name, client in [('Direct', DirectClient(echo_address)), ('Proxy', ProxyClient(echo_address, connection_stats.append))]:
+                timings = await self._measure_latency(client, options['messages'], options['message_size'])
+                self.stdout.write(f'{name:<12}{len(timings):>10}{self._get_percentile(timings, 0.5):>12.3f}{self._get_percentile(timings, 0.99):>12.3f}')
+
+            self.stdout.write(f'Streaming {options["stream_mb"]} MB from the server')
+            self.stdout.write(f'{"Path":<12}{"MB":>10}{"Seconds":>12}{"MB/s":>12}')
+            for name, client in [('Direct', DirectClient(stream_address)), ('Proxy', ProxyClient(stream_address, connection_stats.append))]:
+                received, duration = await self._measure_throughput(client)
+                megabytes = received / 1024 / 1024
+                self.stdout.write(f'{name:<12}{megabytes:>10.0f}{duration:>12.3f}{megabytes / duration:>12.1f}')
+
+        self.stdout.write('Proxy connection metrics')
+        for stats in connection_stats:
+            self.stdout.write(str(stats.as_dict()))
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
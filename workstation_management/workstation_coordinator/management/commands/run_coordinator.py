@@ -5,6 +5,9 @@ class Command(BaseCommand):
     help = 'Run the workstation coordinator'
 
     def handle(self, *args, **options):
+        from utils.database import use_pooled_connection_reset
         from workstation_coordinator.coordinator import WorkstationCoordinator
+        # Shards are owned through session level advisory locks, they must not stay on connections returned to the pool
+        use_pooled_connection_reset()
         coordinator = WorkstationCoordinator()
         coordinator._main_loop()
\ No newline at end of file
@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from utils.singleton import Singleton
+from .models import ProxyMapping
+
+
+class CachedMapping:
+    def __init__(self, mapping: ProxyMapping) -> None:
+        self.external_path = mapping.external_path
+        self.archived = mapping.archived
+        self.expires_at = time.monotonic() + settings.MAPPING_CACHE_TTL
+
+
+# Process local LRU cache of proxy mappings for the websockify token lookup, keyed by the token as text.
+# Only mappings which were already looked up or archived are cached, the first lookup of a mapping is always
+# claimed in the database. Mappings archived by other processes are seen once the entry expires after MAPPING_CACHE_TTL.
+class MappingLookupCache(metaclass=Singleton):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, mapping_id) -> CachedMapping:
+        mapping_id = str(mapping_id)
+        with self.lock:
+            entry = self.entries.get(mapping_id)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                del self.entries[mapping_id]
+                return None
+            self.entries.move_to_end(mapping_id)
+            return entry
+
+    def put(self, mapping_id, entry: CachedMapping):
+        mapping_id = str(mapping_id)
+        with self.lock:
+            self.entries[mapping_id] = entry
+            self.entries.move_to_end(mapping_id)
+            while len(self.entries) > settings.MAPPING_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def mark_archived(self, mapping_id):
+        mapping_id = str(mapping_id)
+        with self.lock:
+            entry = self.entries.get(mapping_id)
+            if entry is not None:
+                entry.archived = True
@@ -0,0 +1,83 @@
+import logging
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from .mapping_cache import CachedMapping, MappingLookupCache
+from .models import Reservation, ProxyMapping
+from .write_batch import WriteBatch
+
+logger = logging.getLogger('workstation_coordinator')
+
+class MappingHandler:
+    def __init__(self) -> None:
+        pass
+
+    # Claims the first lookup of a mapping, only one lookup in all processes gets the workstation address
+    def _claim_lookup(self, id: str) -> bool:
+        return ProxyMapping.objects.filter(id=id, looked_up=False, archived=False).update(looked_up=True) == 1
+
+    # A verified mapping is one that is currently NOT archived and can be used to access reservation.
+    # Mappings already looked up or archived are served from MappingLookupCache
+    def get_mapping_target_by_id(self, id: str) -> str: 
+        mapping_cache = MappingLookupCache()
+        cached = mapping_cache.get(id)
+        if cached is None:
+            # Check if token exists in database 
+            try:
+                mapping = ProxyMapping.objects.select_related('workstation').filter(id=id).first()
+            except ValidationError:
+                mapping = None
+            if mapping is None:
+                logger.info(f'Mapping with id {id} not found')
+                return "" 
+
+            if not mapping.looked_up and not mapping.archived:
+                if self._claim_lookup(id):
+                    mapping_cache.put(id, CachedMapping(mapping))
+                    workstation_ip = mapping.workstation.ip_address
+                    workstation_port = mapping.workstation.port if mapping.workstation.port is not None else 5900
+                    return f'{workstation_ip}:{workstation_port}'
+                # Looked up or archived by another process since it was read
+                mapping.refresh_from_db(fields=['looked_up', 'archived'])
+            cached = CachedMapping(mapping)
+            mapping_cache.put(id, cached)
+
+        # Check if mapping is archived
+        if cached.archived:
+            logger.info(f'Mapping with id {id} is archived')
+            return "" 
+
+        logger.info(f'Mapping with id {id} is already looked up')
+        return cached.external_path
+    
+    def get_mapping_for_reservation(self, reservation: Reservation) -> ProxyMapping:
+        self.create_mapping_for_reservation(reservation)
+        return reservation.proxy_mapping
+    
+    # Coordinator passes its tick write batch, changes are then written when the batch is flushed
+    def archive_mapping_for_reservation_if_exists(self, reservation: Reservation, batch: WriteBatch = None):
+        if reservation.proxy_mapping is None:
+            return
+        mapping = reservation.proxy_mapping
+        mapping.archived = True
+        mapping.archived_at = timezone.now()
+        MappingLookupCache().mark_archived(mapping.id)
+        reservation.proxy_mapping = None
+        if batch is not None:
+            batch.update_fields(mapping, 'archived', 'archived_at')
+            batch.update_fields(reservation, 'proxy_mapping')
+            return
+        mapping.save(update_fields=['archived', 'archived_at'])
+        reservation.save(update_fields=['proxy_mapping'])
+    
+    def create_mapping_for_reservation(self, reservation: Reservation):
+        self.archive_mapping_for_reservation_if_exists(reservation) 
+             
+        mapping = ProxyMapping.objects.create(
+            workstation = reservation.workstation,
+            external_path = f'/novnc/{None}'
+        )
+        mapping.external_path = f'/novnc/{mapping.id}'
+        mapping.save(update_fields=['external_path'])
+
+        reservation.proxy_mapping = mapping
+        reservation.save(update_fields=['proxy_mapping'])
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workstation_coordinator', '0024_alter_workstation_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='engine',
+            name='average_setup_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='template',
+            name='placement_policy',
+            field=models.CharField(choices=[('FirstFit', 'Firstfit'), ('BestFit', 'Bestfit'), ('Spread', 'Spread'), ('LatencyAware', 'Latencyaware')], default='FirstFit', max_length=200),
+        ),
+    ]
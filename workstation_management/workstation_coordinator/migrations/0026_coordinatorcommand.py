@@ -0,0 +1,29 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:32
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workstation_coordinator', '0025_engine_average_setup_time_template_placement_policy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoordinatorCommand',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('Cancel', 'Cancel'), ('Restart', 'Restart')], max_length=200)),
+                ('status', models.CharField(choices=[('Pending', 'Pending'), ('Done', 'Done'), ('Failed', 'Failed')], default='Pending', max_length=200)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='workstation_coordinator.reservation')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_resource_requirements(apps, schema_editor):
+    Template = apps.get_model('workstation_coordinator', 'Template')
+    TemplateResource = apps.get_model('workstation_coordinator', 'TemplateResource')
+    TemplateResource.objects.bulk_create([
+        TemplateResource(template=template, name=name, amount=int(amount))
+        for template in Template.objects.all()
+        for name, amount in template.resource_requirements.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workstation_coordinator', '0026_coordinatorcommand'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateResource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('amount', models.BigIntegerField()),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='resources', to='workstation_coordinator.template')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('template', 'name'), name='unique_template_resource')],
+            },
+        ),
+        migrations.RunPython(copy_resource_requirements, migrations.RunPython.noop),
+    ]
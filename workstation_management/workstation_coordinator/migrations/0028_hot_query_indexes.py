@@ -0,0 +1,51 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workstation_coordinator', '0027_templateresource'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='coordinatorcommand',
+            index=models.Index(fields=['status', 'created_at'], name='command_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['status', 'request_date'], name='reservation_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['start_date', 'end_date'], name='reservation_start_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['end_date', 'start_date'], name='reservation_end_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['last_status_update'], name='reservation_status_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user', '-request_date'], name='reservation_user_request_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['user', 'status', '-start_date'], name='reservation_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workstation',
+            index=models.Index(fields=['engine_internal_name'], name='workstation_internal_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='workstation',
+            index=models.Index(fields=['status'], name='workstation_status_idx'),
+        ),
+    ]
@@ -1,8 +1,9 @@
 from typing import Any
 from main_server.models import User
-from django.db import models
+from django.db import models, transaction
 import uuid
 from django.utils import timezone
+from .status_events import notify_status_changed
 
 class Tag(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -25,6 +26,8 @@ class Engine(models.Model):
     type = models.ForeignKey(EngineType, on_delete=models.SET_NULL, null=True)
     available_resources = models.JSONField()
     max_resources = models.JSONField()
+    # Moving average of measured workstation setup time in seconds, used by latency aware placement
+    average_setup_time = models.FloatField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -39,6 +42,13 @@ class Host(models.Model):
         return self.name
 
 class Template(models.Model):
+
+    class PlacementPolicy(models.TextChoices):
+        FirstFit = 'FirstFit'
+        BestFit = 'BestFit'
+        Spread = 'Spread'
+        LatencyAware = 'LatencyAware'
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=200)
     internal_name = models.CharField(max_length=200, unique=True)
@@ -47,10 +57,37 @@ class Template(models.Model):
     allowed_engine_types = models.ManyToManyField(EngineType)
     tags = models.ManyToManyField(Tag)
     resource_requirements = models.JSONField()
+    placement_policy = models.CharField(max_length=200, choices=PlacementPolicy.choices, default=PlacementPolicy.FirstFit)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.sync_resources()
+
+    # resource_requirements stays the editable source, resources is its typed copy used for load queries
+    def sync_resources(self):
+        TemplateResource.objects.filter(template=self).delete()
+        TemplateResource.objects.bulk_create([
+            TemplateResource(template=self, name=name, amount=int(amount))
+            for name, amount in self.resource_requirements.items()
+        ])
 
     def __str__(self):
         return self.name
 
+class TemplateResource(models.Model):
+    template = models.ForeignKey(Template, on_delete=models.CASCADE, related_name='resources')
+    name = models.CharField(max_length=200)
+    amount = models.BigIntegerField()
+
+    def __str__(self):
+        return f'({self.template}, {self.name}, {self.amount})'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['template', 'name'], name='unique_template_resource'),
+        ]
+
 class Workstation(models.Model):
 
     class Status(models.TextChoices):
@@ -73,16 +110,35 @@ class Workstation(models.Model):
     additional_information = models.JSONField(null=True, blank=True)
     last_status_update = models.DateTimeField(auto_now=True)
 
-    def set_workstation_status(self, status: Status):
+    # Conditional single column update, it only wins if the status in database is still the expected one
+    # (by default the one this instance was loaded with). Extra fields are written in the same statement.
+    def set_workstation_status(self, status: Status, expected_status: Status = None, **fields) -> bool:
+        if expected_status is None:
+            expected_status = self.status
+        last_status_update = timezone.now()
+        updated = Workstation.objects\
+            .filter(id=self.id, status=expected_status)\
+            .update(status=status, last_status_update=last_status_update, **fields)
+        if updated == 0:
+            return False
+        notify_status_changed(type(self), [self.id])
         self.status = status
-        self.last_status_update = timezone.now()
-        self.save()
+        self.last_status_update = last_status_update
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
 
     def __str__(self):
         return f'({self.ip_address}, {self.port}, {self.template}, {self.host}, {self.engine}, {self.status}, {self.engine_internal_name})'
     
     class Meta:
         ordering = ['-last_status_update']
+        indexes = [
+            # Orphan sweep matches VM names reported by engines
+            models.Index(fields=['engine_internal_name'], name='workstation_internal_name_idx'),
+            # Only a small part of workstations is not archived, coordinator looks them up by status
+            models.Index(fields=['status'], name='workstation_status_idx'),
+        ]
 
 class ProxyMapping(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -123,10 +179,22 @@ class Reservation(models.Model):
     last_status_update = models.DateTimeField(auto_now=True)
     user_label = models.CharField(max_length=50, null=True, blank=True)
 
-    def set_reservation_status(self, status: Status):
+    # Conditional single column update, see Workstation.set_workstation_status
+    def set_reservation_status(self, status: Status, expected_status: Status = None, **fields) -> bool:
+        if expected_status is None:
+            expected_status = self.status
+        last_status_update = timezone.now()
+        updated = Reservation.objects\
+            .filter(id=self.id, status=expected_status)\
+            .update(status=status, last_status_update=last_status_update, **fields)
+        if updated == 0:
+            return False
+        notify_status_changed(type(self), [self.id])
         self.status = status
-        self.last_status_update = timezone.now()
-        self.save()
+        self.last_status_update = last_status_update
+        for name, value in fields.items():
+            setattr(self, name, value)
+        return True
 
     def __str__(self) -> str:
         response = f'({self.user_label}, {self.template}, {self.user}, {self.request_date}, {self.start_date}, {self.end_date}, {self.status})' 
@@ -134,5 +202,42 @@ class Reservation(models.Model):
     
     class Meta:
         ordering = ['-request_date']
-    
+        indexes = [
+            # Coordinator tick and schedule rebuild
+            models.Index(fields=['status', 'request_date'], name='reservation_status_idx'),
+            # Overlap queries used during admission, each side of the range is searched by its own index
+            models.Index(fields=['start_date', 'end_date'], name='reservation_start_end_idx'),
+            models.Index(fields=['end_date', 'start_date'], name='reservation_end_start_idx'),
+            # Schedule sync
+            models.Index(fields=['last_status_update'], name='reservation_status_update_idx'),
+            # Reservation list and dashboard of a user
+            models.Index(fields=['user', '-request_date', '-id'], name='reservation_user_request_idx'),
+            models.Index(fields=['user', 'status', '-start_date'], name='reservation_user_status_idx'),
+        ]
+
+class CoordinatorCommand(models.Model):
+
+    class Type(models.TextChoices):
+        Cancel = 'Cancel'
+        Restart = 'Restart'
 
+    class Status(models.TextChoices):
+        Pending = 'Pending'
+        Done = 'Done'
+        Failed = 'Failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    type = models.CharField(max_length=200, choices=Type.choices)
+    status = models.CharField(max_length=200, choices=Status.choices, default=Status.Pending)
+    reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f'({self.type}, {self.reservation_id}, {self.status}, {self.created_at})'
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='command_status_created_idx'),
+        ]
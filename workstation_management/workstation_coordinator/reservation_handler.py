@@ -1,8 +1,13 @@
 import logging
-from django.db.models import QuerySet
+from django.db import transaction, connection
+from django.db.models import QuerySet, Q
 from django.utils import timezone
-from .models import Template, Reservation, Host, Workstation, ProxyMapping
-from .reservation_policies import DefaultReservationPolicy
+from .models import Reservation, Workstation, CoordinatorCommand
+from .mapping_handler import MappingHandler
+from .admission import ReservationAdmission
+from .scheduler import DueActionScheduler
+from .sharding import ShardManager
+from .write_batch import WriteBatch, WriteCounter
 
 from .engine_handler import EngineHandler
 
@@ -10,58 +15,30 @@ logger = logging.getLogger('workstation_coordinator')
 
 class RevervationHandler:
     def __init__(self) -> None:
-        self.policy = DefaultReservationPolicy()
+        self.admission = ReservationAdmission()
+        self.shard_manager = ShardManager()
+        self.scheduler = DueActionScheduler(self.shard_manager.owns)
+        self.mapping_handler = MappingHandler()
+        # Status changes made while handling a tick are written together at its end
+        self.batch = WriteBatch()
+        self.last_tick_write_count = 0
 
     def _handle_pending(self, reservation: Reservation, engine_handler: EngineHandler):
-        logger.info(f'Checking for overlapping reservations')
-
-        reservations_in_same_timeframe = self._get_overlapping(reservation)
-        logger.info(f'Reservations in same timeframe: {list(reservations_in_same_timeframe)}')
-
-        logger.info(f'Filtering out reservetions with already assigned workstation') 
-        reservations_without_workstation = self._get_without_workstation(reservations_in_same_timeframe)
-        filtered_reservations = reservations_in_same_timeframe.exclude(id__in=[r.id for r in reservations_without_workstation])
-        logger.info(f'Reservations without workstation: {list(reservations_without_workstation)}')
-        logger.info(f'Searching for suitable engine')
-
-        for engine in engine_handler._get_all():
-            logger.info(f'Checking engine: {engine}')
-
-            # Check 1: Is engine type supported by template
-            allowed_engines = engine_handler._get_supported_engine_types(reservation.template)
-            logger.info(f'Allowed engines: {allowed_engines}') 
-
-            # Check 2: Does engine have available resources at the time of reservation
-            max_vm_load_at_time = engine_handler._get_max_load_at_time(engine, filtered_reservations)
-            max_possible_load = engine_handler._get_max_possible_load(engine)
-            template_load = reservation.template.resource_requirements
-            cumulative_load = {key: int(max_vm_load_at_time.get(key, 0)) + int(value) for key, value in template_load.items()}
-
-            logger.info(f'Max VM load at time: {max_vm_load_at_time}')
-            logger.info(f'Max possible load: {max_possible_load}')
-            logger.info(f'Template load: {template_load}')
-            logger.info(f'Cumulative load: {cumulative_load}')
-            if all([int(cumulative_load[key]) <= int(max_possible_load[key]) for key in cumulative_load.keys()]):
-                logger.info(f'Engine {engine} has enough resources for reservation {reservation}')
-                host = Host.objects.filter(engines__in=[engine]).first()
-                workstation = Workstation.objects.create(
-                    template=reservation.template,
-                    host=host,
-                    engine=engine,
-                    status=Workstation.Status.Scheduled
-                )
-                reservation.workstation = workstation
-                reservation.workstation.engine = engine
-                reservation.set_reservation_status(Reservation.Status.Approved) 
-                reservation.save()
-                logger.info(f'Reservation {reservation} approved')
-                return
-            else:
-                logger.info(f'Engine {engine} does not have enough resources for reservation {reservation}')
-                continue
-        logger.info(f'No suitable engine found for reservation {reservation}')
-        reservation.set_reservation_status(Reservation.Status.Rejected)
-        logger.info(f'Reservation {reservation} rejected')
+        # Engines stay locked until the admission is committed, so that other coordinators cannot book the same capacity
+        with transaction.atomic():
+            engines = engine_handler._get_all_for_update()
+            self._admit_reservation(reservation, engines, engine_handler)
+
+    def _admit_reservation(self, reservation: Reservation, engines: list, engine_handler: EngineHandler):
+        engine = self.admission.select_engine(reservation, engines, engine_handler)
+        if engine is None:
+            self.batch.set_status(reservation, Reservation.Status.Rejected)
+            logger.info(f'Reservation {reservation} rejected')
+            return
+
+        if not self.admission.approve(reservation, engine):
+            return
+        self.scheduler.schedule_reservation(reservation)
             
     def _handle_approved(self, reservation: Reservation, engine_handler: EngineHandler):
         # Check 1: Is reservation start date in the past
@@ -76,7 +53,7 @@ class RevervationHandler:
         if reservation.end_date < current_time:
             logger.info(f'Reservation {reservation} end date is in the past, skipping')
             # Since reservation end date is in the past before it was active it is an unexpected state, set as broken
-            reservation.set_reservation_status(Reservation.Status.Broken)
+            self.batch.set_status(reservation, Reservation.Status.Broken)
             return 
 
         
@@ -84,7 +61,7 @@ class RevervationHandler:
         if reservation.workstation is None:
             logger.info(f'Reservation {reservation} does not have assigned workstation, unexpected state')
             logger.info(f'Changing to broken state')
-            reservation.set_reservation_status(Reservation.Status.Broken)
+            self.batch.set_status(reservation, Reservation.Status.Broken)
             return
 
         # Handle workstation depending on its status 
@@ -93,30 +70,39 @@ class RevervationHandler:
         if workstation_status == Workstation.Status.Scheduled: 
             # Start setting up workstation
             logger.info(f'Setting up workstation for reservation {reservation}')
-            reservation.workstation.set_workstation_status(Workstation.Status.Setup)
 
             def setup_callback():
-                reservation.workstation.set_workstation_status(Workstation.Status.Active)
+                reservation.workstation.set_workstation_status(Workstation.Status.Active, Workstation.Status.Setup)
+                # Activate reservation on the next tick instead of waiting for the tick interval
+                self.scheduler.wake()
 
-            engine_handler.setup_workstation_for_reservation(reservation, callback=setup_callback) 
+            def start_setup():
+                engine_handler.setup_workstation_for_reservation(reservation, callback=setup_callback)
+
+            def skip_setup():
+                logger.info(f'Workstation for reservation {reservation} changed status, skipping setup')
+
+            self.batch.set_status(reservation.workstation, Workstation.Status.Setup, on_success=start_setup, on_failure=skip_setup)
 
         elif workstation_status == Workstation.Status.Setup:
             # Workstation is actively being setup
             if engine_handler._is_setup_thread_running(reservation):
                 logger.info(f'Workstation for reservation {reservation} is already being setup')
             else:
-                reservation.workstation.set_workstation_status(Workstation.Status.Scheduled)
+                self.batch.set_status(reservation.workstation, Workstation.Status.Scheduled,
+                                      on_success=lambda: self.scheduler.schedule(reservation.id, reservation.start_date))
                 logger.info(f'Workstation for reservation {reservation} is being setup without worker thread, reverting to scheduled state')
 
         elif workstation_status == Workstation.Status.Active:
             # Workstation is active
             logger.info(f'Workstation for reservation {reservation} is active, reservation can be used')
-            reservation.set_reservation_status(Reservation.Status.Active)
+            self.batch.set_status(reservation, Reservation.Status.Active,
+                                  on_success=lambda: self.scheduler.schedule_reservation(reservation))
 
         elif workstation_status == Workstation.Status.Restart:
             # Workstation is to be restarted
             def setup_callback():
-                reservation.workstation.set_workstation_status(Workstation.Status.Active)
+                reservation.workstation.set_workstation_status(Workstation.Status.Active, Workstation.Status.Restart)
 
             logger.info(f'Restarting workstation for reservation {reservation}')
             engine_handler.restart_workstation_for_reservation(reservation, callback=setup_callback)
@@ -131,7 +117,7 @@ class RevervationHandler:
         if workstation_status == Workstation.Status.Restart:
             # Workstation is to be restarted
             def setup_callback():
-                reservation.workstation.set_workstation_status(Workstation.Status.Active)
+                reservation.workstation.set_workstation_status(Workstation.Status.Active, Workstation.Status.Restart)
 
             logger.info(f'Restarting workstation for reservation {reservation}')
             engine_handler.restart_workstation_for_reservation(reservation, callback=setup_callback)
@@ -144,7 +130,7 @@ class RevervationHandler:
             if reservation.workstation is None:
                 logger.info(f'Reservation {reservation} does not have assigned workstation, unexpected state')
                 logger.info(f'Changing to broken state')
-                reservation.set_reservation_status(Reservation.Status.Broken)
+                self.batch.set_status(reservation, Reservation.Status.Broken)
                 return
 
             logger.info(f'Reservation {reservation} end date is in the future, skipping')
@@ -162,18 +148,23 @@ class RevervationHandler:
 
         # Perform workstation cleanup
         logger.info(f'Cleaning up workstation for reservation {reservation}')
-        reservation.workstation.set_workstation_status(Workstation.Status.Cleanup)
 
         def cleanup_callback():
-            reservation.workstation.set_workstation_status(Workstation.Status.Archived)
-            reservation.set_reservation_status(Reservation.Status.Completed)
+            reservation.workstation.set_workstation_status(Workstation.Status.Archived, Workstation.Status.Cleanup)
+            reservation.set_reservation_status(Reservation.Status.Completed, Reservation.Status.Active)
 
-        engine_handler.start_workstation_cleanup_for_reservation(reservation, 
-                                                                 callback=cleanup_callback)
-        
-        self.archive_mapping_for_reservation_if_exists(reservation)
-        
-        logger.info(f'Reservation {reservation} completed')
+        def start_cleanup():
+            engine_handler.start_workstation_cleanup_for_reservation(reservation, 
+                                                                     callback=cleanup_callback)
+            logger.info(f'Reservation {reservation} completed')
+
+        def retry_cleanup():
+            logger.info(f'Workstation for reservation {reservation} changed status, retrying on next tick')
+            self.scheduler.schedule(reservation.id, current_time)
+
+        self.batch.set_status(reservation.workstation, Workstation.Status.Cleanup, on_success=start_cleanup, on_failure=retry_cleanup)
+        # Reservation is over whether or not the cleanup starts on this tick
+        self.mapping_handler.archive_mapping_for_reservation_if_exists(reservation, self.batch)
 
     def _handle_cancelled(self, reservation: Reservation, engine_handler: EngineHandler):
         # Check 1: does reservation have assigned workstation
@@ -187,14 +178,28 @@ class RevervationHandler:
             #logger.info(f'Workstation for reservation {reservation} is {workstation_status} which is not executing operations, skipping')
             return
 
-        # Perform workstation cleanup
+        # Check 3: is cleanup already running
+        if engine_handler._is_cleanup_thread_running(reservation):
+            logger.info(f'Workstation for reservation {reservation} is already being cleaned up, skipping')
+            return
+
+        # Perform workstation cleanup in background, so that cancellation does not block the main loop
         logger.info(f'Cleaning up workstation for reservation {reservation}')
-        reservation.workstation.set_workstation_status(Workstation.Status.Cleanup)
-        engine_handler._cleanup_workstation(reservation)
-        reservation.workstation.set_workstation_status(Workstation.Status.Archived)
-        self.archive_mapping_for_reservation_if_exists(reservation) 
-        
-        logger.info(f'Reservation {reservation} cancelled')
+
+        def cleanup_callback():
+            reservation.workstation.set_workstation_status(Workstation.Status.Archived, Workstation.Status.Cleanup)
+
+        def start_cleanup():
+            engine_handler.start_workstation_cleanup_for_reservation(reservation, 
+                                                                     callback=cleanup_callback)
+            logger.info(f'Reservation {reservation} cancelled')
+
+        def skip_cleanup():
+            # Cancelled reservations are checked every tick, so it will be retried
+            logger.info(f'Workstation for reservation {reservation} changed status, skipping cleanup')
+
+        self.batch.set_status(reservation.workstation, Workstation.Status.Cleanup, on_success=start_cleanup, on_failure=skip_cleanup)
+        self.mapping_handler.archive_mapping_for_reservation_if_exists(reservation, self.batch)
 
     def _handle_broken(self, reservation: Reservation, engine_handler: EngineHandler):
         # Broken reservations are to be cleaned up if needed
@@ -217,13 +222,18 @@ class RevervationHandler:
         # Cleanup workstation forcefully
         # Perform workstation cleanup
         logger.info(f'Cleaning up workstation for reservation {reservation}')
-        reservation.workstation.set_workstation_status(Workstation.Status.Cleanup)
 
         def cleanup_callback():
-            reservation.workstation.set_workstation_status(Workstation.Status.Broken)
+            reservation.workstation.set_workstation_status(Workstation.Status.Broken, Workstation.Status.Cleanup)
+
+        def start_cleanup():
+            engine_handler.start_workstation_cleanup_for_reservation(reservation, 
+                                                                     callback=cleanup_callback)
 
-        engine_handler.start_workstation_cleanup_for_reservation(reservation, 
-                                                                 callback=cleanup_callback)
+        def skip_cleanup():
+            logger.info(f'Workstation for reservation {reservation} changed status, skipping cleanup')
+
+        self.batch.set_status(reservation.workstation, Workstation.Status.Cleanup, on_success=start_cleanup, on_failure=skip_cleanup)
         
     def _handle_reservation(self, reservation: Reservation, engine_handler: EngineHandler):
         if not reservation.status == Reservation.Status.Completed:
@@ -253,22 +263,55 @@ class RevervationHandler:
             self._handle_broken(reservation, engine_handler)
             return
 
-    def _get_without_workstation(self, reservations: QuerySet) -> QuerySet:
-        return reservations.filter(workstation__isnull=True)
-
-    def _get_overlapping(self, reservation: Reservation) -> QuerySet:
-
-        start_overlap = Reservation.objects.filter(start_date__lte=reservation.start_date, end_date__lte=reservation.end_date, end_date__gte=reservation.start_date)
-        end_overlap = Reservation.objects.filter(start_date__gte=reservation.start_date, end_date__gte=reservation.end_date, start_date__lte=reservation.end_date)
-        outer_overlap = Reservation.objects.filter(start_date__lte=reservation.start_date, end_date__gte=reservation.end_date)
-        inner_overlap = Reservation.objects.filter(start_date__gte=reservation.start_date, end_date__lte=reservation.end_date)
-
-        return (start_overlap | end_overlap | outer_overlap | inner_overlap).exclude(id=reservation.id)
+    def _get_workstations_with_status(self, statuses: list) -> QuerySet:
+        return Workstation.objects.filter(status__in=statuses).values('id')
+
+    # Reservations which only wait for their start or end date are not returned until the scheduler reports them as due.
+    # Workstation conditions are subqueries and workstations are prefetched by id, so that archived ones are not joined.
+    def _get_reservations_to_handle(self, due_reservation_ids: list) -> QuerySet:
+        return Reservation.objects.filter(
+            Q(status=Reservation.Status.Pending) |
+            Q(status=Reservation.Status.Approved, workstation__in=self._get_workstations_with_status([Workstation.Status.Setup,
+                                                                                                       Workstation.Status.Active,
+                                                                                                       Workstation.Status.Restart])) |
+            Q(status=Reservation.Status.Active, workstation__in=self._get_workstations_with_status([Workstation.Status.Restart])) |
+            Q(status=Reservation.Status.Cancelled, workstation__in=self._get_workstations_with_status([Workstation.Status.Active,
+                                                                                                        Workstation.Status.Setup,
+                                                                                                        Workstation.Status.Scheduled])) |
+            Q(status=Reservation.Status.Broken, workstation__in=self._get_workstations_with_status([Workstation.Status.Broken])) |
+            Q(id__in=due_reservation_ids)
+        ).select_related('template', 'user')\
+         .prefetch_related('workstation__engine', 'proxy_mapping')\
+         .order_by('request_date')
+
+    def rebuild_schedule(self):
+        self.scheduler.rebuild()
+
+    def rebalance_shards(self, engine_handler: EngineHandler):
+        busy_reservation_ids = list(engine_handler.setup_threads.keys()) + list(engine_handler.cleanup_threads.keys())
+        busy_shards = {self.shard_manager.get_shard(reservation_id) for reservation_id in busy_reservation_ids}
+        if self.shard_manager.rebalance(busy_shards):
+            self.scheduler.rebuild()
 
     def handle(self, engine_handler: EngineHandler):
         logger.info('=== Handling reservations ===')
-        for reservation in Reservation.objects.all().order_by('request_date'):
-            self._handle_reservation(reservation, engine_handler)
+        write_counter = WriteCounter()
+        with connection.execute_wrapper(write_counter):
+            self.batch = WriteBatch()
+            try:
+                self.process_commands()
+                self.scheduler.sync()
+                due_reservation_ids = self.scheduler.pop_due(timezone.now())
+                logger.info(f'Due reservations: {due_reservation_ids}')
+                for reservation in self._get_reservations_to_handle(due_reservation_ids):
+                    if not self.shard_manager.owns(reservation.id):
+                        continue
+                    self._handle_reservation(reservation, engine_handler)
+            finally:
+                logger.info(f'Flushing {len(self.batch)} batched updates')
+                self.batch.flush()
+        self.last_tick_write_count = write_counter.count
+        logger.info(f'Tick issued {write_counter.count} write statements')
 
     def get_with_status(self, status: str) -> list:
         return list(Reservation.objects.filter(status=status))
@@ -283,116 +326,57 @@ class RevervationHandler:
             logger.info(f'Reervation template: {reservation.template}')
             logger.info(f'Reservation user: {reservation.user}')
 
-    def find_template_with_tags(self, tags: list) -> Template:
-        templates = Template.objects.all()
-        for template in templates:
-            logger.info(f'Template tags: {template.tags.all()}')
-            logger.info(list(template.tags.values_list('name', flat=True)))
-            if all([tag in list(template.tags.values_list('name', flat=True)) for tag in tags]):
-                return template 
-        return None
-
-    # A verified mapping is one that is currently NOT archived and can be used to access reservation
-    def get_mapping_target_by_id(self, id: str) -> str: 
-        mapping = ProxyMapping.objects.filter(id=id).first()
-        # Check if token exists in database 
-        if mapping is None:
-            logger.info(f'Mapping with id {id} not found')
-            return "" 
-        # Check if mapping is archived
-        if mapping.archived:
-            logger.info(f'Mapping with id {id} is archived')
-            return "" 
-        
-        # Check if mapping is looked up
-        if mapping.looked_up:
-            logger.info(f'Mapping with id {id} is already looked up')
-            return mapping.external_path
-        
-        workstation_ip = mapping.workstation.ip_address
-        workstation_port = mapping.workstation.port if mapping.workstation.port is not None else 5900
-        mapping_target = f'{workstation_ip}:{workstation_port}' 
-
-        mapping.looked_up = True
-        mapping.save()
-
-        return mapping_target
-    
-    def get_mapping_for_reservation(self, reservation: Reservation) -> ProxyMapping:
-        self.create_mapping_for_reservation(reservation)
-        return reservation.proxy_mapping
-    
-    def archive_mapping_for_reservation_if_exists(self, reservation: Reservation):
-        if reservation.proxy_mapping is None:
-            return
-        reservation.proxy_mapping.archived = True
-        reservation.proxy_mapping.archived_at = timezone.now()
-        reservation.proxy_mapping.save()
-        reservation.proxy_mapping = None
-        reservation.save()
-    
-    def create_mapping_for_reservation(self, reservation: Reservation):
-        self.archive_mapping_for_reservation_if_exists(reservation) 
-             
-        mapping = ProxyMapping.objects.create(
-            workstation = reservation.workstation,
-            external_path = f'/novnc/{None}'
-        )
-        mapping.external_path = f'/novnc/{mapping.id}'
-        mapping.save()
-
-        reservation.proxy_mapping = mapping
-        reservation.save()
-
-    def create_reservation(self, user, tags, start_date, end_date, user_label) -> Reservation:
-        logger.info(f'Creating reservation for user {user} with tags {tags} from {start_date} to {end_date}')
-        logger.info(f'Finding template with tags: {tags}')
-        template = self.find_template_with_tags(tags)
-        if template is None:
-            logger.info(f'No template found for tags {tags}')
-            return None
-        logger.info(f'Found template: {template} for reservation')
-        logger.info(f'User label: {user_label}')
-        if user_label == "" or user_label is None or len(user_label) == 0:
-            logger.info(f'No user label provided, using default')
-            user_label = f'{template.name}'
-        else:
-            logger.info(f'Using user label: {user_label}')
-        reservation = Reservation.objects.create(
-            status=Reservation.Status.Pending,
-            request_date=timezone.now(),
-            start_date=start_date,
-            end_date=end_date,
-            user=user,
-            template=template,
-            user_label=user_label
-        )
-        reservation.save()
-        logger.info(f'Reservation created: {reservation}')
-        return reservation
-    
-    def cancel_reservation(self, reservation) -> bool:
-        reservation_id = reservation.id
-        reservation = Reservation.objects.get(id=reservation_id)
-        if reservation is not None:
-            reservation.set_reservation_status(Reservation.Status.Cancelled)
+    def _apply_command(self, command: CoordinatorCommand) -> bool:
+        reservation = command.reservation
+
+        if command.type == CoordinatorCommand.Type.Cancel:
+            if reservation.status in [Reservation.Status.Completed, 
+                                      Reservation.Status.Cancelled, 
+                                      Reservation.Status.Rejected]:
+                logger.info(f'Reservation {reservation} is already {reservation.status}, cannot cancel')
+                return False
+            # Status read with the command may be outdated, the reservation stays scheduled if it changed since
+            cancelled = reservation.set_reservation_status(Reservation.Status.Cancelled)
+            if not cancelled:
+                logger.info(f'Reservation {reservation} changed status, cannot cancel')
+                return False
+            self.scheduler.unschedule(reservation.id)
             return True
+
+        if command.type == CoordinatorCommand.Type.Restart:
+            if reservation.workstation is None:
+                logger.info(f'Reservation {reservation} does not have assigned workstation, cannot restart')
+                return False
+            restarted = reservation.workstation.set_workstation_status(Workstation.Status.Restart)
+            if not restarted:
+                logger.info(f'Workstation of reservation {reservation} changed status, cannot restart')
+            return restarted
+
+        logger.info(f'Unknown command type: {command.type}')
         return False
-    
-    def get_progress_for_reservation(self, reservation: Reservation) -> int:
-        if reservation.status in [Reservation.Status.Completed, Reservation.Status.Cancelled, Reservation.Status.Rejected]:
-            return 100
-
-        time_between = reservation.end_date - reservation.start_date
-        time_left = reservation.end_date - timezone.now()
-        progress = int((time_between - time_left) / time_between * 100)
-        
-        return progress
-    
-    def restart_workstation_for_reservation(self, reservation: Reservation):
-        if reservation.workstation is None:
-            return False
-        reservation.workstation.set_workstation_status(Workstation.Status.Restart)
-        return True
 
-        
\ No newline at end of file
+    # Commands are sent by web workers through the database, locked rows are being processed by another coordinator
+    def process_commands(self):
+        processed = []
+        with transaction.atomic():
+            commands = CoordinatorCommand.objects\
+                .select_for_update(skip_locked=True, of=('self',))\
+                .select_related('reservation', 'reservation__workstation', 'reservation__template', 'reservation__user')\
+                .filter(status=CoordinatorCommand.Status.Pending)\
+                .order_by('created_at')
+            for command in commands:
+                if not self.shard_manager.owns(command.reservation_id):
+                    continue
+                logger.info(f'Processing command {command}')
+                # Savepoint per command, a database error of one command must not abort the transaction of the others
+                try:
+                    with transaction.atomic():
+                        succeeded = self._apply_command(command)
+                except Exception as e:
+                    logger.error(f'Error while processing command {command}: {e}')
+                    succeeded = False
+                command.status = CoordinatorCommand.Status.Done if succeeded else CoordinatorCommand.Status.Failed
+                command.processed_at = timezone.now()
+                processed.append(command)
+            if len(processed) > 0:
+                CoordinatorCommand.objects.bulk_update(processed, ['status', 'processed_at'])
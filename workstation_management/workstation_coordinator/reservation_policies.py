@@ -1,3 +1,113 @@
-class DefaultReservationPolicy:
-    def __init__(self) -> None:
-        pass
\ No newline at end of file
+import logging
+from abc import ABC, abstractmethod
+
+from .models import Template
+
+logger = logging.getLogger('workstation_coordinator')
+
+
+class EngineCandidate:
+    def __init__(self, engine, current_load: dict, max_load: dict, required_load: dict, average_setup_time: float = None) -> None:
+        self.engine = engine
+        self.current_load = current_load
+        self.max_load = max_load
+        self.required_load = required_load
+        self.average_setup_time = average_setup_time
+
+    def get_load_after_placement(self) -> dict:
+        return {key: int(self.current_load.get(key, 0)) + int(value) for key, value in self.required_load.items()}
+
+    def fits(self) -> bool:
+        load_after_placement = self.get_load_after_placement()
+        return all([load <= int(self.max_load.get(key, 0)) for key, load in load_after_placement.items()])
+
+    # Utilization of the most constrained resource after placing the reservation, in range 0.0 - 1.0
+    def get_utilization_after_placement(self) -> float:
+        utilization = 0.0
+        for key, load in self.get_load_after_placement().items():
+            max_load = int(self.max_load.get(key, 0))
+            if max_load <= 0:
+                return 1.0
+            utilization = max(utilization, load / max_load)
+        return utilization
+
+    def __str__(self) -> str:
+        return f'({self.engine}, {self.current_load}, {self.max_load}, {self.required_load}, {self.average_setup_time})'
+
+
+class ReservationPolicy(ABC):
+    name = None
+
+    @abstractmethod
+    def select_engine(self, candidates: list[EngineCandidate]) -> EngineCandidate:
+        pass
+
+    def _get_fitting(self, candidates: list[EngineCandidate]) -> list[EngineCandidate]:
+        return [candidate for candidate in candidates if candidate.fits()]
+
+
+# First fit in engine order, this was the only placement strategy before policies were introduced
+class DefaultReservationPolicy(ReservationPolicy):
+    name = Template.PlacementPolicy.FirstFit
+
+    def select_engine(self, candidates: list[EngineCandidate]) -> EngineCandidate:
+        fitting = self._get_fitting(candidates)
+        if len(fitting) == 0:
+            return None
+        return fitting[0]
+
+
+# Places reservation on the fullest engine that can still fit it, so that whole hosts are left free
+class BestFitReservationPolicy(ReservationPolicy):
+    name = Template.PlacementPolicy.BestFit
+
+    def select_engine(self, candidates: list[EngineCandidate]) -> EngineCandidate:
+        fitting = self._get_fitting(candidates)
+        if len(fitting) == 0:
+            return None
+        return max(fitting, key=lambda candidate: candidate.get_utilization_after_placement())
+
+
+# Places reservation on the least loaded engine to minimize contention between workstations on one host
+class SpreadReservationPolicy(ReservationPolicy):
+    name = Template.PlacementPolicy.Spread
+
+    def select_engine(self, candidates: list[EngineCandidate]) -> EngineCandidate:
+        fitting = self._get_fitting(candidates)
+        if len(fitting) == 0:
+            return None
+        return min(fitting, key=lambda candidate: candidate.get_utilization_after_placement())
+
+
+# Prefers engines with the fastest measured setup time. Engines without measurements are tried first
+# so that every engine gets measured, ties are resolved by spreading the load.
+class LatencyAwareReservationPolicy(ReservationPolicy):
+    name = Template.PlacementPolicy.LatencyAware
+
+    def select_engine(self, candidates: list[EngineCandidate]) -> EngineCandidate:
+        fitting = self._get_fitting(candidates)
+        if len(fitting) == 0:
+            return None
+
+        def sort_key(candidate: EngineCandidate):
+            measured = candidate.average_setup_time is not None
+            setup_time = candidate.average_setup_time if measured else 0.0
+            return (measured, setup_time, candidate.get_utilization_after_placement())
+
+        return min(fitting, key=sort_key)
+
+
+POLICIES = {
+    Template.PlacementPolicy.FirstFit: DefaultReservationPolicy,
+    Template.PlacementPolicy.BestFit: BestFitReservationPolicy,
+    Template.PlacementPolicy.Spread: SpreadReservationPolicy,
+    Template.PlacementPolicy.LatencyAware: LatencyAwareReservationPolicy,
+}
+
+
+def get_policy(name: str) -> ReservationPolicy:
+    policy_class = POLICIES.get(name)
+    if policy_class is None:
+        logger.info(f'Unknown placement policy {name}, falling back to {DefaultReservationPolicy.name}')
+        policy_class = DefaultReservationPolicy
+    return policy_class()
@@ -0,0 +1,116 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable
+from django.utils import timezone
+from .models import Reservation
+
+logger = logging.getLogger('workstation_coordinator')
+
+# Status updates written by other processes may become visible with a timestamp slightly older than
+# the newest one already seen, so every sync looks back this far. Rescheduling the same date is a no-op.
+SYNC_OVERLAP = timedelta(seconds=30)
+
+
+class DueActionScheduler:
+    def __init__(self, is_owned: Callable = None) -> None:
+        # Reservations handled by other coordinators are not scheduled
+        self.is_owned = is_owned if is_owned is not None else lambda reservation_id: True
+        self.heap = []
+        self.due_dates = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.watermark = timezone.now()
+        # Last seen status update per reservation, so that rows inside the sync overlap are applied only once
+        self.versions = {}
+
+    # Entries are never removed from the heap directly, an entry is valid only while it matches due_dates
+    def schedule(self, reservation_id, due_date: datetime):
+        with self.lock:
+            if self.due_dates.get(reservation_id) == due_date:
+                return
+            self.due_dates[reservation_id] = due_date
+            heapq.heappush(self.heap, (due_date, next(self.counter), reservation_id))
+            is_earliest = self.heap[0][2] == reservation_id
+        # Coordinator may be sleeping until a later due date
+        if is_earliest:
+            self.wake()
+
+    def unschedule(self, reservation_id):
+        with self.lock:
+            self.due_dates.pop(reservation_id, None)
+
+    def schedule_reservation(self, reservation: Reservation):
+        if not self.is_owned(reservation.id):
+            self.unschedule(reservation.id)
+        elif reservation.status == Reservation.Status.Approved:
+            self.schedule(reservation.id, reservation.start_date)
+        elif reservation.status == Reservation.Status.Active:
+            self.schedule(reservation.id, reservation.end_date)
+        else:
+            self.unschedule(reservation.id)
+
+    def pop_due(self, current_time: datetime) -> list:
+        due = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= current_time:
+                due_date, _, reservation_id = heapq.heappop(self.heap)
+                if self.due_dates.get(reservation_id) != due_date:
+                    continue
+                self.due_dates.pop(reservation_id)
+                due.append(reservation_id)
+        return due
+
+    def get_next_due_date(self) -> datetime:
+        with self.lock:
+            while len(self.heap) > 0:
+                due_date, _, reservation_id = self.heap[0]
+                if self.due_dates.get(reservation_id) == due_date:
+                    return due_date
+                heapq.heappop(self.heap)
+        return None
+
+    def get_seconds_until_next_due(self, max_seconds: float) -> float:
+        next_due_date = self.get_next_due_date()
+        if next_due_date is None:
+            return max_seconds
+        seconds = (next_due_date - timezone.now()).total_seconds()
+        return min(max(seconds, 0.0), max_seconds)
+
+    def wait(self, timeout: float):
+        self.wake_event.wait(timeout)
+        self.wake_event.clear()
+
+    def wake(self):
+        self.wake_event.set()
+
+    def _load(self, reservations):
+        for reservation in reservations:
+            if self.versions.get(reservation.id) == reservation.last_status_update:
+                continue
+            self.versions[reservation.id] = reservation.last_status_update
+            self.schedule_reservation(reservation)
+            if reservation.last_status_update > self.watermark:
+                self.watermark = reservation.last_status_update
+
+    def rebuild(self):
+        with self.lock:
+            self.heap = []
+            self.due_dates = {}
+        self.versions = {}
+        self.watermark = timezone.now()
+        self._load(Reservation.objects
+                   .filter(status__in=[Reservation.Status.Approved, Reservation.Status.Active])
+                   .only('id', 'status', 'start_date', 'end_date', 'last_status_update'))
+        logger.info(f'Rebuilt schedule with {len(self.due_dates)} due actions, next due at {self.get_next_due_date()}')
+
+    # Picks up reservations changed outside of the coordinator, for example approved or cancelled by the web server
+    def sync(self):
+        since = self.watermark - SYNC_OVERLAP
+        self.versions = {key: value for key, value in self.versions.items() if value >= since}
+        self._load(Reservation.objects
+                   .filter(last_status_update__gte=since)
+                   .only('id', 'status', 'start_date', 'end_date', 'last_status_update'))
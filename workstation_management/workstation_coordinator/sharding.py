@@ -0,0 +1,83 @@
+import logging
+import math
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger('workstation_coordinator')
+
+# First keys of two key Postgres advisory locks used by coordinators
+MEMBERSHIP_LOCK_NAMESPACE = 72001
+SHARD_LOCK_NAMESPACE = 72002
+LEADER_LOCK_NAMESPACE = 72003
+
+
+# Splits reservations between coordinator processes by hash of reservation id. Each shard is owned by
+# the coordinator holding its session level advisory lock, so shards of a coordinator which died or lost
+# its database connection are released by Postgres and picked up by the others on their next rebalance.
+class ShardManager:
+    def __init__(self) -> None:
+        self.enabled = settings.COORDINATOR_SHARDING
+        self.shard_count = settings.COORDINATOR_SHARD_COUNT if self.enabled else 1
+        self.owned_shards = set() if self.enabled else {0}
+        self.is_leader = not self.enabled
+        self.backend_pid = None
+
+    def get_shard(self, reservation_id) -> int:
+        return reservation_id.int % self.shard_count
+
+    def owns(self, reservation_id) -> bool:
+        return self.get_shard(reservation_id) in self.owned_shards
+
+    def _fetch_value(self, sql: str, params: list = None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def _ensure_membership(self):
+        backend_pid = self._fetch_value('SELECT pg_backend_pid()')
+        if backend_pid == self.backend_pid:
+            return
+        if self.backend_pid is not None:
+            logger.info(f'Database session changed from {self.backend_pid} to {backend_pid}, all shards were released')
+        self.owned_shards = set()
+        self.is_leader = False
+        self.backend_pid = backend_pid
+        self._fetch_value('SELECT pg_advisory_lock(%s, %s)', [MEMBERSHIP_LOCK_NAMESPACE, backend_pid])
+
+    def _get_live_coordinator_count(self) -> int:
+        return self._fetch_value(
+            "SELECT count(DISTINCT pid) FROM pg_locks WHERE locktype = 'advisory' AND classid = %s AND granted",
+            [MEMBERSHIP_LOCK_NAMESPACE])
+
+    # Shards with work still running in background threads of this process are not handed over,
+    # otherwise the new owner would start the same work again. Returns whether owned shards changed.
+    def rebalance(self, busy_shards: set) -> bool:
+        if not self.enabled:
+            return False
+
+        self._ensure_membership()
+        live_coordinators = max(self._get_live_coordinator_count(), 1)
+        target = math.ceil(self.shard_count / live_coordinators)
+        previously_owned = set(self.owned_shards)
+
+        releasable = sorted(self.owned_shards - busy_shards, reverse=True)
+        while len(self.owned_shards) > target and len(releasable) > 0:
+            shard = releasable.pop(0)
+            self._fetch_value('SELECT pg_advisory_unlock(%s, %s)', [SHARD_LOCK_NAMESPACE, shard])
+            self.owned_shards.remove(shard)
+
+        for shard in range(self.shard_count):
+            if len(self.owned_shards) >= target:
+                break
+            if shard in self.owned_shards:
+                continue
+            if self._fetch_value('SELECT pg_try_advisory_lock(%s, %s)', [SHARD_LOCK_NAMESPACE, shard]):
+                self.owned_shards.add(shard)
+
+        if not self.is_leader:
+            self.is_leader = self._fetch_value('SELECT pg_try_advisory_lock(%s, %s)', [LEADER_LOCK_NAMESPACE, 0])
+
+        changed = self.owned_shards != previously_owned
+        if changed:
+            logger.info(f'{live_coordinators} coordinators running, owning {len(self.owned_shards)}/{self.shard_count} shards: {sorted(self.owned_shards)}')
+        return changed
@@ -0,0 +1,27 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Template, Tag, Engine
+from .tag_index import TagIndex
+from .capacity_timeline import CapacityTimeline
+
+
+# Index is also invalidated after commit, it could have been rebuilt from the old rows in the meantime
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Template)
+@receiver(post_delete, sender=Template)
+@receiver(m2m_changed, sender=Template.tags.through)
+def invalidate_tag_index(sender, **kwargs):
+    tag_index = TagIndex()
+    tag_index.invalidate()
+    transaction.on_commit(tag_index.invalidate)
+
+
+# Reservation changes are picked up by the timeline itself, only engine capacity requires a rebuild
+@receiver(post_save, sender=Engine)
+@receiver(post_delete, sender=Engine)
+def invalidate_capacity_timeline(sender, **kwargs):
+    capacity_timeline = CapacityTimeline()
+    capacity_timeline.invalidate()
+    transaction.on_commit(capacity_timeline.invalidate)
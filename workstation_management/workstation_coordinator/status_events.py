@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import psycopg
+from django.conf import settings
+from django.db import connection, connections
+from utils.singleton import Singleton
+
+logger = logging.getLogger('workstation_coordinator')
+
+STATUS_EVENTS_CHANNEL = 'workstation_status_events'
+CONNECTION_PARAMS = ['dbname', 'user', 'password', 'host', 'port']
+
+
+def get_status_event_key(model, object_id) -> str:
+    return f'{model._meta.model_name}:{object_id}'
+
+
+def get_status_event_keys_for_reservation(reservation) -> set:
+    keys = {get_status_event_key(type(reservation), reservation.id)}
+    if reservation.workstation_id is not None:
+        # models imports this module, the workstation model is taken from the relation instead
+        workstation_model = reservation._meta.get_field('workstation').related_model
+        keys.add(get_status_event_key(workstation_model, reservation.workstation_id))
+    return keys
+
+
+# Sent in the transaction changing the status, Postgres delivers notifications only once it commits
+def notify_status_changed(model, object_ids):
+    if not settings.STATUS_EVENTS_ENABLED or len(object_ids) == 0:
+        return
+    keys = [get_status_event_key(model, object_id) for object_id in object_ids]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, key) FROM unnest(%s::text[]) AS key', [STATUS_EVENTS_CHANNEL, keys])
+
+
+# Keeps one LISTEN connection per ASGI process and wakes the event streams of pages showing a changed
+# reservation or workstation. Queues hold one pending event, a stream which is behind sends one event for all changes.
+class StatusEventListener(metaclass=Singleton):
+    def __init__(self) -> None:
+        self.queues_by_key = {}
+        self.keys_by_queue = {}
+        self.task = None
+
+    def _get_connection_params(self) -> dict:
+        params = connections['default'].get_connection_params()
+        return {name: params[name] for name in CONNECTION_PARAMS if name in params}
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(**self._get_connection_params(), autocommit=True) as listen_connection:
+                    await listen_connection.execute(f'LISTEN {STATUS_EVENTS_CHANNEL}')
+                    logger.info(f'Listening for status events, {len(self.keys_by_queue)} streams open')
+                    # Changes made while the connection was down are not known, every stream refreshes once
+                    self.dispatch_all()
+                    async for notification in listen_connection.notifies():
+                        self.dispatch(notification.payload)
+            except Exception as e:
+                logger.error(f'Error while listening for status events: {e}')
+            await asyncio.sleep(settings.STATUS_EVENTS_RECONNECT_DELAY)
+
+    def _ensure_listening(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self._listen())
+
+    def subscribe(self, keys: set) -> asyncio.Queue:
+        self._ensure_listening()
+        queue = asyncio.Queue(maxsize=1)
+        self.update_subscription(queue, keys)
+        return queue
+
+    def update_subscription(self, queue: asyncio.Queue, keys: set):
+        self.unsubscribe(queue)
+        self.keys_by_queue[queue] = keys
+        for key in keys:
+            self.queues_by_key.setdefault(key, set()).add(queue)
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        for key in self.keys_by_queue.pop(queue, set()):
+            queues = self.queues_by_key[key]
+            queues.discard(queue)
+            if len(queues) == 0:
+                del self.queues_by_key[key]
+
+    def _wake(self, queue: asyncio.Queue, key: str):
+        if not queue.full():
+            queue.put_nowait(key)
+
+    def dispatch(self, key: str):
+        for queue in self.queues_by_key.get(key, set()):
+            self._wake(queue, key)
+
+    def dispatch_all(self):
+        for queue, keys in self.keys_by_queue.items():
+            self._wake(queue, next(iter(keys)))
@@ -0,0 +1,199 @@
+import bisect
+import hashlib
+import heapq
+import logging
+import threading
+import time
+from django.conf import settings
+from utils.singleton import Singleton
+from .models import Template, Tag
+
+logger = logging.getLogger('workstation_coordinator')
+
+
+# Compatible tag results kept per snapshot, further tag combinations are computed on every request
+COMPATIBLE_TAG_NAMES_CACHE_SIZE = 1024
+
+# Queries at least this long are answered from the trigram index, shorter ones from prefix lookup or a scan
+TRIGRAM_LENGTH = 3
+
+
+def get_trigrams(text: str) -> set:
+    return {text[i:i + TRIGRAM_LENGTH] for i in range(len(text) - TRIGRAM_LENGTH + 1)}
+
+
+# Case insensitive substring search over tag names. Matches are ranked exact match, prefix, word prefix and then
+# any other substring. Names are stored shortest first, so within a rank the position is the order of results.
+class TagNameAutocomplete:
+    def __init__(self, tag_names: list[str]) -> None:
+        self.names = sorted(set(tag_names), key=lambda name: (len(name), name.lower(), name))
+        self.lower_names = [name.lower() for name in self.names]
+        # Word prefix match is a substring match of a space followed by the query
+        self.word_names = [' ' + name.replace('-', ' ').replace('_', ' ') for name in self.lower_names]
+        # Positions sorted by lowercase name, used for prefix lookup
+        self.prefix_order = sorted(range(len(self.names)), key=lambda position: self.lower_names[position])
+        self.prefix_keys = [self.lower_names[position] for position in self.prefix_order]
+        self.positions_by_trigram = {}
+        for position, lower_name in enumerate(self.lower_names):
+            for trigram in get_trigrams(lower_name):
+                self.positions_by_trigram.setdefault(trigram, set()).add(position)
+
+    def _get_prefix_matches(self, text: str) -> list:
+        start = bisect.bisect_left(self.prefix_keys, text)
+        end = bisect.bisect_left(self.prefix_keys, text + '\uffff', start)
+        return self.prefix_order[start:end]
+
+    def _get_substring_matches(self, text: str) -> set:
+        if len(text) < TRIGRAM_LENGTH:
+            return {position for position, lower_name in enumerate(self.lower_names) if text in lower_name}
+        postings = sorted([self.positions_by_trigram.get(trigram, set()) for trigram in get_trigrams(text)], key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        # Trigrams may appear in a different order in the name, so the match is confirmed
+        return {position for position in candidates if text in self.lower_names[position]}
+
+    def search(self, text: str, limit: int) -> list[str]:
+        text = text.strip().lower()
+        if len(text) == 0:
+            return self.names[:limit]
+
+        # Exact match is the shortest prefix match, so it is first after sorting by position
+        results = heapq.nsmallest(limit, self._get_prefix_matches(text))
+        if len(results) < limit:
+            prefix_matches = set(results)
+            other_matches = [position for position in self._get_substring_matches(text) if position not in prefix_matches]
+            word = ' ' + text
+            word_matches = [position for position in other_matches if word in self.word_names[position]]
+            results += heapq.nsmallest(limit - len(results), word_matches)
+            if len(results) < limit:
+                word_matches = set(word_matches)
+                results += heapq.nsmallest(limit - len(results), [position for position in other_matches if position not in word_matches])
+        return [self.names[position] for position in results]
+
+
+class TagIndexSnapshot:
+    def __init__(self, templates: list[Template], tag_rows: list[tuple]) -> None:
+        # Template order is kept, so that the first matching template is the same one a query would return.
+        # Only ids are kept, templates are loaded by callers so that they never see outdated fields or shared instances
+        self.template_ids = [template.id for template in templates]
+        self.all_template_ids = frozenset(self.template_ids)
+        self.tags_by_id = {}
+        self.tag_ids_by_template_id = {}
+        self.template_ids_by_tag_id = {}
+        self.template_ids_by_tag_name = {}
+        for template in templates:
+            self.tag_ids_by_template_id[template.id] = {tag.id for tag in template.tags.all()}
+            for tag in template.tags.all():
+                self.tags_by_id[tag.id] = tag
+                self.template_ids_by_tag_id.setdefault(tag.id, set()).add(template.id)
+                self.template_ids_by_tag_name.setdefault(tag.name, set()).add(template.id)
+        # Names are not unique, rows are ordered by descending pk so the same tag as in get_tags_by_string is kept
+        self.tag_id_by_name = {name: tag_id for tag_id, name in tag_rows}
+        self.all_tag_names = sorted([name for _, name in tag_rows])
+        self.autocomplete = TagNameAutocomplete(self.all_tag_names)
+        self.compatible_tag_names = {}
+        self.catalogue_version = self._get_catalogue_version(tag_rows)
+
+    # Hash of the catalogue content, so that every process serving the same catalogue reports the same version
+    def _get_catalogue_version(self, tag_rows: list[tuple]) -> str:
+        catalogue_hash = hashlib.sha1()
+        for tag_id, name in sorted(tag_rows):
+            catalogue_hash.update(f'{tag_id}:{name}\n'.encode())
+        for template_id in sorted(self.tag_ids_by_template_id.keys()):
+            tag_ids = ','.join(sorted([str(tag_id) for tag_id in self.tag_ids_by_template_id[template_id]]))
+            catalogue_hash.update(f'{template_id}:{tag_ids}\n'.encode())
+        return catalogue_hash.hexdigest()
+
+    def _intersect(self, template_id_sets: list[set]) -> set:
+        if len(template_id_sets) == 0:
+            return set(self.all_template_ids)
+        template_id_sets = sorted(template_id_sets, key=len)
+        return set(template_id_sets[0]).intersection(*template_id_sets[1:])
+
+    def get_template_ids_with_tag_names(self, tag_names: list[str]) -> set:
+        return self._intersect([self.template_ids_by_tag_name.get(name, set()) for name in tag_names])
+
+    def get_template_ids_with_tag_ids(self, tag_ids: list) -> set:
+        return self._intersect([self.template_ids_by_tag_id.get(tag_id, set()) for tag_id in tag_ids])
+
+
+# Maps tags to templates using them, so that template matching and tag compatibility are set intersections
+# instead of queries per template. Signals invalidate the index in the process which changed tags or templates,
+# other processes rebuild it once it is older than TAG_INDEX_TTL.
+class TagIndex(metaclass=Singleton):
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.version = 0
+        self.snapshot = None
+        self.snapshot_version = None
+        self.snapshot_time = None
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+
+    def _is_current(self) -> bool:
+        return self.snapshot is not None \
+            and self.snapshot_version == self.version \
+            and time.monotonic() - self.snapshot_time < settings.TAG_INDEX_TTL
+
+    def get_snapshot(self) -> TagIndexSnapshot:
+        if self._is_current():
+            return self.snapshot
+        with self.lock:
+            if self._is_current():
+                return self.snapshot
+            version = self.version
+            start = time.perf_counter()
+            snapshot = TagIndexSnapshot(list(Template.objects.prefetch_related('tags')),
+                                        list(Tag.objects.order_by('-pk').values_list('id', 'name')))
+            self.snapshot = snapshot
+            self.snapshot_version = version
+            self.snapshot_time = time.monotonic()
+            logger.info(f'Built tag index with {len(snapshot.template_ids)} templates and {len(snapshot.autocomplete.names)} tag names in {(time.perf_counter() - start) * 1000:.1f}ms')
+            return snapshot
+
+    def find_template_id_with_tag_names(self, tag_names: list[str]):
+        snapshot = self.get_snapshot()
+        template_ids = snapshot.get_template_ids_with_tag_names(tag_names)
+        for template_id in snapshot.template_ids:
+            if template_id in template_ids:
+                return template_id
+        return None
+
+    def _get_compatible_tag_ids(self, snapshot: TagIndexSnapshot, tag_ids: list) -> set:
+        compatible_tag_ids = set()
+        for template_id in snapshot.get_template_ids_with_tag_ids(tag_ids):
+            compatible_tag_ids.update(snapshot.tag_ids_by_template_id[template_id])
+        compatible_tag_ids.difference_update(tag_ids)
+        return compatible_tag_ids
+
+    def get_tags_compatible_with_tags(self, tags: list[Tag]) -> list[Tag]:
+        snapshot = self.get_snapshot()
+        compatible_tag_ids = self._get_compatible_tag_ids(snapshot, [tag.id for tag in tags])
+        return [snapshot.tags_by_id[tag_id] for tag_id in compatible_tag_ids]
+
+    def get_tag_names_compatible_with_tag_names(self, tag_names: list[str]) -> list[str]:
+        snapshot = self.get_snapshot()
+        key = frozenset(tag_names)
+        compatible_tag_names = snapshot.compatible_tag_names.get(key)
+        if compatible_tag_names is not None:
+            return compatible_tag_names
+
+        # Unknown tag names are not used by any template
+        if any([name not in snapshot.tag_id_by_name for name in key]):
+            compatible_tag_names = []
+        else:
+            compatible_tag_ids = self._get_compatible_tag_ids(snapshot, [snapshot.tag_id_by_name[name] for name in key])
+            compatible_tag_names = sorted([snapshot.tags_by_id[tag_id].name for tag_id in compatible_tag_ids])
+        if len(snapshot.compatible_tag_names) < COMPATIBLE_TAG_NAMES_CACHE_SIZE:
+            snapshot.compatible_tag_names[key] = compatible_tag_names
+        return compatible_tag_names
+
+    def get_all_tag_names(self) -> list[str]:
+        return self.get_snapshot().all_tag_names
+
+    def get_catalogue_version(self) -> str:
+        return self.get_snapshot().catalogue_version
+
+    def search_tag_names(self, text: str, limit: int) -> list[str]:
+        return self.get_snapshot().autocomplete.search(text, limit)
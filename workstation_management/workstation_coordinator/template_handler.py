@@ -1,5 +1,6 @@
 import logging
 from .models import Template, Tag
+from .tag_index import TagIndex
 
 logger = logging.getLogger('workstation_coordinator')
 
@@ -10,32 +11,40 @@ class TemplateHandler:
     def get_all(self) -> list:
         return list(Template.objects.all())
     
-    def get_tags_containing_string_anycase(self, tag_string: str) -> list[Tag]:
-        return list(Tag.objects.filter(name__icontains=tag_string))
+    def get_tag_names_matching_text(self, text: str, limit: int) -> list[str]:
+        return TagIndex().search_tag_names(text, limit)
     
     def get_all_tags(self) -> list[Tag]:
         return list(Tag.objects.all())
     
     def get_tags_by_string(self, input_tags: list[str]) -> list[Tag]:
         logger.info(f'Processing input tag list: {input_tags}')
-        tags = [] 
-        for tag in input_tags:
-            tag = Tag.objects.filter(name=tag).first()
-            tags.append(tag)
-        return tags
+        # Names are not unique, the tag with the lowest id is used, as Tag.objects.filter(name=name).first() would
+        tags_by_name = {tag.name: tag for tag in Tag.objects.filter(name__in=input_tags).order_by('-pk')}
+        return [tags_by_name.get(name) for name in input_tags]
     
     def get_tags_compatible_with_tags(self, input_tags: list[Tag]) -> list[Tag]:
-        all_templates = Template.objects.all()
-        compatible_tags: set = set()
+        # Unknown tag names are passed as None, no template has them
+        if None in input_tags:
+            return []
+        return TagIndex().get_tags_compatible_with_tags(input_tags)
+    
+    # Answered from the tag index without queries, results are sorted so equal catalogue versions give equal responses
+    def get_tag_names_compatible_with_tag_names(self, tag_names: list[str]) -> list[str]:
+        return TagIndex().get_tag_names_compatible_with_tag_names(tag_names)
 
-        for template in all_templates:
-            template_tags = template.tags.all()
-            if all([tag in template_tags for tag in input_tags]):
-                for tag in template_tags:
-                    if tag not in input_tags:
-                        compatible_tags.add(tag) 
+    def get_all_tag_names(self) -> list[str]:
+        return TagIndex().get_all_tag_names()
 
-        return list(compatible_tags)
+    def get_tag_catalogue_version(self) -> str:
+        return TagIndex().get_catalogue_version()
+    
+    # Template is matched in the tag index and loaded from the database, placement and capacity depend on its current fields
+    def find_template_with_tags(self, tags: list) -> Template:
+        template_id = TagIndex().find_template_id_with_tag_names(tags)
+        if template_id is None:
+            return None
+        return Template.objects.filter(id=template_id).first()
     
     def get_tag_names(self, tags: list[Tag]) -> list[str]:
         return [tag.name for tag in tags]
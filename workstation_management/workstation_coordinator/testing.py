@@ -0,0 +1,148 @@
+import random
+from datetime import timedelta
+
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from main_server.models import User
+from .engine_handler import EngineHandler
+from .models import EngineType, Engine, Host, Tag, Template, Workstation, ProxyMapping, Reservation, CoordinatorCommand
+
+# Tables which grow with usage, queries on them have to be served by indexes
+HOT_TABLES = {
+    Reservation._meta.db_table,
+    Workstation._meta.db_table,
+    ProxyMapping._meta.db_table,
+    CoordinatorCommand._meta.db_table,
+}
+
+
+# Builds a dataset resembling a deployment in use for a while: most reservations are finished,
+# a small part is approved, active, pending or cancelled. By default the live part grows with the dataset,
+# live_reservation_count fixes the number of reservations in each live status instead.
+def create_reservation_dataset(reservation_count: int, user_count: int = 50, engine_count: int = 4, template_count: int = 5,
+                               live_reservation_count: int = None, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    users = User.objects.bulk_create([
+        User(username=f'user-{i}', email=f'user-{i}@localhost') for i in range(user_count)
+    ])
+    engine_type = EngineType.objects.create(name='test-engine-type')
+    engines = [
+        Engine.objects.create(name=f'engine-{i}', port=8000 + i, type=engine_type,
+                              available_resources={}, max_resources={'cpu': 4096, 'memory': 8388608})
+        for i in range(engine_count)
+    ]
+    host = Host.objects.create(name='host', ip_address='127.0.0.1')
+    host.engines.set(engines)
+
+    tags = Tag.objects.bulk_create([Tag(name=f'tag-{i}') for i in range(template_count * 2)])
+    templates = []
+    for i in range(template_count):
+        template = Template.objects.create(name=f'template-{i}', internal_name=f'template-{i}', description='',
+                                           resource_requirements={'cpu': 2, 'memory': 4096})
+        template.allowed_engine_types.add(engine_type)
+        template.allowed_hosts.add(host)
+        template.tags.add(tags[i * 2], tags[i * 2 + 1])
+        templates.append(template)
+
+    live_statuses = [
+        (Reservation.Status.Approved, Workstation.Status.Scheduled, timedelta(days=1)),
+        (Reservation.Status.Active, Workstation.Status.Active, timedelta(hours=-1)),
+        (Reservation.Status.Cancelled, Workstation.Status.Archived, timedelta(days=-1)),
+    ]
+    if live_reservation_count is None:
+        pending_count = reservation_count // 1000
+        live_count = reservation_count // 100 * len(live_statuses)
+    else:
+        pending_count = live_reservation_count
+        live_count = live_reservation_count * len(live_statuses)
+    rows = []
+    for i in range(reservation_count):
+        if i < pending_count:
+            status, workstation_status = Reservation.Status.Pending, None
+            start_date = now + timedelta(days=2)
+        elif i < pending_count + live_count:
+            status, workstation_status, offset = live_statuses[(i - pending_count) % len(live_statuses)]
+            start_date = now + offset
+        else:
+            status, workstation_status = Reservation.Status.Completed, Workstation.Status.Archived
+            start_date = now - timedelta(minutes=rng.randrange(60 * 24, 60 * 24 * 365))
+        template = rng.choice(templates)
+        workstation = None
+        if workstation_status is not None:
+            workstation = Workstation(template=template, host=host, engine=rng.choice(engines), status=workstation_status,
+                                      engine_internal_name=f'vm-{i}', ip_address='10.0.0.1')
+        rows.append((status, start_date, template, workstation))
+
+    Workstation.objects.bulk_create([workstation for _, _, _, workstation in rows if workstation is not None])
+    reservations = Reservation.objects.bulk_create([
+        Reservation(status=status, request_date=start_date - timedelta(days=1), start_date=start_date,
+                    end_date=start_date + timedelta(hours=2), user=rng.choice(users), template=template,
+                    workstation=workstation, user_label=template.name)
+        for status, start_date, template, workstation in rows
+    ])
+
+    ProxyMapping.objects.bulk_create([
+        ProxyMapping(workstation_id=reservation.workstation_id, external_path=f'/novnc/{reservation.id}', archived=True)
+        for reservation in reservations if reservation.workstation_id is not None
+    ])
+    CoordinatorCommand.objects.bulk_create([
+        CoordinatorCommand(type=CoordinatorCommand.Type.Restart, status=CoordinatorCommand.Status.Done, reservation=reservation)
+        for reservation in reservations[::10]
+    ])
+    # Status update timestamps are set to now on creation, finished rows were last updated when they ended
+    Reservation.objects.filter(end_date__lt=now).update(last_status_update=F('end_date'))
+    Workstation.objects.filter(status=Workstation.Status.Archived).update(last_status_update=now - timedelta(days=1))
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+    return {
+        'users': users,
+        'engines': engines,
+        'templates': templates,
+        'tags': tags,
+        'reservations': reservations,
+    }
+
+
+# Background work is not started, only database access of the coordinator is exercised
+class EngineHandlerWithoutEngines(EngineHandler):
+    def setup_workstation_for_reservation(self, reservation, callback=None):
+        pass
+
+    def start_workstation_cleanup_for_reservation(self, reservation, callback=None):
+        pass
+
+    def restart_workstation_for_reservation(self, reservation, callback=None):
+        pass
+
+
+class QueryPlanAssertionsMixin:
+    def _get_sequential_scans(self, sql: str) -> list:
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+            plan = cursor.fetchone()[0]
+        scans = []
+        nodes = [plan[0]['Plan']]
+        while len(nodes) > 0:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in HOT_TABLES:
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans
+
+    def assertNoSequentialScans(self, queries: CaptureQueriesContext):
+        explained = 0
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            explained += 1
+            scans = self._get_sequential_scans(sql)
+            self.assertEqual(scans, [], f'Sequential scan on {scans} in query: {sql}')
+        self.assertGreater(explained, 0)
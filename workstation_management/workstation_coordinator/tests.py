@@ -1,3 +1,962 @@
-from django.test import TestCase
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .capacity_timeline import CapacityTimeline
+from .client import CoordinatorClient
+from .engine_handler import EngineHandler
+from .mapping_cache import MappingLookupCache
+from .mapping_handler import MappingHandler
+from .models import Engine, Tag, Template, Workstation, ProxyMapping, Reservation, CoordinatorCommand
+from .reservation_handler import RevervationHandler
+from .reservation_policies import EngineCandidate, ReservationPolicy, get_policy
+from .scheduler import DueActionScheduler
+from .tag_index import TagIndex
+from .template_handler import TemplateHandler
+from .sharding import MEMBERSHIP_LOCK_NAMESPACE, SHARD_LOCK_NAMESPACE, ShardManager
+from .write_batch import WriteBatch, WriteCounter
+from utils.database import release_connections, reset_pooled_connection, use_pooled_connection_reset
+from .testing import EngineHandlerWithoutEngines, QueryPlanAssertionsMixin, create_reservation_dataset
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are checked on PostgreSQL only')
+class CoordinatorQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = create_reservation_dataset(20000)
+
+    def test_tick(self):
+        reservation_handler = RevervationHandler()
+        with CaptureQueriesContext(connection) as queries:
+            reservation_handler.handle(EngineHandlerWithoutEngines())
+        self.assertNoSequentialScans(queries)
+
+    # Sync is not checked, right after creating the dataset every live reservation was updated within the sync overlap
+    def test_capacity_timeline_build(self):
+        capacity_timeline = CapacityTimeline()
+        capacity_timeline.invalidate()
+        with CaptureQueriesContext(connection) as queries:
+            capacity_timeline.get_snapshot()
+        self.assertNoSequentialScans(queries)
+
+    def test_schedule_rebuild_and_sync(self):
+        scheduler = DueActionScheduler()
+        with CaptureQueriesContext(connection) as queries:
+            scheduler.rebuild()
+            scheduler.sync()
+        self.assertNoSequentialScans(queries)
+
+    def test_orphan_lookup(self):
+        vm_names = [f'vm-{i}' for i in range(200)]
+        with CaptureQueriesContext(connection) as queries:
+            EngineHandler()._get_orphaned_vm_names(vm_names, set())
+        self.assertNoSequentialScans(queries)
+
+    def test_commands(self):
+        for reservation in self.dataset['reservations'][:3]:
+            CoordinatorCommand.objects.create(type=CoordinatorCommand.Type.Restart, reservation=reservation)
+        with CaptureQueriesContext(connection) as queries:
+            RevervationHandler().process_commands()
+        self.assertNoSequentialScans(queries)
+
+    def test_mapping_lookup(self):
+        reservation = Reservation.objects.filter(status=Reservation.Status.Active).first()
+        mapping_handler = MappingHandler()
+        mapping_handler.create_mapping_for_reservation(reservation)
+        with CaptureQueriesContext(connection) as queries:
+            mapping_handler.get_mapping_target_by_id(reservation.proxy_mapping.id)
+        self.assertNoSequentialScans(queries)
+
+
+# In-memory engine, VMs stop at once and deleting one takes delete_time seconds
+class FakeEngineClient:
+    def __init__(self, vm_names: list[str], failing_vm_names: set = frozenset(), delete_time: float = 0.0) -> None:
+        self.vm_names = set(vm_names)
+        self.failing_vm_names = failing_vm_names
+        self.delete_time = delete_time
+        self.lock = threading.Lock()
+        self.running_deletes = 0
+        self.max_running_deletes = 0
+
+    def vm_exists(self, vm_name: str) -> bool:
+        return vm_name in self.vm_names
+
+    def stop_vm(self, vm_name: str):
+        pass
+
+    def is_vm_running(self, vm_name: str) -> bool:
+        return False
+
+    def get_all_vm_names(self) -> list[str]:
+        return sorted(self.vm_names)
+
+    def delete_vm(self, vm_name: str):
+        with self.lock:
+            self.running_deletes += 1
+            self.max_running_deletes = max(self.max_running_deletes, self.running_deletes)
+        try:
+            time.sleep(self.delete_time)
+            if vm_name in self.failing_vm_names:
+                raise RuntimeError(f'Engine failed to delete {vm_name}')
+            with self.lock:
+                self.vm_names.discard(vm_name)
+        finally:
+            with self.lock:
+                self.running_deletes -= 1
+
+
+class ReservationPolicyTests(SimpleTestCase):
+    # Engines are identified by name. The template needs 2 cpu, a full engine cannot fit it
+    def _get_candidates(self) -> list[EngineCandidate]:
+        required = {'cpu': 2}
+        return [
+            EngineCandidate('full', {'cpu': 8}, {'cpu': 8}, required, 1.0),
+            EngineCandidate('half', {'cpu': 4}, {'cpu': 8}, required, 30.0),
+            EngineCandidate('busy', {'cpu': 6}, {'cpu': 8}, required, 20.0),
+            EngineCandidate('empty', {}, {'cpu': 8}, required, 10.0),
+        ]
+
+    def _select(self, name: str) -> str:
+        return get_policy(name).select_engine(self._get_candidates()).engine
+
+    def test_first_fit(self):
+        self.assertEqual(self._select(Template.PlacementPolicy.FirstFit), 'half')
+
+    def test_best_fit(self):
+        self.assertEqual(self._select(Template.PlacementPolicy.BestFit), 'busy')
+
+    def test_spread(self):
+        self.assertEqual(self._select(Template.PlacementPolicy.Spread), 'empty')
+
+    def test_latency_aware(self):
+        self.assertEqual(self._select(Template.PlacementPolicy.LatencyAware), 'empty')
+
+    # Engines without a measured setup time are tried first
+    def test_latency_aware_prefers_unmeasured(self):
+        candidates = self._get_candidates()
+        candidates[1].average_setup_time = None
+        self.assertEqual(get_policy(Template.PlacementPolicy.LatencyAware).select_engine(candidates).engine, 'half')
+
+    def test_nothing_fits(self):
+        candidates = [EngineCandidate('full', {'cpu': 8}, {'cpu': 8}, {'cpu': 2})]
+        for name in Template.PlacementPolicy.values:
+            with self.subTest(policy=name):
+                self.assertIsNone(get_policy(name).select_engine(candidates))
+
+    def test_unknown_policy_falls_back_to_first_fit(self):
+        self.assertEqual(get_policy('unknown').name, Template.PlacementPolicy.FirstFit)
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            ReservationPolicy()
+
+
+class DueActionSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = DueActionScheduler()
+        self.now = timezone.now()
+
+    def _at(self, minutes: int):
+        return self.now + timedelta(minutes=minutes)
+
+    def test_due_in_date_order(self):
+        for reservation_id, minutes in [('c', 30), ('a', 10), ('b', 20), ('d', 40)]:
+            self.scheduler.schedule(reservation_id, self._at(minutes))
+        self.assertEqual(self.scheduler.get_next_due_date(), self._at(10))
+        self.assertEqual(self.scheduler.pop_due(self._at(30)), ['a', 'b', 'c'])
+        self.assertEqual(self.scheduler.pop_due(self._at(30)), [])
+        self.assertEqual(self.scheduler.get_next_due_date(), self._at(40))
+
+    # Earlier heap entries of a rescheduled reservation are skipped, so it is due once at its latest date
+    def test_rescheduled(self):
+        self.scheduler.schedule('a', self._at(10))
+        self.scheduler.schedule('a', self._at(30))
+        self.scheduler.schedule('b', self._at(20))
+        self.scheduler.schedule('b', self._at(5))
+        self.assertEqual(self.scheduler.get_next_due_date(), self._at(5))
+        self.assertEqual(self.scheduler.pop_due(self._at(20)), ['b'])
+        self.assertEqual(self.scheduler.pop_due(self._at(40)), ['a'])
+
+    def test_same_date_scheduled_once(self):
+        self.scheduler.schedule('a', self._at(10))
+        self.scheduler.schedule('a', self._at(10))
+        self.assertEqual(len(self.scheduler.heap), 1)
+        self.assertEqual(self.scheduler.pop_due(self._at(10)), ['a'])
+
+    def test_unscheduled(self):
+        self.scheduler.schedule('a', self._at(10))
+        self.scheduler.schedule('b', self._at(20))
+        self.scheduler.unschedule('a')
+        self.assertEqual(self.scheduler.get_next_due_date(), self._at(20))
+        self.assertEqual(self.scheduler.pop_due(self._at(20)), ['b'])
+        self.assertIsNone(self.scheduler.get_next_due_date())
+
+    def test_schedule_reservation_by_status(self):
+        reservation = SimpleNamespace(id='a', status=Reservation.Status.Approved, start_date=self._at(10), end_date=self._at(20))
+        self.scheduler.schedule_reservation(reservation)
+        self.assertEqual(self.scheduler.due_dates, {'a': self._at(10)})
+        reservation.status = Reservation.Status.Active
+        self.scheduler.schedule_reservation(reservation)
+        self.assertEqual(self.scheduler.due_dates, {'a': self._at(20)})
+        reservation.status = Reservation.Status.Cancelled
+        self.scheduler.schedule_reservation(reservation)
+        self.assertEqual(self.scheduler.due_dates, {})
+
+    def test_reservations_of_other_coordinators_not_scheduled(self):
+        scheduler = DueActionScheduler(lambda reservation_id: reservation_id != 'b')
+        for reservation_id in ['a', 'b']:
+            scheduler.schedule_reservation(SimpleNamespace(id=reservation_id, status=Reservation.Status.Approved,
+                                                           start_date=self._at(10), end_date=self._at(20)))
+        self.assertEqual(scheduler.pop_due(self._at(10)), ['a'])
+
+    def test_wakes_when_earliest_changes(self):
+        self.scheduler.schedule('a', self._at(10))
+        self.scheduler.wait(0)
+        self.scheduler.schedule('b', self._at(20))
+        self.assertFalse(self.scheduler.wake_event.is_set())
+        self.scheduler.schedule('c', self._at(5))
+        self.assertTrue(self.scheduler.wake_event.is_set())
+
+
+@override_settings(STATUS_EVENTS_ENABLED=False)
+class DueActionSchedulerSyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=1)
+
+    def setUp(self):
+        self.scheduler = DueActionScheduler()
+        self.scheduler.rebuild()
+        self.reservation = Reservation.objects.filter(status=Reservation.Status.Pending).first()
+
+    def test_changes_picked_up(self):
+        self.assertNotIn(self.reservation.id, self.scheduler.due_dates)
+        self.reservation.set_reservation_status(Reservation.Status.Approved)
+        self.scheduler.sync()
+        self.assertEqual(self.scheduler.due_dates[self.reservation.id], self.reservation.start_date)
+
+    # Rows stay inside SYNC_OVERLAP for several syncs, a version already applied must not schedule a popped action again
+    def test_applied_once_within_overlap(self):
+        self.reservation.set_reservation_status(Reservation.Status.Approved)
+        self.scheduler.sync()
+        self.assertIn(self.reservation.id, self.scheduler.pop_due(self.reservation.start_date))
+        self.scheduler.sync()
+        self.assertNotIn(self.reservation.id, self.scheduler.due_dates)
+
+        self.reservation.set_reservation_status(Reservation.Status.Active)
+        self.scheduler.sync()
+        self.assertEqual(self.scheduler.due_dates[self.reservation.id], self.reservation.end_date)
+
+
+@override_settings(COORDINATOR_SHARDING=True)
+class ShardPartitionTests(SimpleTestCase):
+    def test_each_reservation_owned_once(self):
+        reservation_ids = [uuid.uuid4() for _ in range(500)]
+        for shard_count in [1, 4, 64]:
+            with self.subTest(shard_count=shard_count), override_settings(COORDINATOR_SHARD_COUNT=shard_count):
+                shard_managers = [ShardManager() for _ in range(3)]
+                for shard in range(shard_count):
+                    shard_managers[shard % 3].owned_shards.add(shard)
+                for reservation_id in reservation_ids:
+                    owners = [shard_manager for shard_manager in shard_managers if shard_manager.owns(reservation_id)]
+                    self.assertEqual(len(owners), 1)
+                    self.assertLess(owners[0].get_shard(reservation_id), shard_count)
+
+    @override_settings(COORDINATOR_SHARDING=False)
+    def test_disabled_owns_everything(self):
+        shard_manager = ShardManager()
+        self.assertTrue(shard_manager.is_leader)
+        self.assertTrue(all([shard_manager.owns(uuid.uuid4()) for _ in range(10)]))
+        self.assertFalse(shard_manager.rebalance(set()))
+
+
+# Session level advisory locks survive the rollback of the test transaction, they are released in tearDown.
+# Another coordinator is simulated with a second database connection
+@skipUnless(connection.vendor == 'postgresql', 'Shards are owned through PostgreSQL advisory locks')
+@override_settings(COORDINATOR_SHARDING=True, COORDINATOR_SHARD_COUNT=8)
+class ShardLockTests(TestCase):
+    def setUp(self):
+        self.other_connection = connections.create_connection('default')
+
+    def tearDown(self):
+        for database_connection in [connection, self.other_connection]:
+            with database_connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock_all()')
+        self.other_connection.close()
+
+    def _fetch(self, database_connection, sql: str, params: list = None):
+        with database_connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def _get_locked_shards(self) -> set:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT objid FROM pg_locks WHERE locktype = 'advisory' AND classid = %s AND granted AND pid = pg_backend_pid()",
+                           [SHARD_LOCK_NAMESPACE])
+            return {row[0] for row in cursor.fetchall()}
+
+    def _join_other_coordinator(self):
+        other_pid = self._fetch(self.other_connection, 'SELECT pg_backend_pid()')
+        self._fetch(self.other_connection, 'SELECT pg_advisory_lock(%s, %s)', [MEMBERSHIP_LOCK_NAMESPACE, other_pid])
+
+    def test_single_coordinator_owns_all_shards(self):
+        shard_manager = ShardManager()
+        self.assertTrue(shard_manager.rebalance(set()))
+        self.assertEqual(shard_manager.owned_shards, set(range(8)))
+        self.assertEqual(self._get_locked_shards(), set(range(8)))
+        self.assertTrue(shard_manager.is_leader)
+        self.assertFalse(shard_manager.rebalance(set()))
+
+    def test_shards_released_when_coordinator_joins(self):
+        shard_manager = ShardManager()
+        shard_manager.rebalance(set())
+        self._join_other_coordinator()
+        self.assertTrue(shard_manager.rebalance(set()))
+        self.assertEqual(len(shard_manager.owned_shards), 4)
+        self.assertEqual(self._get_locked_shards(), shard_manager.owned_shards)
+
+    # Shard 7 keeps background work running, so it stays even though it would be released first
+    def test_busy_shards_kept(self):
+        shard_manager = ShardManager()
+        shard_manager.rebalance(set())
+        self._join_other_coordinator()
+        shard_manager.rebalance({7})
+        self.assertIn(7, shard_manager.owned_shards)
+        self.assertEqual(len(shard_manager.owned_shards), 4)
+
+    def test_shards_of_other_coordinator_not_taken(self):
+        self._join_other_coordinator()
+        for shard in [0, 1, 2, 3]:
+            self._fetch(self.other_connection, 'SELECT pg_advisory_lock(%s, %s)', [SHARD_LOCK_NAMESPACE, shard])
+        shard_manager = ShardManager()
+        shard_manager.rebalance(set())
+        self.assertEqual(shard_manager.owned_shards, {4, 5, 6, 7})
+        self.assertTrue(all([shard_manager.owns(reservation_id) == (shard_manager.get_shard(reservation_id) >= 4)
+                             for reservation_id in [uuid.uuid4() for _ in range(50)]]))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Advisory locks are specific to PostgreSQL')
+class DatabaseConnectionTests(TestCase):
+    def test_reset_releases_session_state(self):
+        raw_connection = connection.get_new_connection(connection.get_connection_params())
+        try:
+            raw_connection.execute('SELECT pg_advisory_lock(%s, %s)', [SHARD_LOCK_NAMESPACE, 0])
+            raw_pid = raw_connection.info.backend_pid
+            reset_pooled_connection(raw_connection)
+            self.assertEqual(raw_connection.info.transaction_status, raw_connection.info.transaction_status.IDLE)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = %s", [raw_pid])
+                self.assertEqual(cursor.fetchone()[0], 0)
+        finally:
+            raw_connection.close()
+
+    def test_reset_added_only_to_pool(self):
+        with mock.patch.dict(settings.DATABASES['default'], {'OPTIONS': {'pool': {'max_size': 2}}}):
+            use_pooled_connection_reset()
+            self.assertIs(settings.DATABASES['default']['OPTIONS']['pool']['reset'], reset_pooled_connection)
+        with mock.patch.dict(settings.DATABASES['default'], {'OPTIONS': {}}):
+            use_pooled_connection_reset()
+            self.assertEqual(settings.DATABASES['default']['OPTIONS'], {})
+
+    # Runs in its own thread, connections are per thread and the one of the test must stay open
+    def test_release_connections_closes_thread_connections(self):
+        result = {}
+
+        def use_database():
+            list(Engine.objects.all())
+            result['opened'] = connection.connection is not None
+            release_connections()
+            result['closed'] = connection.connection is None
+
+        thread = threading.Thread(target=use_database)
+        thread.start()
+        thread.join()
+        self.assertEqual(result, {'opened': True, 'closed': True})
+        self.assertIsNotNone(connection.connection)
+
+
+class TeardownTests(SimpleTestCase):
+    @override_settings(VM_TEARDOWN_CONCURRENCY=3)
+    def test_concurrency_limited_per_engine(self):
+        engine_handler = EngineHandler()
+        vm_names_by_engine = {engine_id: [f'vm-{engine_id}-{i}' for i in range(10)] for engine_id in [1, 2]}
+        for engine_id, vm_names in vm_names_by_engine.items():
+            engine_handler.clients[engine_id] = FakeEngineClient(vm_names, delete_time=0.02)
+
+        progress = engine_handler.teardown_vms(vm_names_by_engine)
+        self.assertEqual((progress.total, progress.deleted, progress.failed), (20, 20, 0))
+        for client in engine_handler.clients.values():
+            self.assertEqual(client.vm_names, set())
+            self.assertEqual(client.max_running_deletes, 3)
+
+    # VMs which do not exist anymore count as deleted, without being stopped
+    def test_failures_counted(self):
+        engine_handler = EngineHandler()
+        engine_handler.clients[1] = FakeEngineClient(['a', 'b', 'c', 'd', 'e'], failing_vm_names={'d', 'e'})
+
+        progress = engine_handler.teardown_vms({1: ['a', 'b', 'c', 'd', 'e', 'missing']})
+        self.assertEqual((progress.total, progress.stopped, progress.deleted, progress.failed), (6, 5, 4, 2))
+        self.assertEqual(engine_handler.clients[1].vm_names, {'d', 'e'})
+
+    def _run_cleanup(self, client: FakeEngineClient) -> mock.Mock:
+        engine_handler = EngineHandler()
+        engine_handler.clients[1] = client
+        reservation = SimpleNamespace(id=uuid.uuid4(), workstation=SimpleNamespace(engine=SimpleNamespace(id=1), engine_internal_name='vm'))
+        callback = mock.Mock()
+        with mock.patch('threading.excepthook'):
+            engine_handler.start_workstation_cleanup_for_reservation(reservation, callback)
+            engine_handler.cleanup_threads[reservation.id].join()
+        return callback
+
+    def test_cleanup_callback(self):
+        self._run_cleanup(FakeEngineClient(['vm'])).assert_called_once()
+
+    # Workstation is not archived while its VM may still exist
+    def test_failed_cleanup_skips_callback(self):
+        self._run_cleanup(FakeEngineClient(['vm'], failing_vm_names={'vm'})).assert_not_called()
+
+
+class OrphanedVmTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=2)
+        cls.live_vm_names = list(Reservation.objects.filter(status=Reservation.Status.Active)
+                                 .values_list('workstation__engine_internal_name', flat=True))
+        cls.finished_vm_names = list(Reservation.objects.filter(status=Reservation.Status.Completed)
+                                     .values_list('workstation__engine_internal_name', flat=True)[:2])
+        # Approved reservation whose VM is being created
+        approved = Reservation.objects.filter(status=Reservation.Status.Approved).select_related('workstation').first()
+        approved.workstation.set_workstation_status(Workstation.Status.Setup)
+        cls.setup_vm_name = approved.workstation.engine_internal_name
+
+    def test_orphaned_vm_names(self):
+        vm_names = self.live_vm_names + self.finished_vm_names + [self.setup_vm_name, 'unknown', 'being-created']
+        orphaned_vm_names = EngineHandler()._get_orphaned_vm_names(vm_names, {'being-created'})
+        self.assertEqual(orphaned_vm_names, self.finished_vm_names + ['unknown'])
+
+    def test_cancelled_reservation_vm_orphaned(self):
+        reservation = Reservation.objects.filter(workstation__engine_internal_name=self.live_vm_names[0]).get()
+        reservation.set_reservation_status(Reservation.Status.Cancelled)
+        self.assertEqual(EngineHandler()._get_orphaned_vm_names(self.live_vm_names, set()), self.live_vm_names[:1])
+
+    # Names of VMs being set up are taken when the sweep starts, the main loop may change setup_threads later
+    def test_sweep_skips_vms_in_setup(self):
+        engine_handler = EngineHandler()
+        engine_handler.setup_threads[uuid.uuid4()] = (None, 'being-created')
+        with mock.patch.object(engine_handler, '_clean_orphaned_workstations') as clean_orphaned_workstations:
+            engine_handler.start_orphan_sweep()
+            engine_handler.orphan_sweep_thread.join()
+        clean_orphaned_workstations.assert_called_once_with({'being-created'})
+
+
+@override_settings(STATUS_EVENTS_ENABLED=False)
+class WriteBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(20, live_reservation_count=3)
+
+    def setUp(self):
+        self.active = list(Reservation.objects.filter(status=Reservation.Status.Active).select_related('workstation'))
+        self.approved = list(Reservation.objects.filter(status=Reservation.Status.Approved))
+
+    def _flush(self, batch: WriteBatch) -> WriteCounter:
+        write_counter = WriteCounter()
+        with connection.execute_wrapper(write_counter):
+            batch.flush()
+        return write_counter
+
+    # One UPDATE per model, expected and new status, and one per model and updated field set
+    def test_writes_grouped(self):
+        batch = WriteBatch()
+        for reservation in self.active:
+            batch.set_status(reservation, Reservation.Status.Completed)
+        for reservation in self.approved:
+            batch.set_status(reservation, Reservation.Status.Cancelled)
+        for reservation in self.active:
+            reservation.workstation.ip_address = '10.0.0.2'
+            batch.update_fields(reservation.workstation, 'ip_address')
+        self.assertEqual(len(batch), 9)
+
+        write_counter = self._flush(batch)
+        self.assertEqual(write_counter.count, 3)
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(Reservation.objects.filter(id__in=[r.id for r in self.active], status=Reservation.Status.Completed).count(), 3)
+        self.assertEqual(Reservation.objects.filter(id__in=[r.id for r in self.approved], status=Reservation.Status.Cancelled).count(), 3)
+        self.assertEqual(Workstation.objects.filter(ip_address='10.0.0.2').count(), 3)
+        self.assertTrue(all([reservation.status == Reservation.Status.Completed for reservation in self.active]))
+
+    # Reservation was cancelled by another process after it was read
+    def test_expected_status_mismatch_skipped(self):
+        changed = self.active[0]
+        changed.set_reservation_status(Reservation.Status.Cancelled)
+        changed.status = Reservation.Status.Active
+        batch = WriteBatch()
+        results = {}
+        for reservation in self.active:
+            batch.set_status(reservation, Reservation.Status.Completed,
+                             on_success=lambda reservation=reservation: results.__setitem__(reservation.id, True),
+                             on_failure=lambda reservation=reservation: results.__setitem__(reservation.id, False))
+
+        self._flush(batch)
+        self.assertEqual(results, {reservation.id: reservation is not changed for reservation in self.active})
+        self.assertEqual(changed.status, Reservation.Status.Active)
+        changed.refresh_from_db()
+        self.assertEqual(changed.status, Reservation.Status.Cancelled)
+
+    def test_empty_batch_writes_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self._flush(WriteBatch()).count, 0)
+
+    def test_counter_counts_writes_only(self):
+        write_counter = WriteCounter()
+        with connection.execute_wrapper(write_counter):
+            list(Reservation.objects.all())
+            Reservation.objects.filter(id=self.active[0].id).update(user_label='label')
+            CoordinatorCommand.objects.create(type=CoordinatorCommand.Type.Restart, reservation=self.active[0])
+            CoordinatorCommand.objects.all().delete()
+        self.assertEqual(write_counter.count, 3)
+
+
+class TemplateResourceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = create_reservation_dataset(300, template_count=3)
+        templates = cls.dataset['templates']
+        templates[1].resource_requirements = {'cpu': 4, 'memory': 8192, 'gpu': 1}
+        templates[1].save()
+        templates[2].resource_requirements = {'cpu': '1'}
+        templates[2].save()
+
+    def _get_rows(self, template: Template) -> dict:
+        return dict(template.resources.values_list('name', 'amount'))
+
+    def test_rows_follow_requirements(self):
+        template = self.dataset['templates'][0]
+        self.assertEqual(self._get_rows(template), {'cpu': 2, 'memory': 4096})
+        template.resource_requirements = {'cpu': 8, 'gpu': '2'}
+        template.save()
+        self.assertEqual(self._get_rows(template), {'cpu': 8, 'gpu': 2})
+
+    # Per reservation sum done in Python before the load was aggregated in the database
+    def _get_load_by_engine_in_python(self, reservations) -> dict:
+        load_by_engine = {}
+        for reservation in EngineHandler()._get_reservations_with_engine(reservations).select_related('workstation', 'template'):
+            load = load_by_engine.setdefault(reservation.workstation.engine_id, {})
+            for key, value in reservation.template.resource_requirements.items():
+                load[key] = load.get(key, 0) + int(value)
+        return load_by_engine
+
+    def test_aggregate_matches_python_sum(self):
+        querysets = {
+            'all': Reservation.objects.all(),
+            'template': Reservation.objects.filter(template=self.dataset['templates'][1]),
+        }
+        for name, reservations in querysets.items():
+            with self.subTest(reservations=name):
+                load_by_engine = EngineHandler()._get_load_by_engine(reservations)
+                self.assertNotEqual(load_by_engine, {})
+                self.assertEqual(load_by_engine, self._get_load_by_engine_in_python(reservations))
+
+
+@override_settings(STATUS_EVENTS_ENABLED=False)
+class TagIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        cls.tags = Tag.objects.bulk_create([Tag(name=f'tag-{i}') for i in range(20)])
+        for i in range(30):
+            template = Template.objects.create(name=f'template-{i}', internal_name=f'template-{i}', description='',
+                                               resource_requirements={'cpu': 2})
+            template.tags.set(rng.sample(cls.tags, rng.randint(1, 5)))
+
+    def setUp(self):
+        TagIndex().invalidate()
+
+    # Per template loop the index replaced
+    def _get_compatible_tags_by_loop(self, input_tags: list[Tag]) -> set:
+        compatible_tags = set()
+        for template in Template.objects.prefetch_related('tags'):
+            template_tags = template.tags.all()
+            if all([tag in template_tags for tag in input_tags]):
+                compatible_tags.update([tag for tag in template_tags if tag not in input_tags])
+        return compatible_tags
+
+    def _find_template_by_loop(self, tag_names: list[str]) -> Template:
+        for template in Template.objects.prefetch_related('tags'):
+            if all([name in [tag.name for tag in template.tags.all()] for name in tag_names]):
+                return template
+        return None
+
+    def test_lookups_match_template_loop(self):
+        rng = random.Random(1)
+        selections = [[]] + [rng.sample(self.tags, rng.randint(1, 3)) for _ in range(50)]
+        for selection in selections:
+            names = [tag.name for tag in selection]
+            with self.subTest(names=names):
+                expected = self._get_compatible_tags_by_loop(selection)
+                self.assertEqual(set(TagIndex().get_tags_compatible_with_tags(selection)), expected)
+                self.assertEqual(TagIndex().get_tag_names_compatible_with_tag_names(names), sorted([tag.name for tag in expected]))
+                self.assertEqual(TemplateHandler().find_template_with_tags(names), self._find_template_by_loop(names))
+
+    def test_lookups_without_queries(self):
+        TagIndex().get_snapshot()
+        with self.assertNumQueries(0):
+            TagIndex().get_tags_compatible_with_tags(self.tags[:2])
+            TagIndex().get_tag_names_compatible_with_tag_names(['tag-0'])
+
+    def test_signals_invalidate_index(self):
+        snapshot = TagIndex().get_snapshot()
+        tag = Tag.objects.create(name='new-tag')
+        self.assertIsNot(TagIndex().get_snapshot(), snapshot)
+        snapshot = TagIndex().get_snapshot()
+        template = Template.objects.get(name='template-0')
+        template.tags.add(tag)
+        self.assertIsNot(TagIndex().get_snapshot(), snapshot)
+        self.assertIn('new-tag', TagIndex().get_tag_names_compatible_with_tag_names([template.tags.exclude(id=tag.id).first().name]))
+        snapshot = TagIndex().get_snapshot()
+        template.delete()
+        self.assertIsNot(TagIndex().get_snapshot(), snapshot)
+        self.assertIsNone(TagIndex().find_template_id_with_tag_names(['new-tag']))
+
+    # Edits made by other processes do not reach this index through signals, the template is loaded with its current fields
+    def test_template_loaded_with_current_fields(self):
+        template = Template.objects.get(name='template-0')
+        tag_names = [tag.name for tag in template.tags.all()]
+        TagIndex().get_snapshot()
+        Template.objects.filter(id=template.id).update(resource_requirements={'cpu': 8})
+        found = TemplateHandler().find_template_with_tags(tag_names)
+        self.assertEqual(found.resource_requirements, {'cpu': 8})
+        self.assertIsNot(TemplateHandler().find_template_with_tags(tag_names), found)
+
+    # A rebuild between the change and the commit, as another thread could do, is discarded on commit
+    def test_rebuilt_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Template.objects.get(name='template-0').tags.add(Tag.objects.create(name='new-tag'))
+            snapshot_before_commit = TagIndex().get_snapshot()
+        snapshot = TagIndex().get_snapshot()
+        self.assertIsNot(snapshot, snapshot_before_commit)
+        self.assertIs(TagIndex().get_snapshot(), snapshot)
+
+
+class StatusTransitionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=1)
+
+    def setUp(self):
+        self.reservation = Reservation.objects.filter(status=Reservation.Status.Pending).first()
+        self.workstation = Workstation.objects.filter(status=Workstation.Status.Active).first()
+
+    def test_fields_written_with_status(self):
+        last_status_update = self.reservation.last_status_update
+        self.assertTrue(self.reservation.set_reservation_status(Reservation.Status.Approved, workstation=self.workstation))
+        self.assertEqual(self.reservation.workstation, self.workstation)
+        self.assertGreater(self.reservation.last_status_update, last_status_update)
+        stored = Reservation.objects.get(id=self.reservation.id)
+        self.assertEqual((stored.status, stored.workstation_id, stored.last_status_update),
+                         (Reservation.Status.Approved, self.workstation.id, self.reservation.last_status_update))
+
+    # Another process rejected the reservation after this one read it
+    def test_reservation_lost_race(self):
+        Reservation.objects.filter(id=self.reservation.id).update(status=Reservation.Status.Rejected)
+        self.assertFalse(self.reservation.set_reservation_status(Reservation.Status.Approved, workstation=self.workstation))
+        self.assertEqual(self.reservation.status, Reservation.Status.Pending)
+        self.assertIsNone(self.reservation.workstation)
+        stored = Reservation.objects.get(id=self.reservation.id)
+        self.assertEqual((stored.status, stored.workstation_id), (Reservation.Status.Rejected, None))
+
+    def test_workstation_expected_status(self):
+        self.assertFalse(self.workstation.set_workstation_status(Workstation.Status.Active, Workstation.Status.Setup, ip_address='10.0.0.2'))
+        self.assertEqual(self.workstation.ip_address, '10.0.0.1')
+        self.assertTrue(self.workstation.set_workstation_status(Workstation.Status.Restart, Workstation.Status.Active, ip_address='10.0.0.2'))
+        stored = Workstation.objects.get(id=self.workstation.id)
+        self.assertEqual((stored.status, stored.ip_address), (Workstation.Status.Restart, '10.0.0.2'))
+
+
+class CoordinatorCommandTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=2)
+        cls.approved = list(Reservation.objects.filter(status=Reservation.Status.Approved).select_related('workstation'))
+        cls.active = list(Reservation.objects.filter(status=Reservation.Status.Active).select_related('workstation'))
+
+    def _send(self, command_type, reservation) -> CoordinatorCommand:
+        return CoordinatorCommand.objects.create(type=command_type, reservation=reservation)
+
+    def _get_status(self, command: CoordinatorCommand) -> str:
+        command.refresh_from_db()
+        return command.status
+
+    def test_cancel_and_restart(self):
+        cancel = self._send(CoordinatorCommand.Type.Cancel, self.approved[0])
+        restart = self._send(CoordinatorCommand.Type.Restart, self.active[0])
+        RevervationHandler().process_commands()
+
+        self.assertEqual(self._get_status(cancel), CoordinatorCommand.Status.Done)
+        self.assertEqual(self._get_status(restart), CoordinatorCommand.Status.Done)
+        self.approved[0].refresh_from_db()
+        self.active[0].workstation.refresh_from_db()
+        self.assertEqual(self.approved[0].status, Reservation.Status.Cancelled)
+        self.assertEqual(self.active[0].workstation.status, Workstation.Status.Restart)
+
+    def test_cancel_finished_reservation_fails(self):
+        self.approved[0].set_reservation_status(Reservation.Status.Completed)
+        command = self._send(CoordinatorCommand.Type.Cancel, self.approved[0])
+        RevervationHandler().process_commands()
+        self.assertEqual(self._get_status(command), CoordinatorCommand.Status.Failed)
+
+    # Another writer changes the status after the command was read, the conditional update then matches no row
+    def test_status_changed_after_command_read(self):
+        set_reservation_status = Reservation.set_reservation_status
+        set_workstation_status = Workstation.set_workstation_status
+
+        def set_reservation_status_after_change(reservation, *args, **kwargs):
+            Reservation.objects.filter(id=reservation.id).update(status=Reservation.Status.Active)
+            return set_reservation_status(reservation, *args, **kwargs)
+
+        def set_workstation_status_after_change(workstation, *args, **kwargs):
+            Workstation.objects.filter(id=workstation.id).update(status=Workstation.Status.Cleanup)
+            return set_workstation_status(workstation, *args, **kwargs)
+
+        cancel = self._send(CoordinatorCommand.Type.Cancel, self.approved[0])
+        restart = self._send(CoordinatorCommand.Type.Restart, self.active[0])
+        reservation_handler = RevervationHandler()
+        with mock.patch.object(Reservation, 'set_reservation_status', set_reservation_status_after_change), \
+                mock.patch.object(Workstation, 'set_workstation_status', set_workstation_status_after_change), \
+                mock.patch.object(reservation_handler.scheduler, 'unschedule') as unschedule:
+            reservation_handler.process_commands()
+
+        self.assertEqual(self._get_status(cancel), CoordinatorCommand.Status.Failed)
+        self.assertEqual(self._get_status(restart), CoordinatorCommand.Status.Failed)
+        unschedule.assert_not_called()
+        self.approved[0].refresh_from_db()
+        self.active[0].workstation.refresh_from_db()
+        self.assertEqual(self.approved[0].status, Reservation.Status.Active)
+        self.assertEqual(self.active[0].workstation.status, Workstation.Status.Cleanup)
+
+    # Division by zero aborts the transaction on PostgreSQL, commands after it are still applied
+    def test_database_error_fails_only_its_command(self):
+        def set_workstation_status(*args, **kwargs):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1 / 0')
+
+        failing = self._send(CoordinatorCommand.Type.Restart, self.active[0])
+        cancel = self._send(CoordinatorCommand.Type.Cancel, self.approved[0])
+        with mock.patch.object(Workstation, 'set_workstation_status', set_workstation_status):
+            RevervationHandler().process_commands()
+
+        self.assertEqual(self._get_status(failing), CoordinatorCommand.Status.Failed)
+        self.assertEqual(self._get_status(cancel), CoordinatorCommand.Status.Done)
+
+    def test_commands_of_other_shards_skipped(self):
+        reservation_handler = RevervationHandler()
+        shard_manager = reservation_handler.shard_manager
+        shard_manager.shard_count = 2
+        shard_manager.owned_shards = {0}
+        commands = [self._send(CoordinatorCommand.Type.Cancel, reservation) for reservation in self.approved]
+        reservation_handler.process_commands()
+
+        for command in commands:
+            owned = shard_manager.get_shard(command.reservation_id) == 0
+            expected = CoordinatorCommand.Status.Done if owned else CoordinatorCommand.Status.Pending
+            self.assertEqual(self._get_status(command), expected)
+
+
+class MappingLookupCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_reservation_dataset(10, live_reservation_count=2)
+        cls.reservations = list(Reservation.objects.filter(status=Reservation.Status.Active).select_related('workstation'))
+        for reservation in cls.reservations:
+            reservation.workstation.port = 5901
+            reservation.workstation.save(update_fields=['port'])
+
+    def setUp(self):
+        self.mapping_handler = MappingHandler()
+        for reservation in self.reservations:
+            self.mapping_handler.create_mapping_for_reservation(reservation)
+
+    def tearDown(self):
+        MappingLookupCache().entries.clear()
+
+    def test_lookups_served_from_cache(self):
+        mapping_id = str(self.reservations[0].proxy_mapping.id)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), '10.0.0.1:5901')
+        self.assertTrue(ProxyMapping.objects.get(id=mapping_id).looked_up)
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), f'/novnc/{mapping_id}')
+
+    # Another process has an empty cache, the claim written to the database is what it sees
+    def test_looked_up_once_across_processes(self):
+        mapping_id = str(self.reservations[0].proxy_mapping.id)
+        self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), '10.0.0.1:5901')
+        MappingLookupCache().entries.clear()
+        self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), f'/novnc/{mapping_id}')
+
+    # The mapping was read as not looked up, but another process claimed it before this one
+    def test_lost_claim(self):
+        mapping = self.reservations[0].proxy_mapping
+        mapping_id = str(mapping.id)
+        stale_mapping = ProxyMapping.objects.select_related('workstation').get(id=mapping_id)
+        ProxyMapping.objects.filter(id=mapping_id).update(looked_up=True)
+        with mock.patch.object(ProxyMapping.objects, 'select_related') as select_related:
+            select_related.return_value.filter.return_value.first.return_value = stale_mapping
+            self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), f'/novnc/{mapping_id}')
+
+    def test_archived_mapping(self):
+        reservation = self.reservations[0]
+        mapping_id = str(reservation.proxy_mapping.id)
+        self.mapping_handler.get_mapping_target_by_id(mapping_id)
+        self.mapping_handler.archive_mapping_for_reservation_if_exists(reservation)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.mapping_handler.get_mapping_target_by_id(mapping_id), '')
+
+    def test_unknown_mapping(self):
+        self.assertEqual(self.mapping_handler.get_mapping_target_by_id('not-a-mapping'), '')
+
+
+# The only engine has room for a single reservation of the template at a time
+class SynchronousAdmissionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        dataset = create_reservation_dataset(0, engine_count=1, template_count=1)
+        cls.user = dataset['users'][0]
+        cls.engine = dataset['engines'][0]
+        cls.engine.max_resources = {'cpu': 2, 'memory': 4096}
+        cls.engine.save(update_fields=['max_resources'])
+        cls.tags = [dataset['tags'][0].name]
+
+    def _create_reservation(self, start_date) -> Reservation:
+        return CoordinatorClient().create_reservation(self.user, self.tags, start_date, start_date + timedelta(hours=1), '')
+
+    @override_settings(SYNCHRONOUS_ADMISSION=False)
+    def test_left_pending_for_coordinator(self):
+        reservation = self._create_reservation(timezone.now() + timedelta(days=1))
+        self.assertEqual(reservation.status, Reservation.Status.Pending)
+
+    @override_settings(SYNCHRONOUS_ADMISSION=True)
+    def test_approved_and_rejected_in_request(self):
+        start_date = timezone.now() + timedelta(days=1)
+        approved = self._create_reservation(start_date)
+        rejected = self._create_reservation(start_date + timedelta(minutes=30))
+        later = self._create_reservation(start_date + timedelta(hours=2))
+
+        approved.refresh_from_db()
+        rejected.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual(approved.status, Reservation.Status.Approved)
+        self.assertEqual(approved.workstation.engine, self.engine)
+        self.assertEqual(approved.workstation.status, Workstation.Status.Scheduled)
+        self.assertEqual(rejected.status, Reservation.Status.Rejected)
+        self.assertIsNone(rejected.workstation)
+        self.assertEqual(later.status, Reservation.Status.Approved)
+
+    @override_settings(SYNCHRONOUS_ADMISSION=True)
+    def test_not_admitted_again_by_coordinator(self):
+        reservation = self._create_reservation(timezone.now() + timedelta(days=1))
+        reservation_handler = RevervationHandler()
+        reservation_handler.handle(EngineHandlerWithoutEngines())
+        reservation.refresh_from_db()
+        self.assertEqual(reservation.status, Reservation.Status.Approved)
+        self.assertEqual(Workstation.objects.count(), 1)
+        self.assertIn(reservation.id, reservation_handler.scheduler.due_dates)
+
+
+@override_settings(AVAILABILITY_BUCKET_MINUTES=60, AVAILABILITY_MAX_DAYS=2, SYNCHRONOUS_ADMISSION=True)
+class CapacityTimelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        dataset = create_reservation_dataset(0, engine_count=2, template_count=1)
+        cls.user = dataset['users'][0]
+        for engine in dataset['engines']:
+            engine.max_resources = {'cpu': 2, 'memory': 4096}
+            engine.save(update_fields=['max_resources'])
+        cls.tags = [dataset['tags'][0].name]
+
+    def setUp(self):
+        self.client = CoordinatorClient()
+        CapacityTimeline().invalidate()
+        self.origin = CapacityTimeline().get_snapshot().origin
+
+    def _create_reservation(self, first_bucket: int, last_bucket: int) -> Reservation:
+        start_date = self.origin + timedelta(hours=first_bucket)
+        end_date = self.origin + timedelta(hours=last_bucket + 1)
+        return self.client.create_reservation(self.user, self.tags, start_date, end_date, '')
+
+    def test_free_slots(self):
+        availability = self.client.get_availability_for_tags(self.tags, 1)
+        self.assertEqual(availability['template'], 'template-0')
+        self.assertEqual(availability['free'], [2] * 24)
+
+        self._create_reservation(2, 4)
+        self._create_reservation(4, 5)
+        free = self.client.get_availability_for_tags(self.tags, 1)['free']
+        self.assertEqual(free[:7], [2, 2, 1, 1, 0, 1, 2])
+
+    def test_updated_incrementally(self):
+        reservation = self._create_reservation(2, 3)
+        self.client.get_availability_for_tags(self.tags, 1)
+        reservation.set_reservation_status(Reservation.Status.Cancelled)
+        # Only reservations with a newer status update are read
+        with self.assertNumQueries(1):
+            free = CapacityTimeline().get_free_slots({'cpu': 2, 'memory': 4096}, 1)['free']
+        self.assertEqual(free[:4], [2, 2, 2, 2])
+
+    def test_rebuilt_when_engines_change(self):
+        self.client.get_availability_for_tags(self.tags, 1)
+        Engine.objects.filter(name='engine-1').delete()
+        self.assertEqual(self.client.get_availability_for_tags(self.tags, 1)['free'], [1] * 24)
+        Engine.objects.get(name='engine-0').delete()
+        self.assertEqual(self.client.get_availability_for_tags(self.tags, 1)['free'], [0] * 24)
+
+    def test_unknown_tags(self):
+        self.assertIsNone(self.client.get_availability_for_tags(['not-a-tag'], 1))
+
+
+# Sizes of history the query budgets are checked against, budgets must not depend on it
+BUDGET_DATASET_SIZES = [100, 1000, 5000]
+# Pending reservations admitted and cancelled workstations cleaned up during the budgeted tick
+BUDGET_TICK_ADMISSIONS = 2
+BUDGET_TICK_CLEANUPS = 2
+# Commands, schedule sync, tick query with workstations and engines prefetched, 9 queries per admission
+# and one grouped transition flushed with the batch
+TICK_QUERY_BUDGET = 7 + 9 * BUDGET_TICK_ADMISSIONS + 4
+# Status events add a notification per admission and one for the batch
+TICK_QUERY_BUDGET_WITH_STATUS_EVENTS = TICK_QUERY_BUDGET + BUDGET_TICK_ADMISSIONS + 1
+
+
+class CoordinatorQueryBudgetTests(TestCase):
+    @override_settings(STATUS_EVENTS_ENABLED=False)
+    def test_tick(self):
+        self._assert_tick_budget(TICK_QUERY_BUDGET)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Status events use PostgreSQL notifications')
+    @override_settings(STATUS_EVENTS_ENABLED=True)
+    def test_tick_with_status_events(self):
+        self._assert_tick_budget(TICK_QUERY_BUDGET_WITH_STATUS_EVENTS)
+
+    def _assert_tick_budget(self, budget: int):
+        for size in BUDGET_DATASET_SIZES:
+            with self.subTest(size=size), transaction.atomic():
+                create_reservation_dataset(size, live_reservation_count=BUDGET_TICK_ADMISSIONS)
+                cancelled = Reservation.objects.filter(status=Reservation.Status.Cancelled)[:BUDGET_TICK_CLEANUPS]
+                Workstation.objects.filter(reservation__in=cancelled).update(status=Workstation.Status.Active)
+
+                reservation_handler = RevervationHandler()
+                with self.assertNumQueries(budget):
+                    reservation_handler.handle(EngineHandlerWithoutEngines())
+                self.assertEqual(Reservation.objects.filter(status=Reservation.Status.Pending).count(), 0)
+                self.assertEqual(Workstation.objects.filter(status=Workstation.Status.Cleanup).count(), BUDGET_TICK_CLEANUPS)
+                transaction.set_rollback(True)
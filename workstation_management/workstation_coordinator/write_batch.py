@@ -0,0 +1,97 @@
+import logging
+from typing import Callable
+from django.db import transaction
+from django.utils import timezone
+from .status_events import notify_status_changed
+
+logger = logging.getLogger('workstation_coordinator')
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+# Database execute wrapper counting write statements, used as the per tick write metric
+class WriteCounter:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class StatusTransition:
+    def __init__(self, instance, status, on_success: Callable = None, on_failure: Callable = None) -> None:
+        self.instance = instance
+        self.status = status
+        self.on_success = on_success
+        self.on_failure = on_failure
+
+
+# Collects writes made while handling one coordinator tick and flushes them together. Status transitions
+# keep the semantics of set_workstation_status / set_reservation_status: a row is only changed if it still
+# has the expected status, and callbacks of transitions which lost the race are told so after the flush.
+# Transitions sharing model, expected and new status are written with a single UPDATE, field updates
+# with one bulk_update per model and field set.
+class WriteBatch:
+    def __init__(self) -> None:
+        self.transitions = {}
+        self.field_updates = {}
+
+    def __len__(self) -> int:
+        transition_count = sum([len(transitions) for transitions in self.transitions.values()])
+        field_update_count = sum([len(instances) for instances in self.field_updates.values()])
+        return transition_count + field_update_count
+
+    def set_status(self, instance, status, expected_status=None, on_success: Callable = None, on_failure: Callable = None):
+        if expected_status is None:
+            expected_status = instance.status
+        key = (type(instance), expected_status, status)
+        self.transitions.setdefault(key, []).append(StatusTransition(instance, status, on_success, on_failure))
+
+    def update_fields(self, instance, *fields):
+        key = (type(instance), tuple(sorted(fields)))
+        instances = self.field_updates.setdefault(key, {})
+        instances[instance.pk] = instance
+
+    def _flush_transitions(self, model, expected_status, status, transitions: list) -> set:
+        ids = [transition.instance.pk for transition in transitions]
+        updated_ids = set(model.objects
+                          .select_for_update()
+                          .filter(id__in=ids, status=expected_status)
+                          .values_list('id', flat=True))
+        if len(updated_ids) > 0:
+            last_status_update = timezone.now()
+            model.objects.filter(id__in=updated_ids).update(status=status, last_status_update=last_status_update)
+            notify_status_changed(model, list(updated_ids))
+            for transition in transitions:
+                if transition.instance.pk in updated_ids:
+                    transition.instance.status = status
+                    transition.instance.last_status_update = last_status_update
+        return updated_ids
+
+    def flush(self):
+        if len(self) == 0:
+            return
+        transitions = self.transitions
+        field_updates = self.field_updates
+        self.transitions = {}
+        self.field_updates = {}
+
+        results = []
+        with transaction.atomic():
+            for (model, expected_status, status), grouped in transitions.items():
+                updated_ids = self._flush_transitions(model, expected_status, status, grouped)
+                results.extend([(transition, transition.instance.pk in updated_ids) for transition in grouped])
+            for (model, fields), instances in field_updates.items():
+                model.objects.bulk_update(list(instances.values()), list(fields))
+
+        # Callbacks may start background threads, so they only run once the writes are committed
+        for transition, succeeded in results:
+            callback = transition.on_success if succeeded else transition.on_failure
+            if callback is None:
+                continue
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f'Error in callback of status transition of {transition.instance} to {transition.status}: {e}')
@@ -13,4 +13,22 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'workstation_management.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from django.conf import settings
+from main_server.vnc_proxy import VncProxy
+
+vnc_proxy = VncProxy()
+
+
+# WebSocket connections to VNC_PROXY_PATH are relayed to workstations, Django serves HTTP only
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if settings.VNC_PROXY_ENABLED and scope['path'] == settings.VNC_PROXY_PATH:
+            await vnc_proxy(scope, receive, send)
+            return
+        await receive()
+        await send({'type': 'websocket.close', 'code': 1000})
+        return
+    await django_application(scope, receive, send)
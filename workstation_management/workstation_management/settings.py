@@ -29,6 +29,70 @@ DEBUG = os.environ.get('DEBUG', 'False') == 'True'
 ALLOWED_HOSTS = []
 
 NOVNC_SERVER_ADDRESS = os.environ.get('NOVNC_SERVER_ADDRESS', 'http://127.0.0.1:31000/vnc.html')
+
+# Relays noVNC connections to workstations from the ASGI application instead of an external websockify process.
+# noVNC pages at NOVNC_SERVER_ADDRESS then connect to VNC_PROXY_PATH, so they have to be served from the same origin
+VNC_PROXY_ENABLED = os.environ.get('VNC_PROXY_ENABLED', 'False') == 'True'
+VNC_PROXY_PATH = os.environ.get('VNC_PROXY_PATH', '/websockify')
+# Seconds allowed for connecting to the VNC port of a workstation
+VNC_PROXY_CONNECT_TIMEOUT = float(os.environ.get('VNC_PROXY_CONNECT_TIMEOUT', '5'))
+
+# Longest time in seconds the coordinator sleeps between ticks when no start or end date is due earlier
+COORDINATOR_TICK_INTERVAL = float(os.environ.get('COORDINATOR_TICK_INTERVAL', '5'))
+
+# Interval in seconds between sweeps deleting VMs which have no live workstation and reservation
+ORPHAN_SWEEP_INTERVAL = float(os.environ.get('ORPHAN_SWEEP_INTERVAL', '60'))
+
+# Maximum number of VMs stopped and deleted at the same time on one engine
+VM_TEARDOWN_CONCURRENCY = int(os.environ.get('VM_TEARDOWN_CONCURRENCY', '8'))
+
+# Allows running multiple coordinator processes, reservations are split between them in shards using Postgres advisory locks
+COORDINATOR_SHARDING = os.environ.get('COORDINATOR_SHARDING', 'False') == 'True'
+COORDINATOR_SHARD_COUNT = int(os.environ.get('COORDINATOR_SHARD_COUNT', '64'))
+
+# Seconds after which the in-memory tag index is rebuilt, changes made by other processes are seen after this time
+TAG_INDEX_TTL = float(os.environ.get('TAG_INDEX_TTL', '60'))
+
+# Default and largest number of tag names returned by tag autocomplete
+TAG_AUTOCOMPLETE_LIMIT = int(os.environ.get('TAG_AUTOCOMPLETE_LIMIT', '20'))
+TAG_AUTOCOMPLETE_MAX_LIMIT = int(os.environ.get('TAG_AUTOCOMPLETE_MAX_LIMIT', '100'))
+
+# Seconds browsers reuse tag catalogue responses before revalidating them with their ETag
+TAG_CATALOGUE_MAX_AGE = int(os.environ.get('TAG_CATALOGUE_MAX_AGE', '60'))
+
+# Pushes status changes to open reservation pages as server sent events, requires serving the project over ASGI.
+# Pages then poll only to keep progress current, every RESERVATION_POLL_INTERVAL seconds otherwise
+STATUS_EVENTS_ENABLED = os.environ.get('STATUS_EVENTS_ENABLED', 'False') == 'True'
+STATUS_EVENTS_POLL_INTERVAL = int(os.environ.get('STATUS_EVENTS_POLL_INTERVAL', '60'))
+RESERVATION_POLL_INTERVAL = int(os.environ.get('RESERVATION_POLL_INTERVAL', '5'))
+# Seconds between comments keeping idle event streams open and between reconnects of the status event listener
+STATUS_EVENTS_HEARTBEAT = float(os.environ.get('STATUS_EVENTS_HEARTBEAT', '30'))
+STATUS_EVENTS_RECONNECT_DELAY = float(os.environ.get('STATUS_EVENTS_RECONNECT_DELAY', '5'))
+
+# Seconds the number of reservations of a user shown by the reservations table is cached for
+RESERVATION_COUNT_CACHE_TTL = int(os.environ.get('RESERVATION_COUNT_CACHE_TTL', '60'))
+
+# Seconds rendered reservation page fragments are cached for, keys change with every status update they show.
+# The buttons fragment is not cached, it contains the CSRF token of the session
+RESERVATION_FRAGMENT_CACHE_TTL = int(os.environ.get('RESERVATION_FRAGMENT_CACHE_TTL', '300'))
+
+# Looked up proxy mappings cached for the websockify token lookup, mappings archived by other processes are served
+# for at most MAPPING_CACHE_TTL seconds
+MAPPING_CACHE_SIZE = int(os.environ.get('MAPPING_CACHE_SIZE', '1024'))
+MAPPING_CACHE_TTL = float(os.environ.get('MAPPING_CACHE_TTL', '10'))
+
+# Reservations are approved or rejected while the creating request is handled instead of on the next coordinator tick.
+# Admissions of all web workers and coordinators then wait for each other on the engine row locks
+SYNCHRONOUS_ADMISSION = os.environ.get('SYNCHRONOUS_ADMISSION', 'False') == 'True'
+
+# Availability calendar buckets and how far ahead it reaches. Engine changes made by other processes are seen
+# after AVAILABILITY_TIMELINE_TTL seconds, reservation changes on the next request
+AVAILABILITY_BUCKET_MINUTES = int(os.environ.get('AVAILABILITY_BUCKET_MINUTES', '60'))
+AVAILABILITY_MAX_DAYS = int(os.environ.get('AVAILABILITY_MAX_DAYS', '14'))
+AVAILABILITY_TIMELINE_TTL = float(os.environ.get('AVAILABILITY_TIMELINE_TTL', '300'))
+
+# Largest number of reservations booked by one bulk reservation request
+BULK_RESERVATION_MAX_SEATS = int(os.environ.get('BULK_RESERVATION_MAX_SEATS', '200'))
 # Application definition
 
 INSTALLED_APPS = [
@@ -91,6 +155,32 @@ DATABASES = {
     }
 }
 
+# Threads of a process share a bounded psycopg connection pool instead of each keeping its own connection.
+# Requires Django 5.1, the coordinator adds its reset of session state in run_coordinator
+if os.environ.get('DB_POOL', 'True') == 'True':
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '20')),
+            # Seconds a thread waits for a free connection before failing
+            'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '30')),
+        },
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+# Process local cache of reservation counts and rendered fragments
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '10000')),
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators